@@ -0,0 +1,19 @@
+# Generated by Django 5.1.7 on 2026-10-18 20:11
+
+import chat_site.storage
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('a_users', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='profile',
+            name='image',
+            field=models.ImageField(blank=True, null=True, storage=chat_site.storage.ContentAddressedStorage(), upload_to='avatars/'),
+        ),
+    ]
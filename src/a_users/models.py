@@ -2,9 +2,11 @@ from django.db import models
 from django.contrib.auth.models import User
 from django.conf import settings
 
+from chat_site.storage import content_store
+
 class Profile(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE)
-    image = models.ImageField(upload_to='avatars/', null=True, blank=True)
+    image = models.ImageField(upload_to='avatars/', storage=content_store, null=True, blank=True)
     displayname = models.CharField(max_length=20, null=True, blank=True)
     info = models.TextField(null=True, blank=True) 
     
@@ -0,0 +1,6 @@
+"""
+Benchmarks for the realtime chat.
+
+Each module is a standalone script that runs against a throwaway in-memory
+test database, e.g. ``python -m benchmarks.consumers`` from the ``src`` folder.
+"""
@@ -0,0 +1,137 @@
+"""
+Outbound frame coalescing in a hot room.
+
+Connects ``--connections`` sockets to one room, then its members send
+``--rate`` messages per second for ``--duration`` seconds, each followed by
+an online count update, first with every frame sent on its own and then
+with each ``--window``. Reported per mode, as JSON:
+
+* events: message and presence frames queued for the sockets, per second
+* frames: websocket frames written, per second. Each frame is one write
+  to the socket, so this is also the send syscalls per second
+* coalesced / collapsed: frames joined into another, and presence updates
+  replaced by a newer one
+* latency: time from a message being sent to each member receiving it
+
+    python -m benchmarks.coalesce --connections 100 --rate 50 --window 0.02
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import re
+import time
+
+from benchmarks import harness
+
+MARKER = re.compile(r"burst-(\d+)-")
+
+
+async def run_room(room, users, rate, duration):
+    from channels.db import database_sync_to_async
+    from channels.layers import get_channel_layer
+    from channels.testing import WebsocketCommunicator
+
+    from chat_site.consumers import ChatroomConsumer
+    from chat_site.events import online_count_event
+    from chat_site.models import ChatGroup
+    from chat_site.sendqueue import counters
+
+    application = ChatroomConsumer.as_asgi()
+    communicators = []
+    for user in users:
+        communicator = WebsocketCommunicator(application, f"/ws/chatroom/{room}")
+        communicator.scope["user"] = user
+        communicator.scope["url_route"] = {"kwargs": {"chatroom_name": room}}
+        communicators.append(communicator)
+    for communicator in communicators:
+        await communicator.connect(timeout=120)
+    await harness.drain(communicators)
+    chat_group = await ChatGroup.objects.aget(group_name=room)
+    presence_events = await database_sync_to_async(
+        lambda: [online_count_event(chat_group, n) for n in range(7)]
+    )()
+
+    sent_at = {}
+    latencies = []
+    count = math.ceil(rate * duration)
+
+    async def read(communicator):
+        seen = 0
+        while seen < count:
+            frame = await communicator.receive_from(120)
+            for i in MARKER.findall(frame):
+                latencies.append(time.perf_counter() - sent_at[int(i)])
+                seen += 1
+
+    readers = [asyncio.create_task(read(c)) for c in communicators]
+    before = counters.copy()
+    started = time.perf_counter()
+    for i in range(count):
+        sent_at[i] = time.perf_counter()
+        sender = communicators[i % len(communicators)]
+        await sender.send_to(text_data=json.dumps({"body": f"burst-{i}-"}))
+        await get_channel_layer().group_send(room, presence_events[i % 7])
+        await asyncio.sleep(max(0, started + (i + 1) / rate - time.perf_counter()))
+    await asyncio.gather(*readers)
+    elapsed = time.perf_counter() - started
+    delta = counters - before
+
+    for communicator in communicators:
+        await communicator.disconnect(timeout=120)
+
+    return {
+        "connections": len(users),
+        "messages": count,
+        "events_per_s": round(delta["queued"] / elapsed),
+        "frames_per_s": round(delta["sent"] / elapsed),
+        "coalesced": delta["coalesced"],
+        "collapsed": delta["collapsed"],
+        "latency": harness.summarize(latencies),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--connections", type=int, default=100)
+    parser.add_argument("--rate", type=float, default=50, help="messages per second")
+    parser.add_argument("--duration", type=float, default=5)
+    parser.add_argument("--window", type=float, default=0.02, help="seconds")
+    args = parser.parse_args()
+
+    harness.setup()
+    from django.conf import settings
+
+    for limits in settings.CHAT_RATE_LIMITS.values():
+        for scope in limits:
+            limits[scope] = (math.inf, math.inf)
+    # Measure coalescing, not overflow
+    settings.CHAT_SEND_QUEUE_SIZE = 10_000
+    settings.CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "channels.layers.InMemoryChannelLayer",
+            "CONFIG": {"capacity": 10_000},
+        }
+    }
+
+    users = harness.make_users(args.connections)
+    results = []
+    for window in [0, args.window]:
+        settings.CHAT_COALESCE_WINDOW = window
+        room = f"bench-coalesce-{window}"
+        harness.make_room(room)
+        result = asyncio.run(run_room(room, users, args.rate, args.duration))
+        result["window_s"] = window
+        results.append(result)
+        print(
+            f"window {window:>5}s: {result['events_per_s']:>7} events/s, "
+            f"{result['frames_per_s']:>7} frames/s, "
+            f"latency p50 {result['latency']['p50_ms']} ms "
+            f"p99 {result['latency']['p99_ms']} ms"
+        )
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+"""
+Sync vs async ChatroomConsumer.
+
+Opens N concurrent sockets to one room, then one member sends messages and
+the time until every socket has received each message is recorded.
+
+    python -m benchmarks.consumers --connections 50 200 --messages 20
+"""
+
+import argparse
+import asyncio
+import json
+import time
+
+from benchmarks import harness
+
+
+def legacy_consumer():
+    """The WebsocketConsumer implementation the async consumer replaced."""
+    from asgiref.sync import async_to_sync
+    from channels.generic.websocket import WebsocketConsumer
+    from django.shortcuts import get_object_or_404
+    from django.template.loader import render_to_string
+
+    from chat_site.models import ChatGroup, GroupMessage, UserChannel
+
+    class LegacyChatroomConsumer(WebsocketConsumer):
+        def connect(self):
+            self.user = self.scope["user"]
+            self.chatroom_name = self.scope["url_route"]["kwargs"]["chatroom_name"]
+            self.chatroom = get_object_or_404(ChatGroup, group_name=self.chatroom_name)
+            async_to_sync(self.channel_layer.group_add)(
+                self.chatroom_name, self.channel_name
+            )
+            if self.chatroom.groupchat_name:
+                UserChannel.objects.get_or_create(
+                    member=self.user, group=self.chatroom, channel=self.channel_name
+                )
+            if self.user not in self.chatroom.users_online.all():
+                self.chatroom.users_online.add(self.user)
+                self.update_online_count()
+            self.accept()
+
+        def receive(self, text_data=None, bytes_data=None):
+            message = GroupMessage.objects.create(
+                body=json.loads(text_data)["body"], author=self.user, group=self.chatroom
+            )
+            event = {"type": "message_handler", "message": message}
+            async_to_sync(self.channel_layer.group_send)(self.chatroom_name, event)
+
+        def message_handler(self, event):
+            context = {"message": event["message"], "user": self.user}
+            html = render_to_string("chat_site/partials/chat_message_p.html", context)
+            self.send(text_data=html)
+
+        def disconnect(self, code):
+            async_to_sync(self.channel_layer.group_discard)(
+                self.chatroom_name, self.channel_name
+            )
+            UserChannel.objects.filter(channel=self.channel_name).delete()
+            if self.user in self.chatroom.users_online.all():
+                self.chatroom.users_online.remove(self.user)
+                self.update_online_count()
+
+        def online_count_handler(self, event):
+            context = {"online_count": event["online_count"], "chat_group": self.chatroom}
+            self.send(text_data=render_to_string("chat_site/partials/online_count.html", context))
+
+        def update_online_count(self):
+            event = {
+                "type": "online_count_handler",
+                "online_count": self.chatroom.users_online.count() - 1,
+            }
+            async_to_sync(self.channel_layer.group_send)(self.chatroom_name, event)
+
+    return LegacyChatroomConsumer
+
+
+async def run_room(consumer_cls, room, users, messages):
+    from channels.testing import WebsocketCommunicator
+
+    application = consumer_cls.as_asgi()
+    communicators = []
+    for user in users:
+        communicator = WebsocketCommunicator(application, f"/ws/chatroom/{room}")
+        communicator.scope["user"] = user
+        communicator.scope["url_route"] = {"kwargs": {"chatroom_name": room}}
+        communicators.append(communicator)
+
+    # Every socket connects at once; a connection counts when it is accepted
+    handshakes = await asyncio.gather(
+        *(harness.timed(c.connect(timeout=120)) for c in communicators)
+    )
+    connect_total = max(seconds for _, seconds in handshakes)
+    await harness.drain(communicators)
+
+    latencies = []
+    sender = communicators[0]
+    for i in range(messages):
+        sent_at = time.perf_counter()
+        await sender.send_to(text_data=json.dumps({"body": f"message {i}"}))
+        received = await asyncio.gather(
+            *(harness.received_at(c) for c in communicators)
+        )
+        latencies.extend(at - sent_at for at in received)
+
+    for communicator in communicators:
+        await communicator.disconnect(timeout=120)
+
+    return {
+        "connections": len(users),
+        "connect_total_s": round(connect_total, 3),
+        "connections_per_s": round(len(users) / connect_total, 1),
+        "handshake": harness.summarize([seconds for _, seconds in handshakes]),
+        "latency": harness.summarize(latencies),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--connections", type=int, nargs="+", default=[50, 200])
+    parser.add_argument("--messages", type=int, default=20)
+    args = parser.parse_args()
+
+    harness.setup()
+    from chat_site.consumers import ChatroomConsumer
+
+    users = harness.make_users(max(args.connections))
+    implementations = {"sync": legacy_consumer(), "async": ChatroomConsumer}
+
+    results = []
+    for connections in args.connections:
+        for label, consumer_cls in implementations.items():
+            room = f"bench-{label}-{connections}"
+            harness.make_room(room)
+            result = asyncio.run(
+                run_room(consumer_cls, room, users[:connections], args.messages)
+            )
+            result["consumer"] = label
+            results.append(result)
+            print(
+                f"{label:>5} {connections:>5} sockets: "
+                f"{result['connections_per_s']:>8} conn/s, "
+                f"latency p50 {result['latency']['p50_ms']} ms "
+                f"p99 {result['latency']['p99_ms']} ms"
+            )
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
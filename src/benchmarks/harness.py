@@ -0,0 +1,144 @@
+"""Shared helpers for the benchmark scripts."""
+
+import asyncio
+import atexit
+import contextlib
+import math
+import os
+import shutil
+import tempfile
+import time
+
+import django
+
+
+def setup(on_disk=False):
+    """
+    Configure Django and create a throwaway test database.
+
+    The database lives in memory unless ``on_disk`` is set, for benchmarks
+    where SQLite's file locking and fsyncs are what is being measured.
+    """
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "core.settings")
+    django.setup()
+
+    from django.conf import settings
+    from django.db import connection
+    from django.test.utils import setup_test_environment
+
+    if on_disk:
+        directory = tempfile.mkdtemp(prefix="chat-bench-")
+        atexit.register(shutil.rmtree, directory, ignore_errors=True)
+        settings.DATABASES["default"]["TEST"]["NAME"] = os.path.join(directory, "bench.sqlite3")
+    setup_test_environment()
+    # Never touch example.sqlite3: the benchmarks get their own database
+    connection.creation.create_test_db(verbosity=0)
+
+
+def make_users(count, prefix="bench"):
+    from django.contrib.auth import get_user_model
+
+    User = get_user_model()
+    User.objects.bulk_create(
+        [User(username=f"{prefix}{i}", email=f"{prefix}{i}@example.com") for i in range(count)]
+    )
+    users = list(User.objects.filter(username__startswith=prefix).order_by("id"))
+    # bulk_create skips the post_save signal that creates profiles
+    from a_users.models import Profile
+
+    Profile.objects.bulk_create([Profile(user=user) for user in users])
+    return list(
+        User.objects.filter(username__startswith=prefix)
+        .select_related("profile")
+        .order_by("id")
+    )
+
+
+def make_room(group_name, members=(), **fields):
+    from chat_site.models import ChatGroup
+
+    room = ChatGroup.objects.create(group_name=group_name, **fields)
+    if members:
+        room.members.add(*members)
+    return room
+
+
+class QueryCounter:
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+@contextlib.contextmanager
+def count_queries():
+    """
+    Count the queries of every database connection opened inside the block.
+
+    Consumers query from ``database_sync_to_async`` threads, each with its
+    own connection, so the counter is installed on connections as they are
+    created as well as on the current one: enter it before the event loop
+    starts.
+    """
+    from django.db import connections
+    from django.db.backends.signals import connection_created
+
+    counter = QueryCounter()
+
+    def install(sender, connection, **kwargs):
+        if counter not in connection.execute_wrappers:
+            connection.execute_wrappers.append(counter)
+
+    for connection in connections.all(initialized_only=True):
+        install(None, connection)
+    connection_created.connect(install)
+    try:
+        yield counter
+    finally:
+        connection_created.disconnect(install)
+        for connection in connections.all(initialized_only=True):
+            if counter in connection.execute_wrappers:
+                connection.execute_wrappers.remove(counter)
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of ``values`` (``pct`` between 0 and 100)."""
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    rank = max(1, math.ceil(pct / 100 * len(ordered)))
+    return ordered[rank - 1]
+
+
+def summarize(values):
+    """p50/p99/max of a list of seconds, in milliseconds."""
+    return {
+        "p50_ms": round(percentile(values, 50) * 1000, 3),
+        "p99_ms": round(percentile(values, 99) * 1000, 3),
+        "max_ms": round(max(values) * 1000, 3) if values else float("nan"),
+    }
+
+
+async def drain(communicators, timeout=0.1):
+    """Discard everything the consumers have queued for the clients."""
+
+    async def _drain(communicator):
+        while not await communicator.receive_nothing(timeout=timeout):
+            await communicator.receive_output()
+
+    await asyncio.gather(*(_drain(c) for c in communicators))
+
+
+async def timed(coro):
+    """Await ``coro`` and return ``(result, seconds)``."""
+    started = time.perf_counter()
+    result = await coro
+    return result, time.perf_counter() - started
+
+
+async def received_at(communicator, timeout=120):
+    """Wait for the next frame and return the ``perf_counter`` it arrived at."""
+    await communicator.receive_output(timeout)
+    return time.perf_counter()
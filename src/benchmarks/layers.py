@@ -0,0 +1,135 @@
+"""
+Cross-process fan-out over UnixSocketChannelLayer vs InMemoryChannelLayer.
+
+Starts ``--workers`` processes, each joining ``--channels`` channels to one
+group, then sends ``--messages`` group messages from the parent process and
+records the time from ``group_send`` to each channel receiving it. The
+in-memory layer runs the same channels in a single process, the best a
+one-worker deployment can do.
+
+    python -m benchmarks.layers --workers 4 --channels 250 --messages 200
+"""
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import shutil
+import tempfile
+import time
+
+from benchmarks import harness
+
+GROUP = "bench"
+
+
+async def receive_all(layer, channels, messages):
+    """Receive ``messages`` on every channel; the latency of each."""
+    latencies = []
+
+    async def receive(channel):
+        for _ in range(messages):
+            message = await layer.receive(channel)
+            latencies.append(time.perf_counter() - message["sent"])
+
+    await asyncio.gather(*(receive(channel) for channel in channels))
+    return latencies
+
+
+async def send_all(layer, messages, interval):
+    for i in range(messages):
+        await layer.group_send(GROUP, {"type": "bench", "i": i, "sent": time.perf_counter()})
+        await asyncio.sleep(interval)
+
+
+def worker(path, channels, messages, ready, results):
+    from chat_site.layers import UnixSocketChannelLayer
+
+    async def run():
+        layer = UnixSocketChannelLayer(path, capacity=messages)
+        names = [await layer.new_channel() for _ in range(channels)]
+        for name in names:
+            await layer.group_add(GROUP, name)
+        ready.put(True)
+        latencies = await receive_all(layer, names, messages)
+        await layer.close()
+        results.put(latencies)
+
+    # perf_counter is CLOCK_MONOTONIC on Linux, shared by every process
+    asyncio.run(run())
+
+
+def unix_socket_layer(workers, channels, messages, interval):
+    from chat_site.layers import UnixSocketChannelLayer
+
+    path = tempfile.mkdtemp(prefix="chat-bench-layer-")
+    context = multiprocessing.get_context("spawn")
+    ready, results = context.Queue(), context.Queue()
+    processes = [
+        context.Process(target=worker, args=(path, channels, messages, ready, results))
+        for _ in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    for _ in processes:
+        ready.get()
+
+    async def send():
+        layer = UnixSocketChannelLayer(path)
+        await send_all(layer, messages, interval)
+        await layer.close()
+
+    asyncio.run(send())
+    latencies = [latency for _ in processes for latency in results.get()]
+    for process in processes:
+        process.join()
+    shutil.rmtree(path, ignore_errors=True)
+    return latencies
+
+
+def in_memory_layer(workers, channels, messages, interval):
+    from channels.layers import InMemoryChannelLayer
+
+    async def run():
+        layer = InMemoryChannelLayer(capacity=messages)
+        names = [await layer.new_channel() for _ in range(workers * channels)]
+        for name in names:
+            await layer.group_add(GROUP, name)
+        receiving = asyncio.create_task(receive_all(layer, names, messages))
+        await send_all(layer, messages, interval)
+        return await receiving
+
+    return asyncio.run(run())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--channels", type=int, default=250, help="per worker")
+    parser.add_argument("--messages", type=int, default=200)
+    parser.add_argument("--interval", type=float, default=0.01, help="seconds between sends")
+    args = parser.parse_args()
+
+    layers = {"memory": in_memory_layer, "unix": unix_socket_layer}
+    results = []
+    for label, run in layers.items():
+        started = time.perf_counter()
+        latencies = run(args.workers, args.channels, args.messages, args.interval)
+        result = {
+            "layer": label,
+            "channels": args.workers * args.channels,
+            "delivered": len(latencies),
+            "seconds": round(time.perf_counter() - started, 2),
+            "latency": harness.summarize(latencies),
+        }
+        results.append(result)
+        print(
+            f"{label:>6}: {result['delivered']} deliveries, "
+            f"latency p50 {result['latency']['p50_ms']} ms "
+            f"p99 {result['latency']['p99_ms']} ms"
+        )
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,204 @@
+"""
+Load generation and fan-out latency.
+
+Simulates ``--users`` users spread over ``--rooms`` rooms of ``--room-size``
+members each, every member connected to their room's ChatroomConsumer.
+Each room receives ``--rate`` messages per second, sent in turn by its
+members, for ``--duration`` seconds. Reported, as JSON:
+
+* connect: time until every socket was accepted, and per-handshake p50/p99
+* throughput: messages sent and frames delivered per second
+* latency: time from a message being sent to each member receiving it
+* db_queries_per_message: queries issued while sending, per message sent
+
+    python -m benchmarks.load --users 200 --rooms 10 --room-size 20 --rate 5
+    python -m benchmarks.load ... --output results.jsonl  # append one line per run
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import math
+import re
+import subprocess
+import time
+from datetime import datetime, timezone
+
+from benchmarks import harness
+
+LAYERS = {
+    "memory": "channels.layers.InMemoryChannelLayer",
+    "serializing": "chat_site.layers.SerializingInMemoryChannelLayer",
+}
+
+# Every message body is a unique token, found again in the rendered frames
+TOKEN = re.compile(r"bench-token-(\d+)-end")
+
+
+def room_members(users, rooms, room_size):
+    """Assign ``room_size`` users to each room, round robin over ``users``."""
+    members = {}
+    offset = 0
+    for room in rooms:
+        members[room] = [users[(offset + k) % len(users)] for k in range(room_size)]
+        offset += room_size
+    return members
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def run(members, rate, duration, settle, queries):
+    from channels.testing import WebsocketCommunicator
+
+    from chat_site.consumers import ChatroomConsumer
+    from chat_site.persistence import message_writer
+
+    application = ChatroomConsumer.as_asgi()
+    sockets = {}
+    for room, users in members.items():
+        sockets[room] = []
+        for user in users:
+            communicator = WebsocketCommunicator(application, f"/ws/chatroom/{room}")
+            communicator.scope["user"] = user
+            communicator.scope["url_route"] = {"kwargs": {"chatroom_name": room}}
+            sockets[room].append(communicator)
+    communicators = [c for room_sockets in sockets.values() for c in room_sockets]
+
+    handshakes = await asyncio.gather(
+        *(harness.timed(c.connect(timeout=120)) for c in communicators)
+    )
+    connect_total = max(seconds for _, seconds in handshakes)
+    await harness.drain(communicators)
+
+    sent_at = {}
+    latencies = []
+    tokens = itertools.count()
+
+    async def receive(communicator):
+        while True:
+            frame = await communicator.receive_output(timeout=duration + settle + 60)
+            arrived = time.perf_counter()
+            match = TOKEN.search(frame.get("text", ""))
+            if match:
+                latencies.append(arrived - sent_at[int(match[1])])
+
+    async def send(room_sockets):
+        # A fixed schedule, so a slow send doesn't lower the offered rate
+        started = time.perf_counter()
+        for i in itertools.count():
+            due = started + i / rate
+            if due - started >= duration:
+                return i
+            await asyncio.sleep(max(0, due - time.perf_counter()))
+            token = next(tokens)
+            sent_at[token] = time.perf_counter()
+            body = f"bench-token-{token}-end"
+            await room_sockets[i % len(room_sockets)].send_to(text_data=json.dumps({"body": body}))
+
+    receivers = [asyncio.create_task(receive(c)) for c in communicators]
+    queries_before = queries.count
+    started = time.perf_counter()
+    room_sockets = list(sockets.values())
+    sent = await asyncio.gather(*(send(s) for s in room_sockets))
+    expected = sum(count * len(s) for count, s in zip(sent, room_sockets))
+    deadline = time.perf_counter() + settle
+    while len(latencies) < expected and time.perf_counter() < deadline:
+        await asyncio.sleep(0.01)
+    elapsed = time.perf_counter() - started
+    await message_writer.flush()
+    send_queries = queries.count - queries_before
+
+    for task in receivers:
+        task.cancel()
+    await asyncio.gather(*receivers, return_exceptions=True)
+    for communicator in communicators:
+        await communicator.disconnect(timeout=120)
+
+    messages = len(sent_at)
+    return {
+        "sockets": len(communicators),
+        "connect": {
+            "total_s": round(connect_total, 3),
+            "connections_per_s": round(len(communicators) / connect_total, 1),
+            "handshake": harness.summarize([seconds for _, seconds in handshakes]),
+        },
+        "messages_sent": messages,
+        "frames_expected": expected,
+        "frames_delivered": len(latencies),
+        "sent_per_s": round(messages / elapsed, 1),
+        "delivered_per_s": round(len(latencies) / elapsed, 1),
+        "latency": harness.summarize(latencies),
+        "db_queries_per_message": round(send_queries / messages, 2) if messages else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--rooms", type=int, default=10)
+    parser.add_argument("--room-size", type=int, default=20)
+    parser.add_argument("--rate", type=float, default=5, help="messages per second per room")
+    parser.add_argument("--duration", type=float, default=10, help="seconds of sending")
+    parser.add_argument("--settle", type=float, default=10,
+                        help="seconds to wait for the last frames")
+    parser.add_argument("--layer", choices=LAYERS, default="serializing")
+    parser.add_argument("--persistence", choices=["sync", "write_behind"], default="sync")
+    parser.add_argument("--output", help="append the result as one JSON line to this file")
+    args = parser.parse_args()
+
+    harness.setup()
+    from django.test import override_settings
+
+    users = harness.make_users(args.users)
+    rooms = [f"bench-load-{i}" for i in range(args.rooms)]
+    members = room_members(users, rooms, args.room_size)
+    for room in rooms:
+        harness.make_room(room, members[room])
+
+    config = {
+        "users": args.users,
+        "rooms": args.rooms,
+        "room_size": args.room_size,
+        "rate": args.rate,
+        "duration": args.duration,
+        "layer": args.layer,
+        "persistence": args.persistence,
+    }
+    layers = {"default": {"BACKEND": LAYERS[args.layer], "CONFIG": {"capacity": 10000}}}
+    # The offered load is the benchmark's to choose, not the rate limiter's
+    unlimited = {"user": (math.inf, math.inf), "room": (math.inf, math.inf)}
+    with (
+        override_settings(
+            CHANNEL_LAYERS=layers,
+            CHAT_MESSAGE_PERSISTENCE=args.persistence,
+            CHAT_RATE_LIMITS={"message": unlimited, "upload": unlimited},
+        ),
+        harness.count_queries() as queries,
+    ):
+        result = asyncio.run(run(members, args.rate, args.duration, args.settle, queries))
+
+    record = {
+        "benchmark": "load",
+        "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "revision": git_revision(),
+        "config": config,
+        **result,
+    }
+    line = json.dumps(record)
+    if args.output:
+        with open(args.output, "a") as f:
+            f.write(line + "\n")
+    print(json.dumps(record, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""
+Sync vs write-behind message persistence.
+
+Concurrent senders store messages through ``save_message`` against an
+on-disk SQLite database. "ack" is when the sender may broadcast, "durable"
+when every message is committed.
+
+    python -m benchmarks.persistence --senders 20 --messages 200
+"""
+
+import argparse
+import asyncio
+import json
+import time
+
+from benchmarks import harness
+
+
+async def run(mode, room, users, messages):
+    from django.test import override_settings
+
+    from chat_site.models import GroupMessage
+    from chat_site.persistence import message_writer, save_message
+
+    async def sender(user):
+        for i in range(messages):
+            await save_message(GroupMessage(body=f"message {i}", author=user, group=room))
+
+    with override_settings(CHAT_MESSAGE_PERSISTENCE=mode):
+        started = time.perf_counter()
+        await asyncio.gather(*(sender(user) for user in users))
+        acked = time.perf_counter() - started
+        await message_writer.flush()
+        durable = time.perf_counter() - started
+
+    total = len(users) * messages
+    return {
+        "mode": mode,
+        "messages": total,
+        "ack_messages_per_s": round(total / acked, 1),
+        "durable_messages_per_s": round(total / durable, 1),
+        "ack_s": round(acked, 3),
+        "durable_s": round(durable, 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--senders", type=int, default=20)
+    parser.add_argument("--messages", type=int, default=200, help="per sender")
+    args = parser.parse_args()
+
+    harness.setup(on_disk=True)
+    from chat_site.models import GroupMessage
+
+    users = harness.make_users(args.senders)
+    room = harness.make_room("bench-persistence")
+
+    results = []
+    for mode in ("sync", "write_behind"):
+        result = asyncio.run(run(mode, room, users, args.messages))
+        results.append(result)
+        print(
+            f"{mode:>12}: {result['ack_messages_per_s']:>10} msg/s acked, "
+            f"{result['durable_messages_per_s']:>10} msg/s durable"
+        )
+    stored = GroupMessage.objects.filter(group=room).count()
+    assert stored == 2 * args.senders * args.messages, stored
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+"""
+Full-text search latency on a large synthetic history.
+
+Fills an on-disk database with ``--rows`` messages over ``--rooms`` rooms,
+words drawn from a Zipf-like vocabulary, builds the FTS5 index and times
+``search_messages`` for rare, common, multi-word and prefix queries. A few
+``body__icontains`` scans, newest first and stopping at a page of 20, are
+timed for comparison.
+
+    python -m benchmarks.search --rows 2000000 --rooms 100
+"""
+
+import argparse
+import itertools
+import json
+import random
+import time
+from datetime import timedelta
+
+from benchmarks import harness
+
+VOCABULARY = 20000
+
+
+def word(rank):
+    return f"w{rank}"
+
+
+def random_body(rng, cum_weights):
+    ranks = rng.choices(range(VOCABULARY), cum_weights=cum_weights, k=rng.randint(3, 15))
+    return " ".join(word(rank) for rank in ranks)
+
+
+def fill(rooms, author, rows, rng):
+    from django.db import connection, transaction
+    from django.utils import timezone
+
+    from chat_site import search
+    from chat_site.ids import new_message_id
+
+    cum_weights = list(itertools.accumulate(1 / (rank + 1) for rank in range(VOCABULARY)))
+    started_at = timezone.now() - timedelta(days=365)
+    with connection.cursor() as cursor:
+        # Index once at the end rather than row by row through the triggers
+        for trigger in ("insert", "delete", "update"):
+            cursor.execute(f"DROP TRIGGER {search.FTS_TABLE}_{trigger}")
+        started = time.perf_counter()
+        for start in range(0, rows, 10000):
+            batch = [
+                (
+                    new_message_id(),
+                    rng.choice(rooms).pk,
+                    author.pk,
+                    random_body(rng, cum_weights),
+                    "",
+                    "",
+                    "",
+                    "[]",
+                    connection.ops.adapt_datetimefield_value(
+                        started_at + timedelta(seconds=start + i)
+                    ),
+                )
+                for i in range(min(10000, rows - start))
+            ]
+            # One transaction per batch, not per row
+            with transaction.atomic():
+                cursor.executemany(
+                    "INSERT INTO chat_site_groupmessage "
+                    "(id, group_id, author_id, body, file, file_name, mime_type, variants, created) "
+                    "VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)",
+                    batch,
+                )
+        inserted = time.perf_counter() - started
+
+    started = time.perf_counter()
+    search.rebuild()
+    return inserted, time.perf_counter() - started
+
+
+def time_queries(rooms, queries, search_fn):
+    latencies = []
+    for room, query in queries:
+        started = time.perf_counter()
+        search_fn(room, query)
+        latencies.append(time.perf_counter() - started)
+    return harness.summarize(latencies)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--rooms", type=int, default=100)
+    parser.add_argument("--queries", type=int, default=200, help="per query kind")
+    parser.add_argument("--scans", type=int, default=5, help="icontains queries to time")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    harness.setup(on_disk=True)
+    from chat_site.models import GroupMessage
+    from chat_site.search import search_messages
+
+    rng = random.Random(args.seed)
+    (author,) = harness.make_users(1)
+    rooms = [harness.make_room(f"bench-search-{i}") for i in range(args.rooms)]
+    inserted, indexed = fill(rooms, author, args.rows, rng)
+    print(f"inserted {args.rows} rows in {inserted:.1f}s, indexed in {indexed:.1f}s")
+
+    def sample(make_query):
+        return [(rng.choice(rooms), make_query()) for _ in range(args.queries)]
+
+    kinds = {
+        "common_word": sample(lambda: word(rng.randrange(10))),
+        "rare_word": sample(lambda: word(rng.randrange(VOCABULARY // 2, VOCABULARY))),
+        "two_words": sample(lambda: f"{word(rng.randrange(100))} {word(rng.randrange(1000))}"),
+        "prefix": sample(lambda: word(rng.randrange(100, 1000))[:-1]),
+    }
+
+    def fts(room, query):
+        return search_messages(room, query)
+
+    def icontains(room, query):
+        return list(GroupMessage.objects.filter(group=room, body__icontains=query)[:20])
+
+    results = {
+        "rows": args.rows,
+        "rooms": args.rooms,
+        "insert_s": round(inserted, 1),
+        "index_build_s": round(indexed, 1),
+        "fts": {kind: time_queries(rooms, queries, fts) for kind, queries in kinds.items()},
+        "icontains": {
+            kind: time_queries(rooms, queries[: args.scans], icontains)
+            for kind, queries in kinds.items()
+        },
+    }
+    for kind in kinds:
+        print(
+            f"{kind:>12}: fts p50 {results['fts'][kind]['p50_ms']} ms "
+            f"p99 {results['fts'][kind]['p99_ms']} ms, "
+            f"icontains p50 {results['icontains'][kind]['p50_ms']} ms"
+        )
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+"""
+HTML fragments vs JSON records on chatroom sockets.
+
+Connects ``--connections`` sockets to a room speaking one wire protocol,
+then one member sends ``--messages`` text messages and ``--files`` file
+attachments. Reported per protocol:
+
+* bytes per message: the frames one socket receives for a message
+* CPU per broadcast: process time from a message being sent until every
+  socket has received it. The test clients run in the same process and do
+  the same work in both modes, so only the difference between modes is
+  meaningful.
+
+    python -m benchmarks.wire --connections 100 --messages 50
+"""
+
+import argparse
+import asyncio
+import atexit
+import json
+import math
+import shutil
+import statistics
+import tempfile
+import time
+
+from benchmarks import harness
+
+
+async def run_room(room, users, messages, files, subprotocols):
+    from channels.db import database_sync_to_async
+    from channels.layers import get_channel_layer
+    from channels.testing import WebsocketCommunicator
+    from django.core.files.base import ContentFile
+
+    from chat_site.consumers import ChatroomConsumer
+    from chat_site.events import message_event
+    from chat_site.models import ChatGroup, GroupMessage
+
+    application = ChatroomConsumer.as_asgi()
+    communicators = []
+    for user in users:
+        communicator = WebsocketCommunicator(
+            application, f"/ws/chatroom/{room}", subprotocols=subprotocols
+        )
+        communicator.scope["user"] = user
+        communicator.scope["url_route"] = {"kwargs": {"chatroom_name": room}}
+        communicators.append(communicator)
+    for communicator in communicators:
+        await communicator.connect(timeout=120)
+    await harness.drain(communicators)
+
+    sizes = {"text": [], "file": []}
+    cpu = []
+    sender, receiver = communicators[0], communicators[-1]
+    for i in range(messages):
+        started = time.process_time()
+        await sender.send_to(text_data=json.dumps({"body": f"message {i}, said in passing"}))
+        frames = await asyncio.gather(*(c.receive_from(120) for c in communicators))
+        cpu.append(time.process_time() - started)
+        sizes["text"].append(len(frames[-1].encode()))
+
+    # Attachments are broadcast by the upload view; send the same event
+    chat_group = await ChatGroup.objects.aget(group_name=room)
+
+    @database_sync_to_async
+    def attach(i):
+        message = GroupMessage(group=chat_group, author=users[0])
+        message.file.save(f"notes-{i}.txt", ContentFile(f"notes {i}".encode()))
+        return message_event(GroupMessage.objects.with_authors().get(id=message.id))
+
+    for i in range(files):
+        event = await attach(i)
+        await get_channel_layer().group_send(room, event)
+        sizes["file"].append(len((await receiver.receive_from(120)).encode()))
+        await harness.drain(communicators, timeout=0.01)
+
+    for communicator in communicators:
+        await communicator.disconnect(timeout=120)
+
+    return {
+        "text_bytes": round(statistics.mean(sizes["text"]), 1),
+        "file_bytes": round(statistics.mean(sizes["file"]), 1) if files else None,
+        "cpu_per_broadcast": harness.summarize(cpu),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--connections", type=int, default=100)
+    parser.add_argument("--messages", type=int, default=50)
+    parser.add_argument("--files", type=int, default=5)
+    args = parser.parse_args()
+
+    harness.setup()
+    from django.conf import settings
+
+    from chat_site.records import SUBPROTOCOL
+
+    settings.MEDIA_ROOT = tempfile.mkdtemp(prefix="chat-bench-media-")
+    atexit.register(shutil.rmtree, settings.MEDIA_ROOT, ignore_errors=True)
+    settings.CHAT_THUMBNAIL_WORKERS = 0
+    for limits in settings.CHAT_RATE_LIMITS.values():
+        for scope in limits:
+            limits[scope] = (math.inf, math.inf)
+
+    users = harness.make_users(args.connections)
+    results = []
+    for label, subprotocols in [("html", None), ("json", [SUBPROTOCOL])]:
+        room = f"bench-wire-{label}"
+        harness.make_room(room)
+        result = asyncio.run(run_room(room, users, args.messages, args.files, subprotocols))
+        result["protocol"] = label
+        results.append(result)
+        print(
+            f"{label:>5}: {result['text_bytes']:>7} bytes/message, "
+            f"{result['file_bytes']} bytes/attachment, "
+            f"CPU per broadcast p50 {result['cpu_per_broadcast']['p50_ms']} ms"
+        )
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,6 @@
 from django.contrib import admin
 
-from .models import ChatGroup, GroupMessage, UserChannel
+from .models import ChatBan, ChatGroup, GroupMessage, UserChannel
 
 
 @admin.register(ChatGroup)
@@ -23,3 +23,4 @@ class GroupMessageAdmin(admin.ModelAdmin):
 
 
 admin.site.register(UserChannel)
+admin.site.register(ChatBan)
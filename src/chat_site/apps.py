@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class ChatSiteConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'chat_site'
+
+    def ready(self):
+        from . import signals
@@ -0,0 +1,303 @@
+"""
+Cold storage for old messages.
+
+Messages older than a room's ``archive_after_days`` (or
+``CHAT_ARCHIVE_AFTER_DAYS``) move out of the GroupMessage table into
+append-only segment files under ``CHAT_ARCHIVE_ROOT/<room id>/``. A segment
+holds a run of one room's history, oldest first, and is named after the
+pagination keys of its first and last message. Segments are never modified
+once written; later runs add newer segments after them. A message stored
+after newer ones were archived (write-behind, see ``persistence``) goes to
+the next run's segment, inside the range of an older one, so reads merge
+the segments that overlap.
+
+Segment layout:
+
+    MAGIC    the format version, CHATSEG1 or CHATSEG2
+    block*   zlib-compressed JSON list of up to BLOCK_SIZE messages
+    index    one INDEX_ENTRY per block: key of its first message, offset, length
+    footer   index offset, number of blocks, MAGIC
+
+Reads mmap the segment and binary-search the index, so a "load older" page
+inflates one or two small blocks however large the segment is.
+
+A run writes and fsyncs a segment before deleting its rows from the table,
+by id: a row it didn't write is never deleted. If it is interrupted in
+between, the next run deletes the last segment's rows still in the table
+first, so no message is lost or archived twice.
+"""
+
+import functools
+import json
+import mmap
+import os
+import struct
+import zlib
+from datetime import timedelta
+from pathlib import Path
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db.models import Q
+from django.utils import timezone
+
+from .pagination import PAGE_SIZE, decode_key, encode_key, from_micros, to_micros
+
+MAGIC = b"CHATSEG2"
+READ_MAGICS = (b"CHATSEG1", MAGIC)
+BLOCK_SIZE = 256  # messages per compressed block
+INDEX_ENTRY = struct.Struct("<qqQI")  # first created (µs), first id, offset, length
+DELETE_BATCH = 500  # ids per DELETE, under SQLite's limit of query parameters
+FOOTER = struct.Struct("<QI8s")  # index offset, blocks, magic
+
+# A record is [created (µs), id, author id, body, stored file, uploaded file
+# name, image width, image height, MIME type, variants]: its first two
+# fields are the message's pagination key. CHATSEG1 segments end their
+# records after the stored file, or after the file name, and the missing
+# fields read as these defaults
+RECORD_DEFAULTS = ["", None, None, "", []]  # fields after the stored file
+
+
+def room_dir(group_id):
+    return Path(settings.CHAT_ARCHIVE_ROOT) / str(group_id)
+
+
+def segment_paths(group_id):
+    """A room's segments, oldest first."""
+    directory = room_dir(group_id)
+    try:
+        names = [name for name in os.listdir(directory) if name.endswith(".seg")]
+    except FileNotFoundError:
+        return []
+    return sorted((directory / name for name in names), key=lambda path: Segment.keys(path)[0])
+
+
+class Segment:
+    def __init__(self, path):
+        self.path = path
+        self.first, self.last = self.keys(path)
+        with open(path, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._index, self.blocks, magic = FOOTER.unpack_from(
+            self._map, len(self._map) - FOOTER.size
+        )
+        if magic not in READ_MAGICS:
+            raise ValueError(f"{path} is not a message segment")
+
+    @staticmethod
+    def keys(path):
+        """Keys of the first and last message, from the segment's file name."""
+        first, last = Path(path).stem.split("-")
+        return decode_key(first), decode_key(last)
+
+    def _entry(self, i):
+        return INDEX_ENTRY.unpack_from(self._map, self._index + i * INDEX_ENTRY.size)
+
+    def block(self, i):
+        *_, offset, length = self._entry(i)
+        return json.loads(zlib.decompress(self._map[offset : offset + length]))
+
+    def before(self, key, limit):
+        """Up to ``limit`` records strictly before ``key`` (None: the end), newest first."""
+        # Blocks [0, end) start before the key
+        end = self.blocks
+        if key is not None:
+            low = 0
+            while low < end:
+                middle = (low + end) // 2
+                if tuple(self._entry(middle)[:2]) < key:
+                    low = middle + 1
+                else:
+                    end = middle
+        records = []
+        for i in range(end - 1, -1, -1):
+            block = self.block(i)
+            if key is not None:
+                block = [record for record in block if tuple(record[:2]) < key]
+            records.extend(reversed(block))
+            if len(records) >= limit:
+                break
+        return records[:limit]
+
+
+@functools.lru_cache(maxsize=128)
+def open_segment(path):
+    # Segments are immutable, so a mapping stays valid for the process' lifetime
+    return Segment(path)
+
+
+def archived_before(chat_group, key=None, limit=PAGE_SIZE):
+    """
+    Return up to ``limit`` archived messages before ``key``, newest first.
+
+    The messages are unsaved ``GroupMessage`` instances with their authors
+    and profiles attached, ready for chat_message.html.
+    """
+    from .models import GroupMessage
+
+    records = []
+    for path in reversed(segment_paths(chat_group.pk)):
+        first, last = Segment.keys(path)
+        if key is not None and first >= key:
+            continue
+        # An older segment can still overlap the page, see the module docstring
+        if len(records) >= limit and last < tuple(records[-1][:2]):
+            continue
+        records += open_segment(path).before(key, limit)
+        records.sort(key=lambda record: record[:2], reverse=True)
+        del records[limit:]
+    if not records:
+        return []
+
+    authors = (
+        get_user_model()
+        .objects.select_related("profile")
+        .in_bulk({record[2] for record in records})
+    )
+    messages = []
+    for record in records:
+        record = record + RECORD_DEFAULTS[len(record) - 5 :]
+        created, message_id, author_id, body, file, file_name, *image = record
+        if author_id not in authors:
+            continue  # Messages of deleted users go with them, as in the table
+        image_width, image_height, mime_type, variants = image
+        messages.append(
+            GroupMessage(
+                id=message_id,
+                group=chat_group,
+                author=authors[author_id],
+                body=body,
+                file=file or None,
+                file_name=file_name,
+                image_width=image_width,
+                image_height=image_height,
+                mime_type=mime_type,
+                variants=variants,
+                created=from_micros(created),
+            )
+        )
+    return messages
+
+
+def archived_ids(path):
+    """Ids of the messages in a segment."""
+    segment = Segment(path)
+    for i in range(segment.blocks):
+        for record in segment.block(i):
+            yield record[1]
+
+
+def archived_files(group_id):
+    """Names of the files attached to a room's archived messages."""
+    for path in segment_paths(group_id):
+        segment = Segment(path)
+        for i in range(segment.blocks):
+            for record in segment.block(i):
+                if record[4]:
+                    yield record[4]
+
+
+def write_segment(group_id, records):
+    """Write ``records`` (oldest first) as a new segment and make it durable."""
+    directory = room_dir(group_id)
+    directory.mkdir(parents=True, exist_ok=True)
+    name = f"{encode_key(records[0][:2])}-{encode_key(records[-1][:2])}.seg"
+    partial = directory / f"{name}.partial"
+    index = []
+    with open(partial, "wb") as f:
+        f.write(MAGIC)
+        for start in range(0, len(records), BLOCK_SIZE):
+            block = records[start : start + BLOCK_SIZE]
+            data = zlib.compress(json.dumps(block, separators=(",", ":")).encode())
+            index.append(INDEX_ENTRY.pack(*block[0][:2], f.tell(), len(data)))
+            f.write(data)
+        index_offset = f.tell()
+        f.write(b"".join(index))
+        f.write(FOOTER.pack(index_offset, len(index), MAGIC))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(partial, directory / name)
+    # Make the rename itself durable before the rows are deleted
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def delete_archived(messages, ids):
+    """Delete the rows of ``ids``, messages written to a segment."""
+    ids = list(ids)
+    for start in range(0, len(ids), DELETE_BATCH):
+        batch = messages.filter(id__in=ids[start : start + DELETE_BATCH])
+        # A raw delete skips the delete signals, so django_cleanup keeps the
+        # attachments that archived messages still link to
+        batch._raw_delete(batch.db)
+
+
+def archive_room(chat_group, before, segment_size=None):
+    """Move ``chat_group``'s messages created before ``before`` to new segments."""
+    from .models import GroupMessage
+
+    segment_size = segment_size or settings.CHAT_ARCHIVE_SEGMENT_SIZE
+    messages = GroupMessage.objects.filter(group=chat_group)
+    paths = segment_paths(chat_group.pk)
+    if paths:
+        # Rows an interrupted run archived but didn't get to delete
+        created, message_id = Segment.keys(paths[-1])[1]
+        created = from_micros(created)
+        if messages.filter(
+            Q(created__lt=created) | Q(created=created, id__lte=message_id)
+        ).exists():
+            delete_archived(messages, archived_ids(paths[-1]))
+
+    archived = 0
+    while True:
+        rows = (
+            messages.filter(created__lt=before)
+            .order_by("created", "id")
+            .values_list(
+                "created",
+                "id",
+                "author_id",
+                "body",
+                "file",
+                "file_name",
+                "image_width",
+                "image_height",
+                "mime_type",
+                "variants",
+            )[:segment_size]
+        )
+        records = [
+            [to_micros(created), message_id, author_id, body, file or None, *attachment]
+            for created, message_id, author_id, body, file, *attachment in rows
+        ]
+        if not records:
+            return archived
+        write_segment(chat_group.pk, records)
+        delete_archived(messages, [record[1] for record in records])
+        archived += len(records)
+
+
+def archive_messages(chat_groups=None, days=None, now=None):
+    """
+    Archive every room's messages older than its threshold.
+
+    ``days`` overrides the per-room threshold. Returns ``{room: messages archived}``.
+    """
+    from .models import ChatGroup
+
+    now = now or timezone.now()
+    chat_groups = ChatGroup.objects.all() if chat_groups is None else chat_groups
+    archived = {}
+    for chat_group in chat_groups:
+        room_days = days
+        if room_days is None:
+            room_days = chat_group.archive_after_days
+        if room_days is None:
+            room_days = settings.CHAT_ARCHIVE_AFTER_DAYS
+        archived[chat_group.group_name] = archive_room(
+            chat_group, now - timedelta(days=room_days)
+        )
+    return archived
@@ -0,0 +1,203 @@
+"""
+Cached rooms, room members and verified-email flags.
+
+Every page view and socket connect looks up its room by name, and checks
+the user's membership and, to join a group chat, verified email. The
+answers change rarely, so they are cached:
+
+- ``get_room(group_name)``: the room's fields, without ``last_seq``, which
+  changes with every message (reading it queries);
+- ``member_ids(chat_group)``: the ids of the room's members;
+- ``is_verified(user)``: whether the user has a verified email address;
+- ``banned_ids(chat_group)``: the ids of the users banned from the room.
+
+The cache is ``CHAT_CACHE_BACKEND``: ``LocalCache``, an LRU of
+``CHAT_CACHE_SIZE`` entries in each process, or ``SharedCache``, the
+Django cache ``CHAT_CACHE_ALIAS`` (Redis, memcached) shared by every
+worker. Entries are dropped by the signals in ``chat_site.signals`` when
+their rows change, immediately and again once the change commits. A
+``LocalCache`` only hears the signals of its own process, so deployments
+with several workers (``chat_site.layers.UnixSocketChannelLayer``) need
+``SharedCache``.
+
+Writes that bypass signals (``QuerySet.update``, raw SQL) must call the
+``forget_*`` functions themselves.
+"""
+
+import collections
+import threading
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.http import Http404
+from django.utils.module_loading import import_string
+
+MISSING = object()
+UNCACHED_FIELDS = {"last_seq"}
+
+
+class LocalCache:
+    """A thread-safe LRU of objects, in this process."""
+
+    def __init__(self):
+        self.maxsize = settings.CHAT_CACHE_SIZE
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key, MISSING)
+            if value is not MISSING:
+                self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            if len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def delete_many(self, keys):
+        with self.lock:
+            for key in keys:
+                self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class SharedCache:
+    """The Django cache ``CHAT_CACHE_ALIAS``, shared by the workers using it."""
+
+    def __init__(self):
+        self.cache = caches[settings.CHAT_CACHE_ALIAS]
+
+    def get(self, key):
+        return self.cache.get(key, MISSING)
+
+    def set(self, key, value):
+        self.cache.set(key, value, timeout=None)
+
+    def delete_many(self, keys):
+        self.cache.delete_many(keys)
+
+    def clear(self):
+        self.cache.clear()
+
+
+_backend = None
+
+
+def backend():
+    global _backend
+    if _backend is None:
+        _backend = import_string(settings.CHAT_CACHE_BACKEND)()
+    return _backend
+
+
+def cached(key, load):
+    value = backend().get(key)
+    if value is MISSING:
+        value = load()
+        backend().set(key, value)
+    return value
+
+
+def room_key(group_name):
+    return f"chat:room:{group_name}"
+
+
+def members_key(group_id):
+    return f"chat:members:{group_id}"
+
+
+def verified_key(user_id):
+    return f"chat:verified:{user_id}"
+
+
+def bans_key(group_id):
+    return f"chat:bans:{group_id}"
+
+
+def get_room(group_name):
+    """The room named ``group_name``; raises ``ChatGroup.DoesNotExist``."""
+    from .models import ChatGroup
+
+    def load():
+        fields = [
+            field.attname
+            for field in ChatGroup._meta.concrete_fields
+            if field.attname not in UNCACHED_FIELDS
+        ]
+        row = ChatGroup.objects.filter(group_name=group_name).values_list(*fields).first()
+        return None if row is None else (fields, row)
+
+    cached_row = cached(room_key(group_name), load)
+    if cached_row is None:
+        raise ChatGroup.DoesNotExist(group_name)
+    # A fresh instance per caller: views may change it
+    return ChatGroup.from_db("default", *cached_row)
+
+
+def room_or_404(group_name):
+    from .models import ChatGroup
+
+    try:
+        return get_room(group_name)
+    except ChatGroup.DoesNotExist:
+        raise Http404("No chat group found.")
+
+
+def member_ids(chat_group):
+    """The ids of the members of ``chat_group``, a frozenset."""
+    return cached(
+        members_key(chat_group.pk),
+        lambda: frozenset(chat_group.members.values_list("id", flat=True)),
+    )
+
+
+def is_verified(user):
+    """Whether ``user`` has a verified email address."""
+    return cached(
+        verified_key(user.pk),
+        lambda: user.emailaddress_set.filter(verified=True).exists(),
+    )
+
+
+def banned_ids(chat_group):
+    """The ids of the users banned from ``chat_group``, a frozenset."""
+    return cached(
+        bans_key(chat_group.pk),
+        lambda: frozenset(chat_group.bans.values_list("member_id", flat=True)),
+    )
+
+
+def forget(keys):
+    """Drop ``keys`` now, and again once the current transaction commits."""
+    keys = list(keys)
+    backend().delete_many(keys)
+    # Another thread may cache the old rows until then
+    transaction.on_commit(lambda: backend().delete_many(keys))
+
+
+def forget_room(group_name):
+    forget([room_key(group_name)])
+
+
+def forget_members(group_ids):
+    forget(members_key(group_id) for group_id in group_ids)
+
+
+def forget_bans(group_id):
+    forget([bans_key(group_id)])
+
+
+def forget_verified(user_id):
+    forget([verified_key(user_id)])
+
+
+def clear():
+    backend().clear()
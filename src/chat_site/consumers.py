@@ -1,19 +1,170 @@
+import asyncio
 import json
-from asgiref.sync import async_to_sync
-from channels.generic.websocket import WebsocketConsumer
+import math
+from urllib.parse import parse_qs
+from channels.db import database_sync_to_async
+from channels.generic.websocket import AsyncWebsocketConsumer
+from django.conf import settings
+from django.contrib.auth import get_user_model
 from django.template.loader import render_to_string
-from django.shortcuts import get_object_or_404
 
+from .cache import banned_ids, member_ids, room_or_404
+from .events import (
+    event_handler,
+    message_event,
+    new_message_event,
+    online_count_event,
+    room_status_group,
+    unread_event,
+    user_group,
+)
 from .models import ChatGroup, GroupMessage, UserChannel
+from .moderation import REMOVED_CLOSE_CODE
+from .persistence import save_message
+from .presence import SITE_ROOM, presence
+from .ratelimit import rate_limiter
+from .records import SUBPROTOCOL
+from .replay import room_logs, stored_events
+from .sendqueue import OVERFLOW_CLOSE_CODE, SendQueue
+from .unread import advance_read_cursor, unread_counts
 
+User = get_user_model()
 
-class ChatroomConsumer(WebsocketConsumer):
+
+class PresenceMixin:
+    """
+    Keeps the connection registered in the presence registry while it is open.
+
+    A heartbeat task refreshes the registration. The registry itself starts
+    the timers broadcasting changes and writing ``ChatGroup.users_online``
+    (see ``chat_site.presence``).
+    """
+
+    presence_room = None
+    heartbeat_task = None
+
+    async def join_presence(self, room):
+        """Returns True if the user just came online in ``room``."""
+        self.presence_room = room
+        came_online = presence.connect(room, self.user.id, self.channel_name)
+        self.heartbeat_task = asyncio.create_task(self.heartbeat())
+        return came_online
+
+    async def leave_presence(self):
+        """Returns True if this was the user's last connection to the room."""
+        if self.presence_room is None:
+            return False
+        self.heartbeat_task.cancel()
+        return presence.disconnect(self.presence_room, self.user.id, self.channel_name)
+
+    async def heartbeat(self):
+        while True:
+            await asyncio.sleep(presence.ttl / 3)
+            presence.touch(self.presence_room, self.user.id, self.channel_name)
+
+
+class ReadCursorMixin:
+    """
+    Advances the user's read cursor in the chat the socket shows.
+
+    The cursor moves to the newest message when the socket opens. After
+    that the newest delivered message is remembered and written at most
+    every ``CHAT_READ_CURSOR_INTERVAL`` seconds, and when the socket closes.
+    """
+
+    read_up_to = None
+    read_cursor_task = None
+
+    async def open_read_cursor(self):
+        # Only members have cursors; the public chat has none
+        if self.chatroom.groupchat_name or self.chatroom.is_private:
+            await self.save_read_cursor()
+
+    def mark_read(self, message_id):
+        if self.read_up_to is None or message_id > self.read_up_to:
+            self.read_up_to = message_id
+        if self.read_cursor_task is None:
+            self.read_cursor_task = asyncio.create_task(self.save_read_cursor_later())
+
+    async def save_read_cursor_later(self):
+        await asyncio.sleep(settings.CHAT_READ_CURSOR_INTERVAL)
+        self.read_cursor_task = None
+        await self.save_read_cursor()
+
+    async def close_read_cursor(self):
+        if self.read_cursor_task is not None:
+            self.read_cursor_task.cancel()
+            self.read_cursor_task = None
+            await self.save_read_cursor()
+
+    async def save_read_cursor(self):
+        moved = await database_sync_to_async(advance_read_cursor)(
+            self.user.id, self.chatroom.pk, self.read_up_to
+        )
+        if moved is not None:
+            self.read_up_to, unread_count = moved
+            event = unread_event(self.chatroom_name, self.read_up_to, unread_count)
+            await self.channel_layer.group_send(user_group(self.user.id), event)
+
+
+class SendQueueMixin:
+    """
+    Sends through a bounded ``SendQueue`` once the socket is accepted (see
+    ``chat_site.sendqueue``). ``send(..., presence=True)`` marks frames that
+    may be dropped when the client falls behind, ``presence="<name>"`` ones
+    that also replace the queued update of the same name. Consumers setting
+    ``coalesce`` join bursts of frames if ``CHAT_COALESCE_WINDOW`` is set.
+    """
+
+    send_queue = None
+    coalesce = False
+
+    async def accept(self, subprotocol=None, headers=None):
+        await super().accept(subprotocol, headers)
+        self.send_queue = SendQueue(
+            self.base_send,
+            self.close_overflowed,
+            settings.CHAT_SEND_QUEUE_SIZE,
+            window=settings.CHAT_COALESCE_WINDOW if self.coalesce else 0,
+            max_bytes=settings.CHAT_COALESCE_MAX_BYTES,
+        )
+
+    async def send(self, text_data=None, bytes_data=None, close=False, presence=False):
+        if self.send_queue is None:
+            return await super().send(text_data, bytes_data, close)
+        if text_data is not None:
+            message = {"type": "websocket.send", "text": text_data}
+        elif bytes_data is not None:
+            message = {"type": "websocket.send", "bytes": bytes_data}
+        else:
+            raise ValueError("You must pass one of bytes_data or text_data")
+        await self.send_queue.put(message, presence)
+        if close:
+            await self.close(close)
+
+    async def close_overflowed(self):
+        await self.close(code=OVERFLOW_CLOSE_CODE)
+
+    async def websocket_disconnect(self, message):
+        if self.send_queue is not None:
+            self.send_queue.close()
+        await super().websocket_disconnect(message)
+
+
+class ChatroomConsumer(SendQueueMixin, ReadCursorMixin, PresenceMixin, AsyncWebsocketConsumer):
     """
     ChatroomConsumer handles WebSocket connections for a chatroom.
     It manages user connections, message sending, and receiving in real-time.
+
+    The consumer runs natively on the event loop. Every piece of ORM work a
+    handler needs is grouped into a single ``database_sync_to_async`` call so
+    that each event costs at most one hop to the thread pool.
     """
 
-    def connect(self):
+    coalesce = True
+    removed = False
+
+    async def connect(self):
         """
         Handles the WebSocket connection process.
 
@@ -21,74 +172,152 @@ class ChatroomConsumer(WebsocketConsumer):
         It retrieves the chatroom name from the URL, fetches the corresponding
         ChatGroup object, and adds the user to the chatroom group in the channel layer.
         """
-        self.user = self.scope["user"]  # Get the user from the scope
+        # Get the user from the scope, with the profile every message renders
+        self.user = await User.objects.select_related("profile").aget(
+            pk=self.scope["user"].pk
+        )
         self.chatroom_name = self.scope["url_route"]["kwargs"][
             "chatroom_name"
         ]  # Get chatroom name from URL
-        self.chatroom = get_object_or_404(
-            ChatGroup, group_name=self.chatroom_name
-        )  # Fetch the ChatGroup
 
-        # Add the user to the chatroom group in the channel layer
-        async_to_sync(self.channel_layer.group_add)(
-            self.chatroom_name, self.channel_name
-        )
+        self.chatroom = await database_sync_to_async(room_or_404)(
+            self.chatroom_name
+        )  # Fetch the ChatGroup, usually cached
+        if not await database_sync_to_async(self.may_join)():
+            await self.close()  # Rejects the handshake
+            return
+
+        # Add the user to the chatroom group in the channel layer. Joined
+        # before replay() reads the room's last_seq, so every message
+        # numbered after it is delivered live
+        await self.channel_layer.group_add(self.chatroom_name, self.channel_name)
 
         if self.chatroom.groupchat_name:
-            UserChannel.objects.get_or_create(
+            await UserChannel.objects.aget_or_create(
                 member=self.user, group=self.chatroom, channel=self.channel_name
             )
         # Update online users value
-        if self.user not in self.chatroom.users_online.all():
-            self.chatroom.users_online.add(self.user)
-            self.update_online_count()
-        self.accept()  # Accept the WebSocket connection
-
-    def receive(self, text_data=None, bytes_data=None):
+        if await self.join_presence(self.chatroom_name):
+            await self.update_online_count(online=True)
+        await self.open_read_cursor()  # The page shows the newest messages
+        # JSON records if the client offers them, HTML fragments otherwise
+        self.records = SUBPROTOCOL in self.scope.get("subprotocols", [])
+        await self.accept(SUBPROTOCOL if self.records else None)
+        await self.replay()
+
+    def may_join(self):
+        """Members only, in private and group chats, and never the banned."""
+        if self.user.id in banned_ids(self.chatroom):
+            return False
+        if self.chatroom.groupchat_name or self.chatroom.is_private:
+            return self.user.id in member_ids(self.chatroom)
+        return True
+
+    async def replay(self):
+        """
+        Send the messages a reconnecting client missed, the ones numbered
+        after the ``last_seq`` it gives, up to the room's when it connected.
+        """
+        self.replayed = set()
+        query = parse_qs(self.scope.get("query_string", b"").decode())
+        try:
+            after = int(query["last_seq"][0])
+        except (KeyError, ValueError):
+            return  # A fresh page, which shows the newest messages already
+        # Not cached: it changes with every message
+        up_to = await ChatGroup.objects.filter(pk=self.chatroom.pk).values_list(
+            "last_seq", flat=True
+        ).aget()
+        if after >= up_to:
+            return
+        if up_to - after > settings.CHAT_REPLAY_LIMIT:
+            await self.send(text_data=render_to_string("chat_site/partials/reload.html"))
+            return
+        log = room_logs.get(self.chatroom_name)
+        events = log.between(after, up_to)
+        if events is None:
+            events = await database_sync_to_async(stored_events)(self.chatroom, after, up_to)
+            for event in events:
+                log.add(event["seq"], event)
+        for event in events:
+            await self.send(text_data=self.message_frame(event))
+            self.replayed.add(event["seq"])
+
+    def message_frame(self, event):
+        """What this socket is sent for a ``message_handler`` event."""
+        if self.records:
+            return event["record"]
+        return event["html"]["own" if event["author_id"] == self.user.id else "other"]
+
+    async def receive(self, text_data=None, bytes_data=None):
         """
         Receives messages sent from the WebSocket.
 
         This method is called when a message is received from the WebSocket.
         It parses the incoming JSON data, creates a new GroupMessage object,
-        and sends the message to the chatroom group for broadcasting.
+        and sends the message to the chatroom group for broadcasting. With
+        write-behind persistence the message is broadcast before it is stored.
 
         Args:
             text_data (str): The text data received from the WebSocket.
             bytes_data (bytes): The binary data received from the WebSocket (not used here).
         """
+        if self.removed:
+            return  # Closing, see removed_handler
+        retry_after = rate_limiter.take("message", self.user.id, self.chatroom_name)
+        if retry_after:
+            # Dropped before it costs an insert and a broadcast
+            html = render_to_string(
+                "chat_site/partials/rate_limited.html", {"retry_after": math.ceil(retry_after)}
+            )
+            await self.send(text_data=html)
+            return
+
         text_data_json = json.loads(text_data)  # Parse the incoming JSON data
         body = text_data_json["body"]  # Extract the message body
-        message = GroupMessage.objects.create(
+        message = GroupMessage(
             body=body, author=self.user, group=self.chatroom
-        )  # Create a new GroupMessage instance
+        )  # Create a new GroupMessage instance, id and timestamp included
+        await save_message(message)  # Stored now or queued, see persistence
 
-        # Prepare the event to send to the group
+        # Render the message once for the author and once for everyone else
         # Calls message_handler function defined below
-        event = {"type": "message_handler", "message": message}
-        async_to_sync(self.channel_layer.group_send)(
+        event = await database_sync_to_async(message_event)(message)
+        await self.channel_layer.group_send(
             self.chatroom_name, event
         )  # Send the event to the group
+        # Members elsewhere on the site count it towards their unread badges
+        await self.channel_layer.group_send(
+            room_status_group(self.chatroom_name), new_message_event(message)
+        )
 
-    def message_handler(self, event):
+    @event_handler
+    async def message_handler(self, event):
         """
         Handles the message event sent to the chatroom group.
 
         This method is called when a message event is received from the channel layer.
-        It renders the message using a template and sends it back to the WebSocket.
+        The sender already rendered both variants of the message and its JSON
+        record, so the only work left per recipient is picking one and
+        sending it.
 
         Args:
-            event (dict): The event data containing the message to be sent.
+            event (dict): A ``message_handler`` event, see ``chat_site.events``.
         """
-        message = event["message"]  # Extract the message from the event
-
-        # Prepare the context for rendering the message
-        context = {"message": message, "user": self.user}
-        html = render_to_string(
-            "chat_site/partials/chat_message_p.html", context=context
-        )  # Render the message using a template
-        self.send(text_data=html)  # Send the rendered message back to the WebSocket
-
-    def disconnect(self, code):
+        seq = event.get("seq")
+        if seq is not None:
+            room_logs.get(self.chatroom_name).add(seq, event)
+            if seq in self.replayed:
+                return  # Broadcast while it was being replayed
+        await self.send(text_data=self.message_frame(event))
+        self.mark_read(event["id"])
+
+    @event_handler
+    async def attachment_handler(self, event):
+        """Swap in a message's image once its variants are made."""
+        await self.send(text_data=event["record"] if self.records else event["html"])
+
+    async def disconnect(self, code):
         """
         Handles the WebSocket disconnection process.
 
@@ -98,88 +327,168 @@ class ChatroomConsumer(WebsocketConsumer):
         Args:
             code (int): The disconnection code.
         """
-        async_to_sync(self.channel_layer.group_discard)(
+        await self.channel_layer.group_discard(
             self.chatroom_name, self.channel_name
         )  # Remove the user from the chatroom group
 
-        try:
-            user_channel = UserChannel.objects.get(channel=self.channel_name)
-            user_channel.delete()
-        except:
-            pass
-
-        if self.user in self.chatroom.users_online.all():
-            self.chatroom.users_online.remove(self.user)
-            self.update_online_count()
-
-    def online_count_handler(self, event):
-        online_count = event["online_count"]
-        context = {
-            "online_count": online_count,
-            "chat_group": self.chatroom,
-        }
-        html = render_to_string("chat_site/partials/online_count.html", context)
-        self.send(text_data=html)
-
-    def update_online_count(self):
-        online_count = self.chatroom.users_online.count() - 1
-        # event is message sent back to the browser
-        event = {
-            "type": "online_count_handler",  # function to handle event
-            "online_count": online_count,
-        }
-        async_to_sync(self.channel_layer.group_send)(self.chatroom_name, event)
-
-
-class OnlineStatusConsumer(WebsocketConsumer):
-    def connect(self):
-        self.user = self.scope["user"]
-        self.group_name = "online-status"
-        self.group = get_object_or_404(ChatGroup, group_name=self.group_name)
-
-        if self.user not in self.group.users_online.all():
-            self.group.users_online.add(self.user)
-
-        async_to_sync(self.channel_layer.group_add)(self.group_name, self.channel_name)
-        self.accept()
-        self.online_status()
-
-    def online_status_handler(self, event):
-        online_users = self.group.users_online.exclude(id=self.user.id)
-        public_chat_users = ChatGroup.objects.get(
-            group_name="public-chat"
-        ).users_online.exclude(id=self.user.id)
+        if self.chatroom.groupchat_name:
+            await UserChannel.objects.filter(channel=self.channel_name).adelete()
+
+        if await self.leave_presence():
+            await self.update_online_count(online=False)
+        await self.close_read_cursor()
+
+    @event_handler
+    async def removed_handler(self, event):
+        """Close the socket if its user was removed from the room."""
+        if self.user.id in event["user_ids"]:
+            self.removed = True
+            await self.close(code=REMOVED_CLOSE_CODE)
+
+    @event_handler
+    async def online_count_handler(self, event):
+        await self.send(text_data=event["html"], presence="online_count")
+        if "member_html" in event:
+            # Only the member's own dot, superseded by their next change
+            await self.send(
+                text_data=event["member_html"],
+                presence=f"member_status:{event['member_id']}",
+            )
 
-        online_in_chats = False
+    async def update_online_count(self, online):
+        """
+        Broadcast the room's count and this user's status dot, having come
+        ``online`` or gone offline. Nothing is queried or re-rendered per member.
+        """
+        online_count = presence.online_count(self.chatroom_name) - 1
+        event = online_count_event(self.chatroom, online_count, self.user.id, online)
+        await self.channel_layer.group_send(self.chatroom_name, event)
 
-        my_chats: list[ChatGroup] = self.user.chat_groups.all()
-        private_chats_with_users = [
-            chat
-            for chat in my_chats
-            if chat.users_online.exclude(id=self.user.id).exists()
-        ]
 
-        if public_chat_users or private_chats_with_users:
-            online_in_chats = True
+class OnlineStatusConsumer(SendQueueMixin, PresenceMixin, AsyncWebsocketConsumer):
+    """
+    Drives the site-wide online count, the "someone is online in my chats"
+    dot and the unread badges in the header.
 
-        context = {"online_users": online_users, "online_in_chats": online_in_chats}
-        html = render_to_string(
-            "chat_site/partials/online_status.html", context=context
-        )
-        self.send(text_data=html)
+    The consumer listens to the presence batches and new messages of every
+    room the user is a member of and keeps the set of those rooms with
+    someone else online, and their unread counts, up to date from them, so
+    an update costs no queries.
+    """
 
-    def online_status(self):
-        event = {"type": "online_status_handler"}
-        async_to_sync(self.channel_layer.group_send)(self.group_name, event)
+    async def connect(self):
+        self.user = self.scope["user"]
+        self.group_name = SITE_ROOM
+        counts = await database_sync_to_async(unread_counts)(self.user)
+        self.last_read = {room: last_read_id for room, (last_read_id, _) in counts.items()}
+        self.unread = {room: unread_count for room, (_, unread_count) in counts.items()}
+        # Rooms whose activity lights up the "online in chats" dot
+        self.my_rooms = {"public-chat"} | set(counts)
+        self.busy_rooms = {room for room in self.my_rooms if self.others_online(room)}
+
+        await self.join_presence(self.group_name)
+        self.online_count = presence.online_count(self.group_name) - 1
+        for group in [self.group_name, user_group(self.user.id)]:
+            await self.channel_layer.group_add(group, self.channel_name)
+        for room in self.my_rooms:
+            await self.channel_layer.group_add(room_status_group(room), self.channel_name)
+        await self.accept()
+        await self.send_status()
+        await self.send_unread(self.unread)
+
+    def others_online(self, room):
+        return bool(presence.online_user_ids(room) - {self.user.id})
+
+    async def send_status(self):
+        context = {
+            "online_count": self.online_count,
+            "online_in_chats": bool(self.busy_rooms),
+        }
+        html = render_to_string("chat_site/partials/online_status.html", context=context)
+        await self.send(text_data=html, presence="online_status")
 
-    def disconnect(self, code):
-        if self.user in self.group.users_online.all():
-            self.group.users_online.remove(self.user)
-        async_to_sync(self.channel_layer.group_discard)(
-            self.group_name, self.channel_name
-        )
-        self.online_status()
+    async def send_unread(self, rooms):
+        context = {
+            "badges": [(room, self.unread.get(room, 0)) for room in rooms],
+            "total": sum(self.unread.values()),
+        }
+        html = render_to_string("chat_site/partials/unread_badges.html", context=context)
+        await self.send(text_data=html)
+
+    async def set_room_busy(self, room, busy):
+        was_online_in_chats = bool(self.busy_rooms)
+        if busy:
+            self.busy_rooms.add(room)
+        else:
+            self.busy_rooms.discard(room)
+        if bool(self.busy_rooms) != was_online_in_chats:
+            await self.send_status()
+
+    @event_handler
+    async def online_status_handler(self, event):
+        # The recipient is online itself, so it is not counted
+        self.online_count = event["online_count"] - 1
+        await self.send_status()
+
+    @event_handler
+    async def room_presence_handler(self, event):
+        if event["room"] not in self.my_rooms:
+            return
+        online_count, sole_user_id = event["online_count"], event["sole_user_id"]
+        busy = online_count > 1 or (online_count == 1 and sole_user_id != self.user.id)
+        await self.set_room_busy(event["room"], busy)
+
+    @event_handler
+    async def new_message_handler(self, event):
+        room = event["room"]
+        if (
+            room not in self.unread
+            or event["author_id"] == self.user.id
+            or event["id"] <= self.last_read[room]
+            or presence.is_online(room, self.user.id)  # reading it right now
+        ):
+            return
+        self.unread[room] += 1
+        await self.send_unread([room])
+
+    @event_handler
+    async def unread_handler(self, event):
+        room = event["room"]
+        if room not in self.unread:
+            return
+        self.unread[room] = event["unread_count"]
+        self.last_read[room] = max(self.last_read[room], event["last_read_id"])
+        await self.send_unread([room])
+
+    @event_handler
+    async def membership_handler(self, event):
+        room = event["room"]
+        if event["member"]:
+            self.my_rooms.add(room)
+            # Joining starts the cursor at the newest message
+            self.unread.setdefault(room, 0)
+            self.last_read.setdefault(room, 0)
+            await self.channel_layer.group_add(room_status_group(room), self.channel_name)
+            await self.set_room_busy(room, self.others_online(room))
+        elif room != "public-chat":
+            self.my_rooms.discard(room)
+            self.unread.pop(room, None)
+            self.last_read.pop(room, None)
+            await self.channel_layer.group_discard(
+                room_status_group(room), self.channel_name
+            )
+            await self.set_room_busy(room, False)
+            await self.send_unread([room])
+
+    async def disconnect(self, code):
+        await self.leave_presence()
+        for group in [self.group_name, user_group(self.user.id)]:
+            await self.channel_layer.group_discard(group, self.channel_name)
+        for room in self.my_rooms:
+            await self.channel_layer.group_discard(
+                room_status_group(room), self.channel_name
+            )
 
-    def receive(self, text_data=None, bytes_data=None):
+    async def receive(self, text_data=None, bytes_data=None):
         # Handle unexpected message types
         print("Received message:", text_data)
@@ -0,0 +1,9 @@
+def chat_groups(request):
+    """
+    The user's chats for the header dropdown, with the members it lists
+    prefetched and their unread counts.
+    """
+    if not request.user.is_authenticated:
+        return {}
+    chat_groups = request.user.chat_groups.with_members().with_unread_counts(request.user)
+    return {"my_chat_groups": chat_groups}
@@ -0,0 +1,200 @@
+"""
+Channel-layer events exchanged between workers.
+
+Every event is a flat dict of JSON types so it survives any channel layer
+(Redis, a multi-process layer, ...), not only ``InMemoryChannelLayer``. Rows
+are referenced by id and the fields handlers need are extracted up front, so
+recipients never reload them.
+
+``message_handler`` (``v`` 1)
+    ``id``, ``group``, ``seq`` (the message's number in the room, see
+    ``chat_site.replay``), ``author_id``, ``created`` (ISO 8601) and
+    ``html``, a dict with the ``own`` and ``other`` renders of the message,
+    and ``record``, its serialized JSON record (``chat_site.records``).
+``attachment_handler`` (``v`` 1)
+    ``id``, ``html``, the message's image with its variants, rendered to
+    replace the one sent before they were made (``chat_site.thumbnails``),
+    and ``record``, the same as a JSON record.
+``online_count_handler`` (``v`` 1)
+    ``group``, ``online_count`` and ``html``, the rendered count. When a
+    member came online or went offline, also ``member_id``, ``online`` and
+    ``member_html``, that member's status dot, to swap in by itself.
+``removed_handler`` (``v`` 1)
+    ``group`` and ``user_ids``, members removed from a chatroom group, whose
+    sockets in that room close (``chat_site.moderation``).
+``online_status_handler`` (``v`` 1)
+    ``online_count``, the number of users with the site open.
+``room_presence_handler`` (``v`` 1)
+    ``room``, ``online_count`` and ``sole_user_id`` (the only user online
+    when ``online_count`` is 1), sent to ``room_status_group(room)``.
+``membership_handler`` (``v`` 1)
+    ``room`` and ``member``, sent to ``user_group(user_id)`` when the user
+    joins or leaves a chat.
+``new_message_handler`` (``v`` 1)
+    ``room``, ``id`` and ``author_id`` of a message, sent to
+    ``room_status_group(room)`` for the members' unread badges.
+``unread_handler`` (``v`` 1)
+    ``room``, ``last_read_id`` and ``unread_count``, sent to
+    ``user_group(user_id)`` when the user's read cursor moved.
+
+Bump ``EVENT_VERSION`` when a field changes meaning; handlers drop events
+of other versions so mixed deployments don't render garbage.
+"""
+
+import functools
+
+from django.template.loader import render_to_string
+
+from .records import attachment_record, message_record
+
+EVENT_VERSION = 1
+
+
+def room_status_group(room):
+    """Group of the online-status sockets of a room's members."""
+    return f"{room}.status"
+
+
+def user_group(user_id):
+    """Group of all online-status sockets of one user."""
+    return f"user-{user_id}"
+
+
+def event_handler(handler):
+    """Ignore events whose schema version this worker doesn't understand."""
+
+    @functools.wraps(handler)
+    async def wrapper(self, event):
+        if event.get("v") != EVENT_VERSION:
+            return
+        return await handler(self, event)
+
+    return wrapper
+
+
+def render_message_variants(message):
+    """
+    Render a chat message once for its author and once for everyone else.
+
+    ``chat_message_p.html`` only differs between recipients on
+    ``message.author == user``, so two renders cover the whole room.
+    """
+    template = "chat_site/partials/chat_message_p.html"
+    return {
+        "own": render_to_string(template, {"message": message, "user": message.author}),
+        "other": render_to_string(template, {"message": message, "user": None}),
+    }
+
+
+def message_event(message):
+    """Build the ``message_handler`` event broadcast to a chatroom group."""
+    return {
+        "type": "message_handler",
+        "v": EVENT_VERSION,
+        "id": message.id,
+        "group": message.group.group_name,
+        "seq": message.seq,
+        "author_id": message.author_id,
+        "created": message.created.isoformat(),
+        "html": render_message_variants(message),
+        "record": message_record(message),
+    }
+
+
+def attachment_event(message):
+    """Build the ``attachment_handler`` event broadcast to a chatroom group."""
+    return {
+        "type": "attachment_handler",
+        "v": EVENT_VERSION,
+        "id": message.id,
+        "html": render_to_string(
+            "chat_site/partials/attachment.html", {"message": message, "oob": True}
+        ),
+        "record": attachment_record(message),
+    }
+
+
+def online_count_event(chat_group, online_count, member_id=None, online=False):
+    """
+    Build the ``online_count_handler`` event broadcast to a chatroom group,
+    for ``member_id`` having come ``online`` or gone offline.
+    """
+    event = {
+        "type": "online_count_handler",
+        "v": EVENT_VERSION,
+        "group": chat_group.group_name,
+        "online_count": online_count,
+        "html": render_to_string(
+            "chat_site/partials/online_count.html", {"online_count": online_count}
+        ),
+    }
+    if member_id is not None:
+        context = {"member_id": member_id, "online": online, "oob": True}
+        event["member_id"] = member_id
+        event["online"] = online
+        event["member_html"] = render_to_string(
+            "chat_site/partials/member_status.html", context
+        )
+    return event
+
+
+def removed_event(room, user_ids):
+    """Build the ``removed_handler`` event broadcast to a chatroom group."""
+    return {
+        "type": "removed_handler",
+        "v": EVENT_VERSION,
+        "group": room,
+        "user_ids": sorted(user_ids),
+    }
+
+
+def online_status_event(online_count):
+    """Build the ``online_status_handler`` event broadcast to ``online-status``."""
+    return {
+        "type": "online_status_handler",
+        "v": EVENT_VERSION,
+        "online_count": online_count,
+    }
+
+
+def room_presence_event(room, online_user_ids):
+    """Build the ``room_presence_handler`` event for a room's members."""
+    return {
+        "type": "room_presence_handler",
+        "v": EVENT_VERSION,
+        "room": room,
+        "online_count": len(online_user_ids),
+        "sole_user_id": next(iter(online_user_ids)) if len(online_user_ids) == 1 else None,
+    }
+
+
+def membership_event(room, member):
+    """Build the ``membership_handler`` event for a user who joined or left ``room``."""
+    return {
+        "type": "membership_handler",
+        "v": EVENT_VERSION,
+        "room": room,
+        "member": member,
+    }
+
+
+def new_message_event(message):
+    """Build the ``new_message_handler`` event for the status group of a message's room."""
+    return {
+        "type": "new_message_handler",
+        "v": EVENT_VERSION,
+        "room": message.group.group_name,
+        "id": message.id,
+        "author_id": message.author_id,
+    }
+
+
+def unread_event(room, last_read_id, unread_count):
+    """Build the ``unread_handler`` event for a user whose read cursor in ``room`` moved."""
+    return {
+        "type": "unread_handler",
+        "v": EVENT_VERSION,
+        "room": room,
+        "last_read_id": last_read_id,
+        "unread_count": unread_count,
+    }
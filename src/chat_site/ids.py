@@ -0,0 +1,122 @@
+"""
+Time-ordered message ids assigned by the application.
+
+Ids are handed out before a message reaches the database, so a message can
+be broadcast (and referenced by cursors) while it is still queued for the
+write-behind writer. Layout, 53 bits so they stay exact in JavaScript:
+
+    milliseconds since 2025-01-01 (41 bits) | worker (6 bits) | sequence (6 bits)
+
+Every process writing messages needs its own worker id (0-63), or two of
+them can hand out the same id in the same millisecond. ``CHAT_WORKER_ID``
+sets it. Left unset, each process claims the lowest free one by holding
+an exclusive lock on ``worker-<id>.lock`` in ``CHAT_WORKER_LOCK_DIR`` for
+as long as it lives, and refuses to start when all 64 are taken. The locks
+only cover one host: processes on several hosts writing to the same
+database need explicit, distinct ``CHAT_WORKER_ID`` values.
+"""
+
+import os
+import threading
+import time
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+EPOCH_MS = 1735689600000  # 2025-01-01T00:00:00Z
+WORKER_BITS = 6
+SEQUENCE_BITS = 6
+MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+
+
+MAX_WORKER_ID = (1 << WORKER_BITS) - 1
+
+
+def lock_file(f):
+    """Lock ``f`` exclusively without waiting; raises OSError if it is held."""
+    if fcntl is not None:
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    else:
+        msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+
+
+def claim_worker_id(directory):
+    """
+    Claim the lowest worker id no other process holds under ``directory``.
+    Returns the id and its open lock file, which holds the claim until it
+    is closed or the process exits.
+    """
+    os.makedirs(directory, exist_ok=True)
+    for worker_id in range(MAX_WORKER_ID + 1):
+        f = open(os.path.join(directory, f"worker-{worker_id}.lock"), "a+b")
+        try:
+            lock_file(f)
+        except OSError:
+            f.close()
+            continue
+        return worker_id, f
+    raise ImproperlyConfigured(
+        f"All {MAX_WORKER_ID + 1} worker ids in {directory} are taken: "
+        "set CHAT_WORKER_ID for each process writing messages"
+    )
+
+
+class IdGenerator:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._last_ms = 0
+        self._sequence = 0
+        self._claim = None  # (pid, worker id, lock file)
+
+    @property
+    def worker_id(self):
+        worker_id = getattr(settings, "CHAT_WORKER_ID", None)
+        if worker_id is not None:
+            if not 0 <= worker_id <= MAX_WORKER_ID:
+                raise ImproperlyConfigured(f"CHAT_WORKER_ID must be 0-{MAX_WORKER_ID}")
+            return worker_id
+        # A forked child shares its parent's lock, so it claims its own
+        if self._claim is None or self._claim[0] != os.getpid():
+            self._claim = (os.getpid(), *claim_worker_id(settings.CHAT_WORKER_LOCK_DIR))
+        return self._claim[1]
+
+    def release(self):
+        """Give up the claimed worker id."""
+        if self._claim is not None:
+            self._claim[2].close()
+            self._claim = None
+
+    def __call__(self):
+        with self._lock:
+            now_ms = int(time.time() * 1000) - EPOCH_MS
+            # Never go backwards, even if the wall clock does
+            if now_ms > self._last_ms:
+                self._last_ms, self._sequence = now_ms, 0
+            elif self._sequence < MAX_SEQUENCE:
+                self._sequence += 1
+            else:
+                # Sequence exhausted for this millisecond: borrow the next one
+                self._last_ms, self._sequence = self._last_ms + 1, 0
+            return (
+                (self._last_ms << (WORKER_BITS + SEQUENCE_BITS))
+                | (self.worker_id << SEQUENCE_BITS)
+                | self._sequence
+            )
+
+
+_generator = IdGenerator()
+
+
+def new_message_id():
+    return _generator()
+
+
+def claim_process_worker_id():
+    """Claim this process' worker id now: a server refuses to start without one."""
+    return _generator.worker_id
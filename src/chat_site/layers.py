@@ -0,0 +1,239 @@
+import asyncio
+import atexit
+import contextlib
+import json
+import os
+import secrets
+import struct
+
+from channels.exceptions import ChannelFull
+from channels.layers import InMemoryChannelLayer
+
+
+class SerializingInMemoryChannelLayer(InMemoryChannelLayer):
+    """
+    InMemoryChannelLayer that round-trips every message through JSON.
+
+    A broker-backed layer only ever delivers bytes, so anything that isn't
+    plain data (model instances, querysets, datetimes) fails here exactly
+    like it would across workers instead of silently working in one process.
+    """
+
+    @staticmethod
+    def serialize(message):
+        return json.dumps(message, separators=(",", ":"))
+
+    @staticmethod
+    def deserialize(data):
+        return json.loads(data)
+
+    async def send(self, channel, message):
+        # group_send delivers through send() as well
+        await super().send(channel, self.deserialize(self.serialize(message)))
+
+
+class UnixSocketChannelLayer(InMemoryChannelLayer):
+    """
+    Channel layer shared by the worker processes of one host, without Redis.
+
+    Every process listens on a Unix socket of its own in the ``path``
+    directory and keeps its channels and group memberships in memory, like
+    ``InMemoryChannelLayer``. Channel names carry the worker that owns them,
+    so ``send`` goes straight to that worker's socket. ``group_send`` goes
+    to every worker in the directory, each delivering it to its own members
+    of the group, so ``group_add`` and ``group_discard`` stay local and cost
+    nothing. A fan-out costs one write per worker, not per channel.
+
+    Messages cross processes as length-prefixed JSON, over one connection
+    per pair of workers (and event loop, for ``async_to_sync`` callers).
+    ``capacity`` bounds each channel's queue, as in memory; a worker that
+    doesn't read its socket fast enough has its messages dropped once
+    ``PEER_BUFFER`` bytes are waiting, and ``send`` raises ``ChannelFull``.
+    A worker that died leaves a socket that refuses connections; the first
+    worker to find it deletes it.
+
+    Only the layer is shared. Presence, rate limits and replay logs stay
+    per process, and the room cache too unless it is ``SharedCache``; what
+    that means for a deployment is listed with ``CHANNEL_LAYERS`` in
+    ``core/settings.py``.
+    """
+
+    PEER_BUFFER = 4 * 1024 * 1024  # bytes waiting for a peer before dropping
+    HEADER = struct.Struct("!I")
+
+    def __init__(self, path, **kwargs):
+        super().__init__(**kwargs)
+        self.path = os.fspath(path)
+        self.worker = f"w{os.getpid()}x{secrets.token_hex(4)}"
+        self.socket_path = os.path.join(self.path, f"{self.worker}.sock")
+        self.loop = None  # the loop this worker receives on
+        self.server = None
+        self.listening = None
+        self.peers = {}  # worker -> socket path
+        self.peers_mtime = None
+        self.connections = {}  # (loop, worker) -> future of a StreamWriter
+        self.serving = {}  # task reading a peer -> its StreamWriter
+
+    # Addressing
+
+    async def new_channel(self, prefix="specific."):
+        await self.listen()
+        return f"{prefix}{self.worker}!{secrets.token_hex(6)}"
+
+    @staticmethod
+    def owner(channel):
+        """The worker that owns a specific channel, None for other channels."""
+        name, bang, _ = channel.partition("!")
+        return name.rpartition(".")[2] if bang else None
+
+    def find_peers(self):
+        """The other workers' sockets, rescanned when the directory changes."""
+        mtime = os.stat(self.path).st_mtime_ns
+        if mtime != self.peers_mtime:
+            self.peers_mtime = mtime
+            self.peers = {
+                name.removesuffix(".sock"): os.path.join(self.path, name)
+                for name in os.listdir(self.path)
+                if name.endswith(".sock") and name != f"{self.worker}.sock"
+            }
+        return self.peers
+
+    # Channel layer API
+
+    async def send(self, channel, message):
+        assert isinstance(message, dict), "message is not a dict"
+        assert self.valid_channel_name(channel), "Channel name not valid"
+        owner = self.owner(channel)
+        if owner is None or owner == self.worker:
+            return await self.deliver(super().send, channel, message)
+        if not await self.forward(owner, ["send", channel, message]):
+            raise ChannelFull(channel)
+
+    async def receive(self, channel):
+        await self.listen()
+        return await super().receive(channel)
+
+    async def group_send(self, group, message):
+        assert isinstance(message, dict), "Message is not a dict"
+        assert self.valid_group_name(group), "Invalid group name"
+        frame = self.encode(["group", group, message])
+        await asyncio.gather(
+            *(self.forward(worker, frame) for worker in list(self.find_peers()))
+        )
+        await self.deliver(super().group_send, group, message)
+
+    async def close(self):
+        for connection in list(self.connections.values()):
+            if connection.done() and not self.broken(connection):
+                connection.result().close()
+        self.connections.clear()
+        if self.server is not None:
+            self.server.close()
+            self.server = None
+            self.listening = None
+            self.remove_socket()
+        for writer in self.serving.values():
+            writer.close()
+        await asyncio.gather(*self.serving, return_exceptions=True)
+
+    # Local delivery
+
+    async def deliver(self, method, target, message):
+        """
+        Run ``method`` of the in-memory layer on the loop this worker
+        receives on, which ``async_to_sync`` callers aren't.
+        """
+        loop = asyncio.get_running_loop()
+        if self.loop is None or self.loop is loop or self.loop.is_closed():
+            return await method(target, message)
+        future = asyncio.run_coroutine_threadsafe(method(target, message), self.loop)
+        await asyncio.wrap_future(future)
+
+    async def listen(self):
+        if self.loop is not None and self.loop.is_closed():
+            # The loop it received on ended (asyncio.run, a test): start over
+            with contextlib.suppress(RuntimeError):
+                self.server.close()
+            self.server = self.listening = None
+            self.remove_socket()
+        if self.listening is None:
+            self.loop = asyncio.get_running_loop()
+            self.listening = self.loop.create_task(self.start_server())
+        await self.listening
+
+    async def start_server(self):
+        os.makedirs(self.path, exist_ok=True)
+        self.server = await asyncio.start_unix_server(self.serve_peer, path=self.socket_path)
+        atexit.register(self.remove_socket)
+
+    def remove_socket(self):
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(self.socket_path)
+
+    async def serve_peer(self, reader, writer):
+        task = asyncio.current_task()
+        self.serving[task] = writer
+        try:
+            while True:
+                (size,) = self.HEADER.unpack(await reader.readexactly(self.HEADER.size))
+                kind, target, message = json.loads(await reader.readexactly(size))
+                if kind == "group":
+                    await InMemoryChannelLayer.group_send(self, target, message)
+                else:
+                    with contextlib.suppress(ChannelFull):
+                        await InMemoryChannelLayer.send(self, target, message)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            del self.serving[task]
+            writer.close()
+
+    # Other workers
+
+    def encode(self, frame):
+        data = json.dumps(frame, separators=(",", ":")).encode()
+        return self.HEADER.pack(len(data)) + data
+
+    async def forward(self, worker, frame):
+        """Write ``frame`` to ``worker``; False if it was dropped."""
+        if not isinstance(frame, bytes):
+            frame = self.encode(frame)
+        writer = await self.connect(worker)
+        if writer is None:
+            return False
+        if writer.transport.get_write_buffer_size() > self.PEER_BUFFER:
+            return False
+        writer.write(frame)
+        if asyncio.get_running_loop() is not self.loop:
+            await writer.drain()  # an async_to_sync loop may be closed next
+        return True
+
+    async def connect(self, worker):
+        loop = asyncio.get_running_loop()
+        connection = self.connections.get((loop, worker))
+        if connection is None:
+            # Forget the connections of the loops async_to_sync closed
+            for key in [key for key in self.connections if key[0].is_closed()]:
+                del self.connections[key]
+        if connection is None or (connection.done() and self.broken(connection)):
+            connection = asyncio.ensure_future(self.open(worker))
+            self.connections[loop, worker] = connection
+        return await connection
+
+    @staticmethod
+    def broken(connection):
+        writer = connection.result()
+        return writer is None or writer.is_closing()
+
+    async def open(self, worker):
+        path = os.path.join(self.path, f"{worker}.sock")
+        try:
+            _, writer = await asyncio.open_unix_connection(path)
+        except ConnectionRefusedError:
+            # Left behind by a worker that died
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(path)
+            return None
+        except OSError:
+            return None
+        return writer
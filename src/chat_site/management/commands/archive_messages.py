@@ -0,0 +1,50 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from chat_site.archive import archive_messages
+from chat_site.models import ChatGroup
+
+
+class Command(BaseCommand):
+    help = (
+        "Move messages older than each room's archive threshold to cold storage. "
+        "Run it from cron, or keep it running with --every."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--room", action="append", dest="rooms", metavar="GROUP_NAME",
+            help="Only archive this room (repeatable).",
+        )
+        parser.add_argument(
+            "--days", type=int, help="Archive messages older than this, for every room."
+        )
+        parser.add_argument(
+            "--every", type=float, metavar="SECONDS",
+            help="Run again every SECONDS instead of exiting.",
+        )
+        parser.add_argument(
+            "--vacuum", action="store_true",
+            help="VACUUM the database afterwards to return freed pages (SQLite).",
+        )
+
+    def handle(self, *args, rooms=None, days=None, every=None, vacuum=False, **options):
+        while True:
+            chat_groups = ChatGroup.objects.all()
+            if rooms:
+                chat_groups = chat_groups.filter(group_name__in=rooms)
+            archived = archive_messages(chat_groups, days=days)
+            for room, count in archived.items():
+                if count:
+                    self.stdout.write(f"{room}: archived {count} messages")
+            self.stdout.write(
+                self.style.SUCCESS(f"Archived {sum(archived.values())} messages")
+            )
+            if vacuum and any(archived.values()) and connection.vendor == "sqlite":
+                with connection.cursor() as cursor:
+                    cursor.execute("VACUUM")
+            if every is None:
+                return
+            time.sleep(every)
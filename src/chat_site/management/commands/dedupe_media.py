@@ -0,0 +1,52 @@
+import os
+
+from django.core.files import File
+from django.core.management.base import BaseCommand
+
+from a_users.models import Profile
+from chat_site.archive import archived_files
+from chat_site.models import ChatGroup, GroupMessage
+from chat_site.storage import content_store
+
+
+class Command(BaseCommand):
+    help = (
+        "Move attachments and avatars saved before the content-addressed store "
+        "into it, deleting the duplicate copies."
+    )
+
+    def handle(self, *args, **options):
+        moved = {}
+        for model, field in ((GroupMessage, "file"), (Profile, "image")):
+            legacy = (
+                model.objects.exclude(**{f"{field}__isnull": True})
+                .exclude(**{field: ""})
+                .exclude(**{f"{field}__startswith": "blobs/"})
+            )
+            for pk, name in legacy.values_list("pk", field).iterator():
+                if name not in moved:
+                    if not content_store.exists(name):
+                        self.stderr.write(f"{name} is missing, skipped")
+                        continue
+                    with content_store.open(name) as f:
+                        moved[name] = content_store.save(name, File(f, name))
+                else:
+                    content_store.add_reference(moved[name])
+                changes = {field: moved[name]}
+                if model is GroupMessage:
+                    changes["file_name"] = os.path.basename(name)
+                # An update, so django_cleanup doesn't delete the old file yet
+                model.objects.filter(pk=pk).update(**changes)
+
+        # Archived messages still link to their old files
+        kept = set()
+        for group_id in ChatGroup.objects.values_list("pk", flat=True):
+            kept.update(archived_files(group_id))
+        for name in moved.keys() - kept:
+            content_store.delete(name)
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Moved {len(moved)} files into the store, kept {len(moved.keys() & kept)} "
+                "that archived messages link to"
+            )
+        )
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+
+from chat_site import thumbnails
+from chat_site.models import GroupMessage
+
+
+class Command(BaseCommand):
+    help = "Make the sized variants of image attachments that have none yet."
+
+    def handle(self, *args, **options):
+        messages = (
+            GroupMessage.objects.select_related("group")
+            .exclude(file__isnull=True)
+            .exclude(file="")
+            .filter(mime_type="")
+        )
+        made = 0
+        for message in messages.iterator():
+            if message.filename.lower().endswith(thumbnails.RASTER_EXTENSIONS):
+                thumbnails.submit(message)
+                made += 1
+        if thumbnails._pool is not None:
+            thumbnails._pool.shutdown()
+        self.stdout.write(self.style.SUCCESS(f"Made the variants of {made} images"))
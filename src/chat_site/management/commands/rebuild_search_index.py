@@ -0,0 +1,16 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from chat_site import search
+
+
+class Command(BaseCommand):
+    help = "Reindex every message for search from scratch and compact the index."
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        search.rebuild()
+        self.stdout.write(
+            self.style.SUCCESS(f"Rebuilt the search index in {time.perf_counter() - started:.1f}s")
+        )
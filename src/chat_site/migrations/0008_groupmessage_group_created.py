@@ -0,0 +1,19 @@
+# Generated by Django 5.1.7 on 2026-10-18 19:25
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat_site', '0007_groupmessage_file_alter_chatgroup_group_name_and_more'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='groupmessage',
+            index=models.Index(fields=['group', 'created', 'id'], name='groupmessage_group_created'),
+        ),
+    ]
@@ -0,0 +1,48 @@
+# Generated by Django 5.1.7 on 2026-10-18 19:31
+
+from django.db import migrations, models
+
+
+def backfill_private_keys(apps, schema_editor):
+    """
+    Key every existing private chat by its member pair. When a pair already
+    has duplicate rooms, the oldest one gets the key; the others keep working
+    through their links but are no longer returned by the lookup.
+    """
+    ChatGroup = apps.get_model("chat_site", "ChatGroup")
+    Members = ChatGroup.members.through
+
+    members = {}
+    for group_id, user_id in (
+        Members.objects.filter(chatgroup__is_private=True)
+        .order_by("chatgroup_id", "user_id")
+        .values_list("chatgroup_id", "user_id")
+    ):
+        members.setdefault(group_id, []).append(user_id)
+
+    keyed = {}
+    for group_id, user_ids in sorted(members.items()):
+        if len(user_ids) != 2:
+            continue
+        keyed.setdefault(":".join(map(str, user_ids)), group_id)
+
+    groups = ChatGroup.objects.in_bulk(keyed.values())
+    for key, group_id in keyed.items():
+        groups[group_id].private_key = key
+    ChatGroup.objects.bulk_update(groups.values(), ["private_key"], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat_site', '0008_groupmessage_group_created'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatgroup',
+            name='private_key',
+            field=models.CharField(blank=True, editable=False, max_length=64, null=True, unique=True),
+        ),
+        migrations.RunPython(backfill_private_keys, migrations.RunPython.noop),
+    ]
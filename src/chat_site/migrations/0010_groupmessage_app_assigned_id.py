@@ -0,0 +1,25 @@
+# Generated by Django 5.1.7 on 2026-10-18 19:32
+
+import chat_site.ids
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat_site', '0009_chatgroup_private_key'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='groupmessage',
+            name='created',
+            field=models.DateTimeField(default=django.utils.timezone.now, editable=False),
+        ),
+        migrations.AlterField(
+            model_name='groupmessage',
+            name='id',
+            field=models.BigIntegerField(default=chat_site.ids.new_message_id, editable=False, primary_key=True, serialize=False),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.7 on 2026-10-18 19:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat_site', '0010_groupmessage_app_assigned_id'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatgroup',
+            name='archive_after_days',
+            field=models.PositiveIntegerField(blank=True, help_text='Defaults to CHAT_ARCHIVE_AFTER_DAYS.', null=True),
+        ),
+    ]
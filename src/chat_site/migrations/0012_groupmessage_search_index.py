@@ -0,0 +1,53 @@
+from django.db import migrations
+
+# Maintained by triggers, see chat_site/search.py
+CREATE_INDEX = [
+    """
+    CREATE VIRTUAL TABLE chat_site_groupmessage_fts USING fts5(
+        body, group_id,
+        content='chat_site_groupmessage', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2',
+        prefix='2 3'
+    )
+    """,
+    # Rank on the body only: group_id is there for filtering
+    """
+    INSERT INTO chat_site_groupmessage_fts(chat_site_groupmessage_fts, rank)
+    VALUES ('rank', 'bm25(1.0, 0.0)')
+    """,
+    """
+    INSERT INTO chat_site_groupmessage_fts(chat_site_groupmessage_fts)
+    VALUES ('rebuild')
+    """,
+]
+
+DROP_INDEX = [
+    "DROP TRIGGER IF EXISTS chat_site_groupmessage_fts_insert",
+    "DROP TRIGGER IF EXISTS chat_site_groupmessage_fts_delete",
+    "DROP TRIGGER IF EXISTS chat_site_groupmessage_fts_update",
+    "DROP TABLE chat_site_groupmessage_fts",
+]
+
+
+def create_index(apps, schema_editor):
+    # FTS5 is SQLite's; search is unavailable on other databases
+    if schema_editor.connection.vendor == "sqlite":
+        for statement in CREATE_INDEX:
+            schema_editor.execute(statement)
+
+
+def drop_index(apps, schema_editor):
+    if schema_editor.connection.vendor == "sqlite":
+        for statement in DROP_INDEX:
+            schema_editor.execute(statement)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("chat_site", "0011_chatgroup_archive_after_days"),
+    ]
+
+    operations = [
+        migrations.RunPython(create_index, drop_index),
+    ]
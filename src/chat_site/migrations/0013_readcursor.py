@@ -0,0 +1,64 @@
+# Generated by Django 5.1.7 on 2026-10-18 20:04
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def create_read_cursors(apps, schema_editor):
+    """Start every existing member's cursor at their chat's newest message."""
+    ChatGroup = apps.get_model("chat_site", "ChatGroup")
+    GroupMessage = apps.get_model("chat_site", "GroupMessage")
+    ReadCursor = apps.get_model("chat_site", "ReadCursor")
+
+    latest = dict(
+        GroupMessage.objects.values("group")
+        .annotate(latest=models.Max("id"))
+        .values_list("group", "latest")
+    )
+    ReadCursor.objects.bulk_create(
+        [
+            ReadCursor(member_id=user_id, group_id=group_id, last_read_id=latest.get(group_id, 0))
+            for group_id, user_id in ChatGroup.members.through.objects.values_list(
+                "chatgroup_id", "user_id"
+            )
+        ],
+        batch_size=500,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat_site', '0012_groupmessage_search_index'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReadCursor',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_read_id', models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='groupmessage',
+            index=models.Index(fields=['group', 'id'], name='groupmessage_group_id'),
+        ),
+        migrations.AddField(
+            model_name='readcursor',
+            name='group',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='read_cursors', to='chat_site.chatgroup'),
+        ),
+        migrations.AddField(
+            model_name='readcursor',
+            name='member',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='read_cursors', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddConstraint(
+            model_name='readcursor',
+            constraint=models.UniqueConstraint(fields=('member', 'group'), name='readcursor_member_group'),
+        ),
+        migrations.RunPython(create_read_cursors, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 5.1.7 on 2026-10-18 20:11
+
+import chat_site.storage
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat_site', '0014_chunkedupload'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Blob',
+            fields=[
+                ('name', models.CharField(max_length=100, primary_key=True, serialize=False)),
+                ('size', models.PositiveBigIntegerField()),
+                ('references', models.PositiveIntegerField(default=0)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='groupmessage',
+            name='file_name',
+            field=models.CharField(blank=True, default='', max_length=255),
+        ),
+        migrations.AlterField(
+            model_name='groupmessage',
+            name='file',
+            field=models.FileField(blank=True, null=True, storage=chat_site.storage.ContentAddressedStorage(), upload_to='files/'),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.1.7 on 2026-10-18 20:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat_site', '0015_blob_groupmessage_file_name_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='groupmessage',
+            name='image_height',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='groupmessage',
+            name='image_width',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='groupmessage',
+            name='mime_type',
+            field=models.CharField(blank=True, default='', max_length=100),
+        ),
+        migrations.AddField(
+            model_name='groupmessage',
+            name='variants',
+            field=models.JSONField(blank=True, default=list),
+        ),
+    ]
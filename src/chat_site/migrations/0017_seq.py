@@ -0,0 +1,45 @@
+# Generated by Django 5.1.7 on 2026-10-18 20:22
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+def number_messages(apps, schema_editor):
+    """Number each chat's existing messages in the order they were sent."""
+    ChatGroup = apps.get_model("chat_site", "ChatGroup")
+    GroupMessage = apps.get_model("chat_site", "GroupMessage")
+
+    for group_id in ChatGroup.objects.values_list("id", flat=True).iterator():
+        messages = list(
+            GroupMessage.objects.filter(group_id=group_id).order_by("created", "id").only("id")
+        )
+        for seq, message in enumerate(messages, 1):
+            message.seq = seq
+        GroupMessage.objects.bulk_update(messages, ["seq"], batch_size=500)
+        ChatGroup.objects.filter(id=group_id).update(last_seq=len(messages))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat_site', '0016_groupmessage_image_height_groupmessage_image_width_and_more'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatgroup',
+            name='last_seq',
+            field=models.BigIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='groupmessage',
+            name='seq',
+            field=models.BigIntegerField(blank=True, editable=False, null=True),
+        ),
+        migrations.RunPython(number_messages, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='groupmessage',
+            constraint=models.UniqueConstraint(fields=('group', 'seq'), name='groupmessage_group_seq'),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.1.7 on 2026-10-18 21:18
+
+import chat_site.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat_site', '0018_chatban'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='chatgroup',
+            name='group_name',
+            field=models.CharField(default=chat_site.models.new_group_name, max_length=128, unique=True),
+        ),
+    ]
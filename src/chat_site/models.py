@@ -1,22 +1,99 @@
 import os
+import uuid
+
 import shortuuid
 from django.db import models
 from django.contrib.auth import get_user_model
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from .ids import new_message_id
+from .replay import allocate_seq
+from .storage import content_store
 
 User = get_user_model()
 
 
+def new_group_name():
+    """
+    Default of ``ChatGroup.group_name``. A plain function, unlike the bound
+    ``shortuuid.uuid``, deconstructs to the same path every time, so
+    makemigrations doesn't see a change that isn't there.
+    """
+    return shortuuid.uuid()
+
+
+class ChatGroupQuerySet(models.QuerySet):
+    def with_members(self):
+        """Prefetch members and their profiles, as the member lists render them."""
+        return self.prefetch_related(
+            models.Prefetch("members", queryset=User.objects.select_related("profile"))
+        )
+
+    def with_unread_counts(self, user):
+        """
+        Annotate ``last_read_id`` and ``unread_count`` from ``user``'s read
+        cursors, in the same query (see ``chat_site.unread``).
+        """
+        cursors = ReadCursor.objects.filter(member=user)
+        unread = (
+            GroupMessage.objects.filter(
+                group=models.OuterRef("pk"),
+                id__gt=models.Subquery(
+                    cursors.filter(group=models.OuterRef(models.OuterRef("pk")))
+                    .values("last_read_id")[:1]
+                ),
+            )
+            .order_by()
+            .values("group")
+            .annotate(count=models.Count("*"))
+            .values("count")
+        )
+        return self.annotate(
+            last_read_id=models.Subquery(
+                cursors.filter(group=models.OuterRef("pk")).values("last_read_id")[:1]
+            ),
+            unread_count=Coalesce(models.Subquery(unread), 0),
+        )
+
+
+class GroupMessageQuerySet(models.QuerySet):
+    def with_authors(self):
+        """Join authors and their profiles, as chat_message.html renders them."""
+        return self.select_related("author__profile")
+
+
 class ChatGroup(models.Model):
-    group_name = models.CharField(max_length=128, unique=True, default=shortuuid.uuid)
+    group_name = models.CharField(max_length=128, unique=True, default=new_group_name)
     groupchat_name = models.CharField(max_length=128, null=True, blank=True)
     admin = models.ForeignKey(
         User, related_name="groupchats", blank=True, null=True, on_delete=models.CASCADE
     )
+    # Snapshot of chat_site.presence for the admin, not read by the app
     users_online = models.ManyToManyField(
         User, related_name="online_in_groups", blank=True
     )
     members = models.ManyToManyField(User, related_name="chat_groups", blank=True)
     is_private = models.BooleanField(default=False)
+    # "<lower user id>:<higher user id>" of a private chat's two members
+    private_key = models.CharField(
+        max_length=64, unique=True, null=True, blank=True, editable=False
+    )
+
+    # Messages older than this move to cold storage (chat_site/archive.py)
+    archive_after_days = models.PositiveIntegerField(
+        null=True, blank=True, help_text="Defaults to CHAT_ARCHIVE_AFTER_DAYS."
+    )
+
+    # Number of the room's newest message (chat_site/replay.py)
+    last_seq = models.BigIntegerField(default=0, editable=False)
+
+    objects = ChatGroupQuerySet.as_manager()
+
+    @staticmethod
+    def private_key_for(*users):
+        """Canonical key of the private chat between ``users``, in any order."""
+        return ":".join(str(user_id) for user_id in sorted(user.pk for user in users))
 
     @property
     def members_count(self):
@@ -24,33 +101,75 @@ class ChatGroup(models.Model):
 
     @property
     def online_count(self):
-        return self.users_online.count()
+        from .presence import presence
+
+        return presence.online_count(self.group_name)
 
     def __str__(self):
         return self.group_name
 
 
 class GroupMessage(models.Model):
+    # Assigned by the app so a message has an id before it is written
+    id = models.BigIntegerField(primary_key=True, default=new_message_id, editable=False)
     group = models.ForeignKey(
         ChatGroup, related_name="chat_messages", on_delete=models.CASCADE
     )
     author = models.ForeignKey(User, on_delete=models.CASCADE)
     body = models.CharField(max_length=300, blank=True, null=True)
-    file = models.FileField(upload_to="files/", blank=True, null=True)
-    created = models.DateTimeField(auto_now_add=True)
+    file = models.FileField(upload_to="files/", storage=content_store, blank=True, null=True)
+    # The uploaded name: stored files are named after their content
+    file_name = models.CharField(max_length=255, blank=True, default="")
+    # Set by chat_site.thumbnails once an image's variants are made
+    image_width = models.PositiveIntegerField(null=True, blank=True)
+    image_height = models.PositiveIntegerField(null=True, blank=True)
+    mime_type = models.CharField(max_length=100, blank=True, default="")
+    variants = models.JSONField(default=list, blank=True)  # [[width, height, name], ...]
+    created = models.DateTimeField(default=timezone.now, editable=False)
+    # Position in the room's sequence, taken as the message is saved
+    seq = models.BigIntegerField(null=True, blank=True, editable=False)
+
+    objects = GroupMessageQuerySet.as_manager()
 
     class Meta:
         ordering = ["-created"]
+        indexes = [
+            # Keyset pagination of a room's history on (created, id)
+            models.Index(
+                fields=["group", "created", "id"], name="groupmessage_group_created"
+            ),
+            # Unread counts: messages after a read cursor (ids are time-ordered)
+            models.Index(fields=["group", "id"], name="groupmessage_group_id"),
+        ]
+        constraints = [
+            # Also the index replaying a room from a sequence number
+            models.UniqueConstraint(fields=["group", "seq"], name="groupmessage_group_seq"),
+        ]
 
     def __str__(self):
         return f"{self.author.username} :{self.body if self.body else self.filename}"
 
+    def save(self, *args, **kwargs):
+        if self.seq is None and self._state.adding:
+            self.seq = allocate_seq(self.group_id)
+        super().save(*args, **kwargs)
+
     @property
     def filename(self):
         if self.file:
-            return os.path.basename(self.file.name)
+            return self.file_name or os.path.basename(self.file.name)
         return None
 
+    @property
+    def srcset(self):
+        """The image's variants and original for ``<img srcset>``, "" if there are none."""
+        if not self.variants:
+            return ""
+        storage = self.file.storage
+        candidates = [f"{storage.url(name)} {width}w" for width, _, name in self.variants]
+        candidates.append(f"{self.file.url} {self.image_width}w")
+        return ", ".join(candidates)
+
     @property
     def is_image(self):
         if self.filename.lower().endswith(
@@ -60,6 +179,92 @@ class GroupMessage(models.Model):
         return False
 
 
+class Blob(models.Model):
+    """A stored file and how many fields reference it (see ``chat_site.storage``)."""
+
+    name = models.CharField(max_length=100, primary_key=True)
+    size = models.PositiveBigIntegerField()
+    references = models.PositiveIntegerField(default=0)
+
+    def __str__(self):
+        return f"{self.name} ({self.references})"
+
+
+class ChunkedUpload(models.Model):
+    """An attachment being uploaded in chunks (see ``chat_site.uploads``)."""
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    group = models.ForeignKey(ChatGroup, related_name="uploads", on_delete=models.CASCADE)
+    author = models.ForeignKey(User, on_delete=models.CASCADE)
+    filename = models.CharField(max_length=255)
+    size = models.PositiveBigIntegerField()
+    offset = models.PositiveBigIntegerField(default=0)
+    created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.filename} ({self.offset}/{self.size})"
+
+
+class ReadCursor(models.Model):
+    """The newest message a member has seen in a chat (see ``chat_site.unread``)."""
+
+    member = models.ForeignKey(User, related_name="read_cursors", on_delete=models.CASCADE)
+    group = models.ForeignKey(
+        ChatGroup, related_name="read_cursors", on_delete=models.CASCADE
+    )
+    last_read_id = models.BigIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["member", "group"], name="readcursor_member_group"
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.member} in {self.group}: {self.last_read_id}"
+
+
+class ChatBan(models.Model):
+    """A user banned from a group chat (see ``chat_site.moderation``)."""
+
+    member = models.ForeignKey(User, related_name="chat_bans", on_delete=models.CASCADE)
+    group = models.ForeignKey(ChatGroup, related_name="bans", on_delete=models.CASCADE)
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["group", "member"], name="chatban_group_member"),
+        ]
+
+    def __str__(self):
+        return f"{self.member} banned from {self.group}"
+
+
+class WorkerPresence(models.Model):
+    """
+    Who one worker process sees online in a room. ``users_online`` is the
+    union of every worker's rows (see ``chat_site.presence``).
+    """
+
+    worker = models.PositiveSmallIntegerField()
+    group = models.ForeignKey(
+        ChatGroup, related_name="worker_presence", on_delete=models.CASCADE
+    )
+    user = models.ForeignKey(User, related_name="+", on_delete=models.CASCADE)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["worker", "group", "user"], name="workerpresence_worker_group_user"
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.user} in {self.group} (worker {self.worker})"
+
+
 class UserChannel(models.Model):
     member = models.ForeignKey(User, on_delete=models.CASCADE)
     group = models.ForeignKey(
@@ -0,0 +1,59 @@
+"""
+Removing and banning group chat members in bulk.
+
+``remove_members`` takes any number of members out of a room with a fixed
+number of queries: one ``DELETE`` of the memberships, one of their
+``UserChannel`` rows and, to ban them, one insert. Their sockets are closed
+by a single ``removed_handler`` event sent to the room's group once the
+change commits. The event reaches every worker the room's sockets are on,
+and each socket checks whether its own user is in the list. The same event
+covers one member or hundreds.
+
+Banned users are kept out by ``cache.banned_ids``. ``chat_view`` won't add
+them back as members, and sockets of non-members are refused on connect.
+"""
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.db import transaction
+
+from . import cache
+from .events import removed_event
+from .models import ChatBan, UserChannel
+
+# Not one the htmx ws extension reconnects on
+REMOVED_CLOSE_CODE = 4403
+
+
+def remove_members(chat_group, user_ids, ban=False):
+    """
+    Remove the users ``user_ids`` from ``chat_group``, banning them if
+    ``ban``, and close their sockets in the room. The admin is never
+    removed. Returns the ids acted on.
+    """
+    user_ids = set(user_ids) - {chat_group.admin_id}
+    if not user_ids:
+        return user_ids
+    with transaction.atomic():
+        chat_group.members.remove(*user_ids)
+        UserChannel.objects.filter(group=chat_group, member_id__in=user_ids).delete()
+        if ban:
+            ChatBan.objects.bulk_create(
+                [ChatBan(group=chat_group, member_id=user_id) for user_id in user_ids],
+                ignore_conflicts=True,
+            )
+            cache.forget_bans(chat_group.pk)  # bulk_create sends no signals
+
+        event = removed_event(chat_group.group_name, user_ids)
+        transaction.on_commit(
+            lambda: async_to_sync(get_channel_layer().group_send)(
+                chat_group.group_name, event
+            )
+        )
+    return user_ids
+
+
+def unban_members(chat_group, user_ids):
+    """Let the users ``user_ids`` join ``chat_group`` again."""
+    ChatBan.objects.filter(group=chat_group, member_id__in=user_ids).delete()
+    cache.forget_bans(chat_group.pk)
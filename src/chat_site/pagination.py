@@ -0,0 +1,95 @@
+"""
+Keyset pagination of a room's history.
+
+A cursor points at the oldest message already on screen as
+``"<created, in microseconds since the epoch>.<id>"``; the next page is the
+``PAGE_SIZE`` messages strictly before it on ``(created, id)``. Every page
+is a bounded range scan of the ``groupmessage_group_created`` index, however
+long the room's history is. Past the oldest message in the table, pages
+continue from the room's cold storage (see ``archive``).
+"""
+
+from datetime import datetime, timedelta, timezone
+
+from django.db.models import Q
+
+PAGE_SIZE = 40
+MAX_ID = (1 << 63) - 1  # a 64-bit integer column's range
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+MICROSECOND = timedelta(microseconds=1)
+
+
+def to_micros(created):
+    return (created - EPOCH) // MICROSECOND
+
+
+def from_micros(micros):
+    return EPOCH + micros * MICROSECOND
+
+
+def message_key(message):
+    """``(created in microseconds, id)``, the order history is paginated in."""
+    return to_micros(message.created), message.id
+
+
+def encode_key(key):
+    return f"{key[0]}.{key[1]}"
+
+
+def decode_key(cursor):
+    """Inverse of ``encode_key``, raising ValueError if the cursor is malformed."""
+    micros, _, message_id = cursor.partition(".")
+    return int(micros), int(message_id)
+
+
+def encode_cursor(message):
+    return encode_key(message_key(message))
+
+
+def decode_cursor(cursor):
+    """Return ``(created, id)`` for a cursor, raising ValueError if it's malformed."""
+    micros, message_id = decode_key(cursor)
+    try:
+        created = from_micros(micros)
+    except OverflowError:
+        raise ValueError(f"Cursor out of range: {cursor}") from None
+    if not -MAX_ID <= message_id <= MAX_ID:
+        raise ValueError(f"Cursor out of range: {cursor}")
+    return created, message_id
+
+
+def messages_before(chat_group, cursor=None, limit=PAGE_SIZE):
+    """
+    Return a page of messages, oldest first, and the cursor of the page before it.
+
+    Without a cursor the newest page is returned. The returned cursor is None
+    when there are no older messages.
+    """
+    messages = chat_group.chat_messages.with_authors().order_by("-created", "-id")
+    if cursor:
+        created, message_id = decode_cursor(cursor)
+        messages = messages.filter(
+            Q(created__lt=created) | Q(created=created, id__lt=message_id)
+        )
+
+    # One extra row tells whether an older page exists
+    page = list(messages[: limit + 1])
+    if len(page) <= limit:
+        # The table ran out: older messages, if any, are archived. A message
+        # stored late can sit among them, so both are merged, and rows an
+        # interrupted archive run left behind are only shown once
+        from .archive import archived_before
+
+        before = decode_key(cursor) if cursor else None
+        ids = {message.id for message in page}
+        page += [
+            message
+            for message in archived_before(chat_group, before, limit + 1)
+            if message.id not in ids
+        ]
+        page.sort(key=message_key, reverse=True)
+    has_older = len(page) > limit
+    page = page[:limit]
+    page.reverse()
+    return page, encode_cursor(page[0]) if has_older else None
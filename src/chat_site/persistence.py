@@ -0,0 +1,124 @@
+"""
+How chat messages reach the database.
+
+``CHAT_MESSAGE_PERSISTENCE = "sync"`` (the default) inserts each message
+before it is broadcast: once a client sees a message, it is stored.
+
+``"write_behind"`` broadcasts first and hands the message to
+``message_writer``, a bounded queue drained by one writer task that inserts
+messages with ``bulk_create`` in group commits of up to
+``CHAT_WRITE_BEHIND_BATCH_SIZE`` rows, at least every
+``CHAT_WRITE_BEHIND_INTERVAL`` seconds. The queue holds at most
+``CHAT_WRITE_BEHIND_QUEUE_SIZE`` messages; when it is full, senders wait,
+which pushes back on the sockets producing the burst.
+
+Durability in write-behind mode:
+
+* a message can be seen by clients before it is stored;
+* on a clean shutdown the queue is drained to the database at exit;
+* on a crash (SIGKILL, power loss) the queued messages and the batch being
+  written are lost, i.e. at most ``CHAT_WRITE_BEHIND_QUEUE_SIZE`` messages
+  or about ``CHAT_WRITE_BEHIND_INTERVAL`` seconds of traffic.
+"""
+
+import asyncio
+import atexit
+import logging
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+
+from .replay import allocate_seq
+
+logger = logging.getLogger(__name__)
+
+
+class MessageWriter:
+    def __init__(self):
+        self._queue = None
+        self._task = None
+        self._in_flight = []  # batch handed to the database, not yet committed
+        atexit.register(self.drain)
+
+    def _ensure_running(self):
+        loop = asyncio.get_running_loop()
+        if self._task is None or self._task.done() or self._task.get_loop() is not loop:
+            # Carry messages queued on a previous loop over to this one
+            pending = self._take_pending()
+            self._queue = asyncio.Queue(maxsize=settings.CHAT_WRITE_BEHIND_QUEUE_SIZE)
+            for message in pending:
+                self._queue.put_nowait(message)
+            self._task = loop.create_task(self._run())
+
+    async def save(self, message):
+        """Queue ``message``; waits while the queue is full."""
+        self._ensure_running()
+        await self._queue.put(message)
+
+    async def _run(self):
+        batch_size = settings.CHAT_WRITE_BEHIND_BATCH_SIZE
+        interval = settings.CHAT_WRITE_BEHIND_INTERVAL
+        while True:
+            batch = [await self._queue.get()]
+            # Group commit: gather what arrives within the interval
+            deadline = asyncio.get_running_loop().time() + interval
+            while len(batch) < batch_size:
+                timeout = deadline - asyncio.get_running_loop().time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            self._in_flight = batch
+            await database_sync_to_async(write_messages)(batch)
+            self._in_flight = []
+            for _ in batch:
+                self._queue.task_done()
+
+    async def flush(self):
+        """Wait until everything queued so far is in the database."""
+        if self._queue is not None:
+            await self._queue.join()
+
+    def _take_pending(self):
+        pending, self._in_flight = self._in_flight, []
+        while self._queue is not None and not self._queue.empty():
+            pending.append(self._queue.get_nowait())
+            self._queue.task_done()
+        return pending
+
+    def drain(self):
+        """Synchronously write whatever is still queued (run at exit)."""
+        pending = self._take_pending()
+        if pending:
+            write_messages(pending)
+
+
+def write_messages(messages):
+    from .models import GroupMessage
+
+    try:
+        GroupMessage.objects.bulk_create(messages)
+    except Exception:
+        # Don't let one bad row sink the whole batch
+        logger.exception("Batch insert of %d messages failed, retrying one by one", len(messages))
+        for message in messages:
+            try:
+                message.save(force_insert=True)
+            except Exception:
+                logger.exception("Dropping message %s", message.pk)
+
+
+message_writer = MessageWriter()
+
+
+async def save_message(message):
+    """Persist a new ``GroupMessage`` according to ``CHAT_MESSAGE_PERSISTENCE``."""
+    if settings.CHAT_MESSAGE_PERSISTENCE == "write_behind":
+        if message.seq is None:
+            # Numbered now: the message is broadcast before it is written
+            message.seq = await database_sync_to_async(allocate_seq)(message.group_id)
+        await message_writer.save(message)
+    else:
+        await message.asave(force_insert=True)
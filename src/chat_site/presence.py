@@ -0,0 +1,261 @@
+"""
+In-memory presence registry.
+
+Who is online in which room is tracked per connection (channel name), so a
+user with several tabs open stays online until the last one closes. Each
+connection must be refreshed by a heartbeat within ``CHAT_PRESENCE_TTL``
+seconds or it is dropped, which cleans up after consumers that died without
+running ``disconnect``.
+
+Changes are broadcast in batches: rooms that changed during a
+``CHAT_PRESENCE_BATCH_INTERVAL`` window go out as one event each, to the
+``online-status`` sockets of that room's members (see ``events``).
+
+Reads never hit the database. ``ChatGroup.users_online`` is only a snapshot
+for the admin and reporting, written ``CHAT_PRESENCE_FLUSH_INTERVAL``
+seconds after the first change since the last one.
+
+The registry lives in the worker process: with several workers each one
+knows about its own sockets only, so counts, status dots and the "reading
+it right now" check of unread badges only see the local ones. The
+snapshot is the exception: each worker writes its own view of a room to
+``WorkerPresence``, keyed by its worker id (see ``chat_site.ids``), and
+``users_online`` is rebuilt as the union of all of them.
+"""
+
+import asyncio
+import time
+
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import transaction
+
+from .events import online_status_event, room_presence_event, room_status_group
+
+# The room every online-status socket joins; its count is the site online count
+SITE_ROOM = "online-status"
+
+
+class PresenceRegistry:
+    def __init__(self):
+        # room -> user id -> channel name -> heartbeat deadline
+        self._rooms: dict[str, dict[int, dict[str, float]]] = {}
+        self._dirty: set[str] = set()  # not yet written to users_online
+        self._changed: set[str] = set()  # not yet broadcast
+        self.on_change = None  # called once a room is marked, see ``schedule``
+
+    @property
+    def ttl(self):
+        return settings.CHAT_PRESENCE_TTL
+
+    def connect(self, room, user_id, channel):
+        """Register a connection. Returns True if the user just came online."""
+        users = self._rooms.setdefault(room, {})
+        came_online = not self._live_channels(room, user_id)
+        users.setdefault(user_id, {})[channel] = time.monotonic() + self.ttl
+        if came_online:
+            self._mark(room)
+        return came_online
+
+    def disconnect(self, room, user_id, channel):
+        """Drop a connection. Returns True if it was the user's last one."""
+        channels = self._rooms.get(room, {}).get(user_id)
+        if not channels or channels.pop(channel, None) is None:
+            return False
+        if self._live_channels(room, user_id):
+            return False
+        self._mark(room)
+        return True
+
+    def touch(self, room, user_id, channel):
+        """Heartbeat: push the connection's deadline ``ttl`` seconds ahead."""
+        channels = self._rooms.get(room, {}).get(user_id)
+        if channels is not None and channel in channels:
+            channels[channel] = time.monotonic() + self.ttl
+
+    def _live_channels(self, room, user_id):
+        users = self._rooms.get(room)
+        if not users or user_id not in users:
+            return {}
+        now = time.monotonic()
+        channels = users[user_id]
+        for channel, deadline in list(channels.items()):
+            if deadline < now:
+                del channels[channel]
+        if not channels:
+            del users[user_id]
+            self._mark(room)
+        return channels
+
+    def _mark(self, room):
+        self._dirty.add(room)
+        self._changed.add(room)
+        if self.on_change is not None:
+            self.on_change()
+
+    def online_user_ids(self, room):
+        return {
+            user_id
+            for user_id in list(self._rooms.get(room, ()))
+            if self._live_channels(room, user_id)
+        }
+
+    def online_count(self, room):
+        return len(self.online_user_ids(room))
+
+    def peek_online_user_ids(self, room):
+        """
+        ``online_user_ids`` without dropping expired connections, for views
+        reading from another thread than the event loop's.
+        """
+        now = time.monotonic()
+        return {
+            user_id
+            for user_id, channels in list(self._rooms.get(room, {}).items())
+            if any(deadline >= now for deadline in list(channels.values()))
+        }
+
+    def is_online(self, room, user_id):
+        return bool(self._live_channels(room, user_id))
+
+    def take_snapshot(self):
+        """Return ``{room: online user ids}`` for rooms changed since the last flush."""
+        snapshot = {room: self.online_user_ids(room) for room in self._dirty}
+        self._dirty.clear()
+        return snapshot
+
+    def take_changes(self):
+        """Return ``{room: online user ids}`` for rooms changed since the last batch."""
+        changes = {room: self.online_user_ids(room) for room in self._changed}
+        self._changed.clear()
+        return changes
+
+    def flush(self):
+        """Write pending changes to ``ChatGroup.users_online`` (sync, hits the DB)."""
+        write_snapshot(self.take_snapshot())
+
+
+# Worker ids whose rows left behind by an earlier process are cleared
+_cleared_workers = set()
+
+
+def write_snapshot(snapshot, worker_id=None):
+    """
+    Replace this worker's view of every room in ``snapshot``, then rebuild
+    their ``users_online`` from every worker's view.
+
+    A process' first write also drops what an earlier process with the same
+    worker id left behind, in any room.
+    """
+    from .ids import claim_process_worker_id
+    from .models import ChatGroup, WorkerPresence
+
+    if not snapshot:
+        return
+    if worker_id is None:
+        worker_id = claim_process_worker_id()
+    Online = ChatGroup.users_online.through
+    group_ids = dict(
+        ChatGroup.objects.filter(group_name__in=snapshot).values_list("group_name", "id")
+    )
+    views = WorkerPresence.objects.filter(worker=worker_id)
+    with transaction.atomic():
+        rebuilt = set(group_ids.values())
+        if worker_id in _cleared_workers:
+            views.filter(group_id__in=rebuilt).delete()
+        else:
+            rebuilt.update(views.values_list("group_id", flat=True))
+            views.delete()
+        WorkerPresence.objects.bulk_create(
+            [
+                WorkerPresence(worker=worker_id, group_id=group_ids[room], user_id=user_id)
+                for room, user_ids in snapshot.items()
+                if room in group_ids
+                for user_id in user_ids
+            ]
+        )
+        Online.objects.filter(chatgroup_id__in=rebuilt).delete()
+        Online.objects.bulk_create(
+            [
+                Online(chatgroup_id=group_id, user_id=user_id)
+                for group_id, user_id in WorkerPresence.objects.filter(group_id__in=rebuilt)
+                .values_list("group_id", "user_id")
+                .distinct()
+            ]
+        )
+    _cleared_workers.add(worker_id)
+
+
+class PresenceBroadcaster:
+    """
+    Debounces presence changes into periodic batches.
+
+    The first change after a quiet period starts a timer; when it fires,
+    every room that changed in the meantime is broadcast once with its
+    current state, however many sockets came and went.
+    """
+
+    def __init__(self, registry):
+        self.registry = registry
+        self._task = None
+
+    def schedule(self):
+        loop = asyncio.get_running_loop()
+        if self._task is None or self._task.done() or self._task.get_loop() is not loop:
+            self._task = loop.create_task(self._broadcast_later())
+
+    async def _broadcast_later(self):
+        await asyncio.sleep(settings.CHAT_PRESENCE_BATCH_INTERVAL)
+        # Changes arriving while this batch is sent start the next one
+        self._task = None
+        channel_layer = get_channel_layer()
+        for room, user_ids in self.registry.take_changes().items():
+            if room == SITE_ROOM:
+                event = online_status_event(len(user_ids))
+                await channel_layer.group_send(SITE_ROOM, event)
+            else:
+                event = room_presence_event(room, user_ids)
+                await channel_layer.group_send(room_status_group(room), event)
+
+
+class PresenceFlusher:
+    """
+    Writes the ``users_online`` snapshot the same way: the first change
+    after a flush starts a ``CHAT_PRESENCE_FLUSH_INTERVAL`` timer, and the
+    rooms changed by the time it fires are written in one go.
+    """
+
+    def __init__(self, registry):
+        self.registry = registry
+        self._task = None
+
+    def schedule(self):
+        loop = asyncio.get_running_loop()
+        if self._task is None or self._task.done() or self._task.get_loop() is not loop:
+            self._task = loop.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(settings.CHAT_PRESENCE_FLUSH_INTERVAL)
+        self._task = None
+        # Taken on the event loop, which owns the registry
+        await database_sync_to_async(write_snapshot)(self.registry.take_snapshot())
+
+
+def schedule_presence():
+    """
+    Start the broadcast and flush timers of a change, connects, disconnects
+    and expiries alike. Outside the event loop there is nothing to start.
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return
+    presence_broadcaster.schedule()
+    presence_flusher.schedule()
+
+
+presence = PresenceRegistry()
+presence_broadcaster = PresenceBroadcaster(presence)
+presence_flusher = PresenceFlusher(presence)
+presence.on_change = schedule_presence
@@ -0,0 +1,96 @@
+"""
+Token-bucket rate limits on what users send.
+
+Each kind of action (``"message"``, ``"upload"``) has a bucket per user and
+one per room, sized by ``CHAT_RATE_LIMITS[kind]``: ``(tokens per second,
+burst)`` for ``"user"`` and for ``"room"``. An action takes a token from
+both of its buckets, and is refused if either is empty, so one user can't
+flood a room and a crowd can't flood it together either. A refused action
+costs no token.
+
+Buckets refill lazily when they are used, so idle ones cost nothing and
+are forgotten after ``IDLE_AFTER`` seconds. Limits are counted per process,
+like presence: behind N workers a user or room gets up to N times its
+limit, less when their sockets share a worker.
+"""
+
+import threading
+import time
+
+from django.conf import settings
+
+IDLE_AFTER = 600  # seconds before an unused bucket is forgotten
+
+
+class TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self):
+        """Seconds until a token is available."""
+        if not self.rate:
+            return IDLE_AFTER  # forgotten, and so full again, after that
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+
+class RateLimiter:
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.buckets = {}
+        self.lock = threading.Lock()  # views take tokens from worker threads
+        self.swept = clock()
+
+    def bucket(self, kind, scope, key, now):
+        bucket = self.buckets.get((kind, scope, key))
+        if bucket is None:
+            rate, burst = settings.CHAT_RATE_LIMITS[kind][scope]
+            bucket = self.buckets[kind, scope, key] = TokenBucket(rate, burst, now)
+        else:
+            bucket.refill(now)
+        return bucket
+
+    def take(self, kind, user_id, room):
+        """
+        Take a token for ``user_id`` doing ``kind`` in ``room``.
+
+        Returns 0 if allowed, otherwise the seconds to wait before retrying.
+        """
+        with self.lock:
+            now = self.clock()
+            if now - self.swept > IDLE_AFTER:
+                self.sweep(now)
+            buckets = [
+                self.bucket(kind, "user", user_id, now),
+                self.bucket(kind, "room", room, now),
+            ]
+            empty = [bucket for bucket in buckets if bucket.tokens < 1]
+            if empty:
+                return max(bucket.wait_time() for bucket in empty)
+            for bucket in buckets:
+                bucket.tokens -= 1
+            return 0
+
+    def sweep(self, now):
+        # A bucket idle this long is full again, the same as a new one
+        self.buckets = {
+            key: bucket
+            for key, bucket in self.buckets.items()
+            if now - bucket.updated < IDLE_AFTER
+        }
+        self.swept = now
+
+    def clear(self):
+        with self.lock:
+            self.buckets.clear()
+
+
+rate_limiter = RateLimiter()
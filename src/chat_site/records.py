@@ -0,0 +1,66 @@
+"""
+The structured wire protocol of chatroom sockets.
+
+By default a chatroom socket receives every message as an HTML fragment
+for htmx to swap in. A client offering the ``SUBPROTOCOL`` websocket
+subprotocol receives messages and attachment updates as compact JSON
+records instead, rendered by ``static/js/records.js``:
+
+``{"type": "message", ...}``
+    ``id``, ``seq``, ``author_id``, ``username``, ``name`` and ``avatar``,
+    and either ``body`` or ``file`` (URL) and ``file_name``, with
+    ``image`` set for images and ``width``, ``height`` and ``srcset`` once
+    known. Empty fields are left out.
+``{"type": "attachment", ...}``
+    ``id``, ``width``, ``height`` and ``srcset`` of an image whose variants
+    were just made.
+
+A record is the same for every member, so it is serialized once per
+message, next to the HTML renders, and the author is recognised by the
+client. Presence counts and notices are sent as fragments in both modes.
+``CHAT_WIRE_PROTOCOL`` picks what the chat page offers.
+"""
+
+import json
+
+SUBPROTOCOL = "chat.records.v1"
+
+
+def dumps(record):
+    return json.dumps(
+        {key: value for key, value in record.items() if value not in (None, "", False)},
+        separators=(",", ":"),
+    )
+
+
+def image_fields(message):
+    return {
+        "width": message.image_width,
+        "height": message.image_height,
+        "srcset": message.srcset,
+    }
+
+
+def message_record(message):
+    """The JSON record of a chat message."""
+    profile = message.author.profile
+    record = {
+        "type": "message",
+        "id": message.id,
+        "seq": message.seq,
+        "author_id": message.author_id,
+        "username": message.author.username,
+        "name": profile.name,
+        "avatar": profile.avatar,
+        "body": message.body,
+    }
+    if message.file:
+        record.update(file=message.file.url, file_name=message.filename)
+        if message.is_image:
+            record.update(image=True, **image_fields(message))
+    return dumps(record)
+
+
+def attachment_record(message):
+    """The JSON record updating an image once its variants are made."""
+    return dumps({"type": "attachment", "id": message.id, **image_fields(message)})
@@ -0,0 +1,155 @@
+"""
+Room sequence numbers and resuming a dropped socket.
+
+Every message gets the next number of its room's sequence,
+``ChatGroup.last_seq``, bumped with one ``UPDATE ... RETURNING`` as it is
+saved. The page puts each message's number on its ``<li>`` and the client
+reconnects to ``/ws/chatroom/<room>?last_seq=<newest number shown>``.
+
+On connect the consumer joins the room's group, then reads ``last_seq``:
+anything numbered after that is sent to the group, so it arrives like any
+live message. The messages in between, the ones the client missed, are
+replayed:
+
+- from ``room_logs``, each process' ring buffer of the last
+  ``CHAT_REPLAY_BUFFER`` message events of each room, already rendered, if
+  it holds every number of the gap;
+- otherwise from the database, on the ``(group, seq)`` index. The events
+  rebuilt go into the ring buffer, so the other clients that dropped at
+  the same moment (a network blip, a deploy) are replayed from memory.
+
+A gap of more than ``CHAT_REPLAY_LIMIT`` messages is not worth replaying:
+the client is told to reload the page instead.
+
+An event holds two renders of its message and its record, a few KB for a
+long one, so the buffers of all rooms together are bounded by
+``CHAT_REPLAY_MAX_BYTES`` of rendered text: past it, the oldest events of
+the least recently used rooms go first. Those gaps are replayed from the
+database.
+
+Numbers are allocated before the broadcast and two messages can be
+broadcast in the opposite order; a client that drops in that instant can
+miss the earlier one. With write-behind persistence, a message the ring
+buffer doesn't have and which isn't written yet is missed too.
+"""
+
+import bisect
+import collections
+
+from django.conf import settings
+from django.db import connection
+
+MAX_ROOMS = 1000  # rooms with a ring buffer per process
+
+
+def allocate_seq(group_id):
+    """Take the next number of the room's message sequence."""
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "UPDATE chat_site_chatgroup SET last_seq = last_seq + 1 "
+            "WHERE id = %s RETURNING last_seq",
+            [group_id],
+        )
+        return cursor.fetchone()[0]
+
+
+def event_size(event):
+    """Roughly the bytes an event's rendered text takes."""
+    return sum(len(html) for html in event["html"].values()) + len(event["record"])
+
+
+class RoomLog:
+    """The newest message events of one room, by sequence number."""
+
+    def __init__(self, size, logs=None):
+        self.size = size
+        self.seqs = []
+        self.events = {}
+        self.logs = logs  # the RoomLogs counting its bytes
+
+    def add(self, seq, event):
+        if seq in self.events:
+            return  # every consumer of the room sees each event
+        bisect.insort(self.seqs, seq)
+        self.events[seq] = event
+        self.count_bytes(event, 1)
+        if len(self.seqs) > self.size:
+            self.pop_oldest()
+        if self.logs is not None:
+            self.logs.trim()
+
+    def pop_oldest(self):
+        self.count_bytes(self.events.pop(self.seqs.pop(0)), -1)
+
+    def count_bytes(self, event, sign):
+        if self.logs is not None:
+            self.logs.bytes += sign * event_size(event)
+
+    def between(self, after, up_to):
+        """
+        The events numbered ``after`` + 1 to ``up_to``, or None unless this
+        log holds every one of them.
+        """
+        start = bisect.bisect_right(self.seqs, after)
+        end = bisect.bisect_right(self.seqs, up_to)
+        seqs = self.seqs[start:end]
+        if len(seqs) != up_to - after:
+            return None
+        return [self.events[seq] for seq in seqs]
+
+
+class RoomLogs:
+    def __init__(self):
+        self.logs = collections.OrderedDict()
+        self.bytes = 0
+
+    def get(self, room):
+        log = self.logs.get(room)
+        if log is None:
+            log = self.logs[room] = RoomLog(settings.CHAT_REPLAY_BUFFER, self)
+            if len(self.logs) > MAX_ROOMS:
+                self.drop(next(iter(self.logs)))
+        else:
+            self.logs.move_to_end(room)
+        return log
+
+    def trim(self):
+        """Drop the oldest events of the least recently used rooms while over budget."""
+        while self.bytes > settings.CHAT_REPLAY_MAX_BYTES and self.logs:
+            room, log = next(iter(self.logs.items()))
+            if log.seqs:
+                log.pop_oldest()
+            else:
+                self.drop(room)
+
+    def drop(self, room):
+        log = self.logs.pop(room)
+        self.bytes -= sum(event_size(event) for event in log.events.values())
+        log.logs = None
+
+    def clear(self):
+        self.logs.clear()
+        self.bytes = 0
+
+
+room_logs = RoomLogs()
+
+
+def stored_events(chat_group, after, up_to):
+    """
+    The ``message_handler`` events of the messages of ``chat_group``
+    numbered ``after`` + 1 to ``up_to``, rebuilt from the database.
+    """
+    from .events import message_event
+    from .models import GroupMessage
+
+    messages = (
+        GroupMessage.objects.with_authors()
+        .filter(group=chat_group, seq__gt=after, seq__lte=up_to)
+        .order_by("seq")
+    )
+    events = []
+    for message in messages:
+        message.group = chat_group
+        events.append(message_event(message))
+    return events
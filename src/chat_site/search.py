@@ -0,0 +1,170 @@
+"""
+Full-text search of a room's messages, on an SQLite FTS5 index.
+
+``chat_site_groupmessage_fts`` is an external-content FTS5 table: it holds
+only the index, the rows themselves stay in ``chat_site_groupmessage``.
+SQL triggers keep it in step with every insert, update and delete, including
+``bulk_create``, the write-behind writer and the archive's raw deletes
+(archived messages are not searchable).
+
+Each message is indexed with its group id, so searching a room intersects
+two posting lists inside the index instead of filtering every room's
+matches. Results are ranked by bm25 on the body, newest first among equals.
+Ranking scores every candidate, so only the ``SEARCH_CANDIDATES`` newest
+matches are ranked: a common word costs the same in a room of a million
+messages as in one of a thousand. Message ids are time-ordered, so "newest"
+is a walk down the index in rowid order that stops early. Past the ranked
+window, pages go on through the older matches newest first, keyset
+paginated on rowid, down to the room's first message.
+
+Migrations that rebuild the GroupMessage table drop its triggers: they are
+recreated after every ``migrate`` and by ``manage.py rebuild_search_index``.
+"""
+
+import re
+
+from django.db import connections
+
+from .pagination import MAX_ID
+
+FTS_TABLE = "chat_site_groupmessage_fts"
+SEARCH_PAGE_SIZE = 20
+SEARCH_CANDIDATES = 250  # newest matches ranked per query
+
+TRIGGERS = [
+    f"""
+    CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_insert
+    AFTER INSERT ON chat_site_groupmessage BEGIN
+        INSERT INTO {FTS_TABLE}(rowid, body, group_id)
+        VALUES (new.id, new.body, new.group_id);
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_delete
+    AFTER DELETE ON chat_site_groupmessage BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, body, group_id)
+        VALUES ('delete', old.id, old.body, old.group_id);
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_update
+    AFTER UPDATE OF body, group_id ON chat_site_groupmessage BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, body, group_id)
+        VALUES ('delete', old.id, old.body, old.group_id);
+        INSERT INTO {FTS_TABLE}(rowid, body, group_id)
+        VALUES (new.id, new.body, new.group_id);
+    END
+    """,
+]
+
+WORD = re.compile(r"\w+")
+
+
+def install_triggers(using="default"):
+    """Create the triggers that maintain the index, if the index exists."""
+    connection = connections[using]
+    if connection.vendor != "sqlite" or FTS_TABLE not in connection.introspection.table_names():
+        return
+    with connection.cursor() as cursor:
+        for trigger in TRIGGERS:
+            cursor.execute(trigger)
+
+
+def rebuild(using="default"):
+    """Reindex every message from scratch and compact the index."""
+    install_triggers(using)
+    with connections[using].cursor() as cursor:
+        cursor.execute(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')")
+        cursor.execute(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('optimize')")
+
+
+def match_expression(chat_group, query):
+    """
+    Turn what the user typed into an FTS5 query on ``chat_group``.
+
+    Every word must match, the last one as a prefix (of two letters or
+    more, which the index keeps prefix entries for) so results show up as
+    the user types. Quoting each word keeps FTS5 operators and punctuation
+    in the input from being parsed. Returns None if there is nothing to
+    search for.
+    """
+    words = WORD.findall(query)
+    if not words:
+        return None
+    terms = [f'"{word}"' for word in words]
+    if len(words[-1]) >= 2:
+        # A one-letter prefix would match most of the vocabulary
+        terms[-1] += "*"
+    return f'group_id : "{chat_group.pk}" AND body : ({" ".join(terms)})'
+
+
+def encode_search_cursor(phase, value):
+    return f"{phase}.{value}"
+
+
+def decode_search_cursor(cursor):
+    """``("rank", offset)`` or ``("date", rowid)``; raises ValueError if malformed."""
+    if not cursor:
+        return "rank", 0
+    phase, _, value = cursor.partition(".")
+    value = int(value)
+    if phase not in ("rank", "date") or not 0 <= value <= MAX_ID:
+        raise ValueError(cursor)
+    return phase, value
+
+
+def search_messages(chat_group, query, cursor=None, per_page=SEARCH_PAGE_SIZE):
+    """
+    Return one page of ``chat_group``'s messages matching ``query`` and the
+    cursor of the next page, None on the last one.
+
+    The ``SEARCH_CANDIDATES`` newest matches come first, best first, then
+    every older match, newest first. Raises ValueError for a malformed
+    ``cursor``.
+    """
+    from .models import GroupMessage
+
+    phase, value = decode_search_cursor(cursor)
+    expression = match_expression(chat_group, query)
+    if expression is None or connections["default"].vendor != "sqlite":
+        return [], None  # no index on other databases, see migration 0012
+    with connections["default"].cursor() as cursor:
+        ids, next_cursor = [], None
+        if phase == "rank":
+            cursor.execute(
+                "SELECT rowid FROM ("
+                f"  SELECT rowid, rank FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s"
+                "  ORDER BY rowid DESC LIMIT %s"
+                ") ORDER BY rank, rowid DESC LIMIT %s OFFSET %s",
+                [expression, SEARCH_CANDIDATES, per_page + 1, value],
+            )
+            ids = [row[0] for row in cursor.fetchall()]
+            if len(ids) > per_page:
+                ids = ids[:per_page]
+                next_cursor = encode_search_cursor("rank", value + per_page)
+            else:
+                # The ranked window is used up: fill the page from older matches
+                cursor.execute(
+                    "SELECT count(*), min(rowid) FROM ("
+                    f"  SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s"
+                    "  ORDER BY rowid DESC LIMIT %s"
+                    ")",
+                    [expression, SEARCH_CANDIDATES],
+                )
+                count, oldest = cursor.fetchone()
+                if count == SEARCH_CANDIDATES:
+                    phase, value = "date", oldest
+        if phase == "date":
+            limit = per_page - len(ids)
+            cursor.execute(
+                f"SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s AND rowid < %s"
+                " ORDER BY rowid DESC LIMIT %s",
+                [expression, value, limit + 1],
+            )
+            older = [row[0] for row in cursor.fetchall()]
+            if len(older) > limit:
+                older = older[:limit]
+                next_cursor = encode_search_cursor("date", older[-1] if older else value)
+            ids += older
+    messages = GroupMessage.objects.with_authors().in_bulk(ids)
+    return [messages[message_id] for message_id in ids if message_id in messages], next_cursor
@@ -0,0 +1,164 @@
+"""
+Bounded outbound queues for websocket connections.
+
+A consumer's sends go through a ``SendQueue`` of at most
+``CHAT_SEND_QUEUE_SIZE`` frames, written out one at a time by a task of
+its own. A client that reads slower than the room talks fills its queue
+instead of the server's memory, and the overflow policy is:
+
+1. drop the oldest queued presence update (online counts, status dots):
+   it is about to be superseded by a newer one anyway;
+2. if the queue holds nothing but messages, drop a new presence update;
+3. if a message still doesn't fit, close the connection with
+   ``OVERFLOW_CLOSE_CODE`` (1013, try again later). The client reconnects
+   and reloads the room instead of silently missing messages.
+
+A presence update can name what it updates (``presence="online_count"``):
+it then replaces the queued update of the same name, as only the newest
+one matters.
+
+The queue can only fill when the server's websocket ``send`` waits for the
+socket to drain, as uvicorn's (with the ``websockets`` implementation)
+does. Daphne, which ``runserver`` and the default deployment use, returns
+from ``send`` at once and buffers in Twisted without limit, and it doesn't
+tell the application what is still unwritten. Under Daphne the writer
+never falls behind, so the policy above never runs and a slow client's
+backlog grows in the server's memory. Deployments that need the bound
+run the application under uvicorn.
+
+Coalescing
+----------
+
+With a ``window``, the writer waits that long after the first frame of a
+burst, or until ``max_bytes`` are queued, then joins what it finds into as
+few frames as fit ``max_bytes``: HTML fragments one after the other, which
+htmx swaps out of band one by one, and JSON records (``chat_site.records``)
+into an array. Each frame is a write to the socket, so a busy room costs
+fewer frames and syscalls, for ``window`` more latency.
+
+``counters`` adds up, for the process, the frames ``queued`` and ``sent``
+and those ``coalesced`` into another, ``collapsed`` into a newer update or
+``dropped``.
+"""
+
+import asyncio
+import collections
+import contextlib
+
+OVERFLOW_CLOSE_CODE = 1013
+
+counters = collections.Counter()
+
+
+class SendQueue:
+    def __init__(self, send, overflow, maxsize, window=0, max_bytes=0):
+        """
+        ``send`` is a coroutine function writing one ASGI message,
+        ``overflow`` one closing the connection. ``window`` (seconds) and
+        ``max_bytes`` turn coalescing on.
+        """
+        self._send = send
+        self._overflow = overflow
+        self.maxsize = maxsize
+        self.window = window
+        self.max_bytes = max_bytes
+        self.frames = collections.deque()  # (presence, message)
+        self.queued_bytes = 0
+        self.ready = asyncio.Event()
+        self.full = asyncio.Event()
+        self.dropped = 0
+        self.overflowed = False
+        self.task = asyncio.create_task(self.run())
+
+    async def put(self, message, presence=False):
+        if self.overflowed:
+            return
+        counters["queued"] += 1
+        if isinstance(presence, str) and self.remove(presence):
+            counters["collapsed"] += 1
+        if len(self.frames) >= self.maxsize and not self.make_room():
+            if presence:
+                self.drop()
+                return
+            await self.overflow()
+            return
+        self.frames.append((presence, message))
+        if self.window:
+            self.queued_bytes += len(message.get("text") or "")
+            if self.queued_bytes >= self.max_bytes:
+                self.full.set()
+        self.ready.set()
+
+    def remove(self, presence):
+        """Remove the queued update of ``presence``; True if there was one."""
+        for i, (queued, _) in enumerate(self.frames):
+            if queued == presence:
+                self.discard(i)
+                return True
+        return False
+
+    def make_room(self):
+        for i, (presence, _) in enumerate(self.frames):
+            if presence:
+                self.discard(i)
+                self.drop()
+                return True
+        return False
+
+    def discard(self, i):
+        _, message = self.frames[i]
+        del self.frames[i]
+        if self.window:
+            self.queued_bytes -= len(message.get("text") or "")
+
+    def drop(self):
+        self.dropped += 1
+        counters["dropped"] += 1
+
+    async def overflow(self):
+        self.overflowed = True
+        self.frames.clear()
+        self.task.cancel()
+        await self._overflow()
+
+    async def run(self):
+        while True:
+            await self.ready.wait()
+            if self.window:
+                # Let the burst gather, unless it fills a frame already
+                with contextlib.suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(self.full.wait(), self.window)
+            while self.frames:
+                await self._send(self.take())
+                counters["sent"] += 1
+            self.ready.clear()
+            self.full.clear()
+
+    def take(self):
+        """The next frame, joined with the queued frames after it when coalescing."""
+        _, message = self.frames.popleft()
+        text = message.get("text") if self.window else None
+        if text is None:
+            return message
+        records = text.startswith("{")
+        parts, size = [text], len(text)
+        while self.frames:
+            following = self.frames[0][1].get("text")
+            if (
+                following is None
+                or following.startswith("{") != records
+                or size + len(following) > self.max_bytes
+            ):
+                break
+            self.frames.popleft()
+            parts.append(following)
+            size += len(following)
+        self.queued_bytes -= size
+        if len(parts) == 1:
+            return message
+        counters["coalesced"] += len(parts) - 1
+        text = f"[{','.join(parts)}]" if records else "\n".join(parts)
+        return {"type": "websocket.send", "text": text}
+
+    def close(self):
+        self.task.cancel()
@@ -0,0 +1,120 @@
+import shutil
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.db import transaction
+from allauth.account.models import EmailAddress
+from django.contrib.auth import get_user_model
+from django.db.models.signals import (
+    m2m_changed,
+    post_delete,
+    post_migrate,
+    post_save,
+    pre_delete,
+)
+from django.dispatch import receiver
+
+from . import cache
+from .archive import archived_files, room_dir
+from .events import membership_event, user_group
+from .models import ChatBan, ChatGroup, ReadCursor
+from .search import install_triggers
+from .storage import content_store
+from .unread import create_read_cursors
+
+User = get_user_model()
+
+
+@receiver(m2m_changed, sender=ChatGroup.members.through)
+def members_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    Give new members a read cursor (and drop it when they leave), and tell
+    the online-status sockets of users who joined or left a chat, so they
+    start or stop following that room's presence.
+    """
+    if action not in ("post_add", "post_remove") or not pk_set:
+        return
+    member = action == "post_add"
+    if reverse:  # user.chat_groups.add(...)
+        pairs = [(instance.pk, group_id) for group_id in pk_set]
+        rooms = ChatGroup.objects.filter(pk__in=pk_set).values_list(
+            "group_name", flat=True
+        )
+        changes = [(instance.pk, room) for room in rooms]
+    else:  # chat_group.members.add(...)
+        pairs = [(user_id, instance.pk) for user_id in pk_set]
+        changes = [(user_id, instance.group_name) for user_id in pk_set]
+
+    if member:
+        create_read_cursors(pairs)
+    else:
+        member_ids, group_ids = zip(*pairs)
+        ReadCursor.objects.filter(
+            member_id__in=member_ids, group_id__in=group_ids
+        ).delete()
+
+    def notify():
+        channel_layer = get_channel_layer()
+        for user_id, room in changes:
+            async_to_sync(channel_layer.group_send)(
+                user_group(user_id), membership_event(room, member)
+            )
+
+    transaction.on_commit(notify)
+
+
+@receiver(m2m_changed, sender=ChatGroup.members.through)
+def forget_members(sender, instance, action, reverse, pk_set, **kwargs):
+    """Drop the cached member ids of the rooms whose members changed."""
+    if reverse and action == "pre_clear":  # user.chat_groups.clear()
+        cache.forget_members(instance.chat_groups.values_list("pk", flat=True))
+    elif action in ("post_add", "post_remove", "post_clear"):
+        cache.forget_members((pk_set or []) if reverse else [instance.pk])
+
+
+@receiver([post_save, post_delete], sender=ChatGroup)
+def forget_room(sender, instance, **kwargs):
+    cache.forget_room(instance.group_name)
+    if kwargs["signal"] is post_delete:
+        cache.forget_members([instance.pk])
+        cache.forget_bans(instance.pk)
+
+
+@receiver(pre_delete, sender=User)
+def forget_user(sender, instance, **kwargs):
+    # Deleting the user deletes its memberships without m2m_changed
+    cache.forget_members(instance.chat_groups.values_list("pk", flat=True))
+    cache.forget_verified(instance.pk)
+
+
+@receiver([post_save, post_delete], sender=ChatBan)
+def forget_bans(sender, instance, **kwargs):
+    cache.forget_bans(instance.group_id)
+
+
+@receiver([post_save, post_delete], sender=EmailAddress)
+def forget_verified(sender, instance, **kwargs):
+    cache.forget_verified(instance.user_id)
+
+
+@receiver(post_delete, sender=ChatGroup)
+def chat_group_deleted(sender, instance, **kwargs):
+    """
+    Archived messages go with their room, like the ones in the table, and
+    so do their references to attachments.
+    """
+    group_id = instance.pk
+
+    def delete_archive():
+        for name in archived_files(group_id):
+            content_store.delete(name)
+        shutil.rmtree(room_dir(group_id), ignore_errors=True)
+
+    transaction.on_commit(delete_archive)
+
+
+@receiver(post_migrate)
+def search_index_migrated(sender, using, **kwargs):
+    """Restore the search triggers, which SQLite drops when a table is rebuilt."""
+    if sender.name == "chat_site":
+        install_triggers(using)
@@ -0,0 +1,149 @@
+"""
+Content-addressed, deduplicating storage for attachments and avatars.
+
+Every file is stored once, as ``blobs/<ab>/<sha256><.ext>`` under
+MEDIA_ROOT, however many messages and profiles use it. A ``Blob`` row
+counts the fields that reference it: saving content that is already
+stored only adds a reference, without writing a byte, and deleting a name
+(as django_cleanup does when a message is deleted or an avatar replaced)
+drops one. The file goes when its last reference does.
+
+The extension is kept so the files are served with the right type. Image
+variants (``chat_site.thumbnails``) are named after the file and deleted
+with it. Names no longer say what the file was called, so messages keep
+the uploaded name in ``GroupMessage.file_name``.
+
+URLs are signed, so that only pages and events that show a file (to the
+members of its chat) hand out a working link to it.
+
+Archived messages keep their references: the archive deletes rows without
+signals, and a room's references are dropped with its archive.
+
+Files saved before this storage existed keep their old names and are
+deleted as before; ``manage.py dedupe_media`` moves them into the store.
+"""
+
+import hashlib
+import os
+import uuid
+
+from django.core import signing
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.utils.crypto import constant_time_compare
+from django.utils.deconstruct import deconstructible
+
+BLOB_DIR = "blobs"
+
+_signer = signing.Signer(salt="chat_site.storage")
+
+
+def url_signature(name):
+    return _signer.signature(name)
+
+
+def verify_url_signature(name, signature):
+    return constant_time_compare(url_signature(name), signature)
+
+
+def file_digest(content):
+    """SHA-256 hex digest of a Django ``File``."""
+    sha256 = hashlib.sha256()
+    for chunk in content.chunks():
+        sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+@deconstructible
+class ContentAddressedStorage(FileSystemStorage):
+    def blob_name(self, digest, name):
+        """Where content with ``digest`` uploaded as ``name`` is stored."""
+        extension = os.path.splitext(name)[1].lower()
+        if not extension[1:].isalnum() or len(extension) > 10:
+            extension = ""
+        return f"{BLOB_DIR}/{digest[:2]}/{digest}{extension}"
+
+    def is_blob(self, name):
+        return name.startswith(f"{BLOB_DIR}/")
+
+    def variant_name(self, name, width, extension):
+        """Name of the ``width`` pixels wide variant of the image ``name``."""
+        return f"{os.path.splitext(name)[0]}.w{width}{extension}"
+
+    def delete_variants(self, name):
+        """
+        Delete the variants of ``name`` by their exact names: files of other
+        uploads in the same directory may start with the same stem.
+        """
+        from .thumbnails import VARIANT_EXTENSIONS, VARIANT_WIDTHS
+
+        for width in VARIANT_WIDTHS:
+            for extension in VARIANT_EXTENSIONS:
+                try:
+                    os.remove(self.path(self.variant_name(name, width, extension)))
+                except FileNotFoundError:
+                    pass
+
+    def url(self, name):
+        """The file's URL, signed: ``core.files`` serves media only with it."""
+        return f"{super().url(name)}?s={url_signature(name)}"
+
+    def add_reference(self, name):
+        """Reference the stored blob ``name``. False if it isn't stored."""
+        from .models import Blob
+
+        return bool(Blob.objects.filter(name=name).update(references=F("references") + 1))
+
+    def save(self, name, content, max_length=None):
+        """
+        Store ``content`` under its digest and return the blob's name.
+
+        ``content.sha256``, if set, is trusted instead of hashing the content
+        again (``chat_site.uploads`` computes it as chunks arrive).
+        """
+        from .models import Blob
+
+        if name is None:
+            name = content.name
+        if not hasattr(content, "chunks"):
+            content = File(content, name)
+        digest = getattr(content, "sha256", None) or file_digest(content)
+        name = self.blob_name(digest, name)
+        if self.add_reference(name):
+            return name
+
+        size = content.size  # before the content is moved
+        # Write under a temporary name, then rename: a concurrent save of the
+        # same content replaces the file with identical bytes
+        temporary = self._save(f"{name}.{uuid.uuid4().hex}.partial", content)
+        os.replace(self.path(temporary), self.path(name))
+        try:
+            with transaction.atomic():
+                Blob.objects.create(name=name, size=size, references=1)
+        except IntegrityError:
+            # Stored concurrently
+            self.add_reference(name)
+        return name
+
+    def delete(self, name):
+        """Drop a reference to ``name``, and the file with the last one."""
+        from .models import Blob
+
+        if not name or not self.is_blob(name):
+            super().delete(name)
+            self.delete_variants(name)
+            return
+        with transaction.atomic():
+            Blob.objects.filter(name=name, references__gt=0).update(
+                references=F("references") - 1
+            )
+            deleted, _ = Blob.objects.filter(name=name, references=0).delete()
+            if deleted:
+                # Before committing, so a save waiting on the row writes it anew
+                super().delete(name)
+                self.delete_variants(name)
+
+
+content_store = ContentAddressedStorage()
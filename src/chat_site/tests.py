@@ -1,3 +1,1602 @@
-from django.test import TestCase
+import asyncio
+import contextlib
+import hashlib
+import io
+import os
+import shutil
+import socket
+import tempfile
+from datetime import timedelta
+from io import StringIO
+from unittest import mock
 
-# Create your tests here.
+from allauth.account.models import EmailAddress
+from channels.db import database_sync_to_async
+from channels.exceptions import ChannelFull
+from channels.routing import URLRouter
+from channels.testing import HttpCommunicator, WebsocketCommunicator
+from django.contrib.auth import get_user_model
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.http import http_date
+from PIL import Image
+
+from core import files
+
+from . import archive, cache, moderation, records, routing, thumbnails, uploads
+from .models import Blob, ChatBan, ChatGroup, ChunkedUpload, GroupMessage, ReadCursor
+from .ids import IdGenerator, new_message_id
+from .layers import UnixSocketChannelLayer
+from .pagination import PAGE_SIZE
+from .persistence import message_writer
+from .presence import PresenceRegistry, write_snapshot
+from .ratelimit import RateLimiter, rate_limiter
+from .replay import RoomLog, RoomLogs, room_logs
+from .search import search_messages
+from .sendqueue import SendQueue
+from .storage import content_store, url_signature
+
+User = get_user_model()
+
+SERIALIZING_LAYERS = {
+    "default": {"BACKEND": "chat_site.layers.SerializingInMemoryChannelLayer"}
+}
+
+
+@override_settings(CHANNEL_LAYERS=SERIALIZING_LAYERS, CHAT_PRESENCE_BATCH_INTERVAL=0)
+class ChatTestCase(TestCase):
+    """Base for tests that exercise the consumers over a serializing layer."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create_user("alice", "alice@example.com", "pw")
+        cls.bob = User.objects.create_user("bob", "bob@example.com", "pw")
+        cls.public_chat = ChatGroup.objects.create(group_name="public-chat")
+        cls.online_status = ChatGroup.objects.create(group_name="online-status")
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root, ignore_errors=True)
+        media = override_settings(
+            MEDIA_ROOT=self.media_root,
+            CHAT_ARCHIVE_ROOT=os.path.join(self.media_root, "archive"),
+        )
+        media.enable()
+        self.addCleanup(media.disable)
+        self.addCleanup(rate_limiter.clear)
+        self.addCleanup(room_logs.clear)
+        self.addCleanup(cache.clear)  # its rows are rolled back
+
+    async def connect(self, user, path, subprotocols=None):
+        communicator = WebsocketCommunicator(
+            URLRouter(routing.websocket_urlpatterns), path, subprotocols=subprotocols
+        )
+        communicator.scope["user"] = user
+        connected, subprotocol = await communicator.connect()
+        self.assertTrue(connected)
+        if subprotocols:
+            self.assertEqual(subprotocol, subprotocols[0])
+        return communicator
+
+    @contextlib.asynccontextmanager
+    async def assertNumQueriesAsync(self, num):
+        """assertNumQueries for code awaited from an async test."""
+        # The connection is thread-bound: only touch it from the sync thread
+        context = CaptureQueriesContext(connection)
+        await database_sync_to_async(context.__enter__)()
+        try:
+            yield
+        finally:
+            await database_sync_to_async(context.__exit__)(None, None, None)
+        captured = await database_sync_to_async(lambda: context.captured_queries)()
+        queries = "\n".join(query["sql"] for query in captured)
+        self.assertEqual(len(captured), num, f"{len(captured)} queries executed:\n{queries}")
+
+    async def drain(self, *communicators):
+        for communicator in communicators:
+            while not await communicator.receive_nothing(timeout=0.05):
+                await communicator.receive_output()
+
+
+class ChatroomConsumerTests(ChatTestCase):
+    async def test_message_is_rendered_per_variant(self):
+        alice = await self.connect(self.alice, "/ws/chatroom/public-chat")
+        bob = await self.connect(self.bob, "/ws/chatroom/public-chat")
+        await self.drain(alice, bob)
+
+        await alice.send_json_to({"body": "hello"})
+        own = await alice.receive_from()
+        other = await bob.receive_from()
+
+        self.assertIn("hello", own)
+        self.assertIn("bg-green-200", own)
+        self.assertIn("hello", other)
+        self.assertNotIn("bg-green-200", other)
+        self.assertIn("@alice", other)
+
+        await alice.disconnect()
+        await bob.disconnect()
+
+    async def test_online_count_is_broadcast(self):
+        alice = await self.connect(self.alice, "/ws/chatroom/public-chat")
+        await self.drain(alice)
+        bob = await self.connect(self.bob, "/ws/chatroom/public-chat")
+
+        html = await alice.receive_from()
+        self.assertIn('id="online-count"', html)
+        self.assertIn("1", html)
+        # Only bob's dot, not the member strip
+        dot = await alice.receive_from()
+        self.assertIn(f'id="member-status-{self.bob.id}"', dot)
+        self.assertIn("bg-green-500", dot)
+
+        await bob.disconnect()
+        await alice.receive_from()
+        self.assertIn("bg-gray-500", await alice.receive_from())
+        await alice.disconnect()
+
+    @override_settings(CHAT_PRESENCE_FLUSH_INTERVAL=0.2)
+    async def test_users_online_is_flushed_after_the_last_disconnect(self):
+        online = database_sync_to_async(
+            lambda: sorted(self.public_chat.users_online.values_list("username", flat=True))
+        )
+        bob = await self.connect(self.bob, "/ws/chatroom/public-chat")
+        await asyncio.sleep(0.3)
+        self.assertEqual(await online(), ["bob"])
+
+        # Everyone leaves well within the interval, and no one comes after
+        alice = await self.connect(self.alice, "/ws/chatroom/public-chat")
+        await alice.disconnect()
+        await bob.disconnect()
+        await asyncio.sleep(0.3)
+        self.assertEqual(await online(), [])
+
+    @override_settings(CHAT_SEND_QUEUE_SIZE=3)
+    async def test_slow_client_is_disconnected(self):
+        # A server whose send waits for the socket to drain, like uvicorn
+        drained = asyncio.Event()
+        application = URLRouter(routing.websocket_urlpatterns)
+
+        async def server(scope, receive, send):
+            async def send_when_drained(message):
+                if message["type"] == "websocket.send":
+                    await drained.wait()
+                await send(message)
+
+            await application(scope, receive, send_when_drained)
+
+        bob = WebsocketCommunicator(server, "/ws/chatroom/public-chat")
+        bob.scope["user"] = self.bob
+        connected, _ = await bob.connect()
+        self.assertTrue(connected)
+        alice = await self.connect(self.alice, "/ws/chatroom/public-chat")
+        await self.drain(alice)
+
+        # Bob's presence updates make way for the first messages, then he is
+        # closed rather than silently missing one
+        for i in range(5):
+            await alice.send_json_to({"body": f"hello {i}"})
+        self.assertEqual(
+            await bob.receive_output(), {"type": "websocket.close", "code": 1013}
+        )
+        drained.set()
+        await alice.disconnect()
+        await bob.disconnect()
+
+    async def test_json_records_are_negotiated(self):
+        alice = await self.connect(
+            self.alice, "/ws/chatroom/public-chat", subprotocols=[records.SUBPROTOCOL]
+        )
+        bob = await self.connect(self.bob, "/ws/chatroom/public-chat")
+        await self.drain(alice, bob)
+
+        await alice.send_json_to({"body": "<b>hello</b>"})
+        record = await alice.receive_json_from()
+        html = await bob.receive_from()
+
+        self.assertEqual(record["type"], "message")
+        self.assertEqual(record["body"], "<b>hello</b>")
+        self.assertEqual(record["username"], "alice")
+        self.assertEqual(record["seq"], 1)
+        self.assertNotIn("file", record)  # empty fields are left out
+        self.assertIn("&lt;b&gt;hello&lt;/b&gt;", html)
+        self.assertNotIn("<script>", html)
+
+        await alice.disconnect()
+        await bob.disconnect()
+
+    async def test_file_upload_is_broadcast(self):
+        bob = await self.connect(self.bob, "/ws/chatroom/public-chat")
+        await self.drain(bob)
+
+        await database_sync_to_async(self.client.force_login)(self.alice)
+        upload = SimpleUploadedFile("notes.txt", b"some notes")
+        response = await database_sync_to_async(self.client.post)(
+            reverse("chat-file-upload", args=["public-chat"]),
+            {"file": upload},
+            headers={"HX-Request": "true"},
+        )
+        self.assertEqual(response.status_code, 200)
+
+        html = await bob.receive_from()
+        self.assertIn("notes", html)
+        await bob.disconnect()
+
+
+class OnlineStatusConsumerTests(ChatTestCase):
+    async def test_online_users_are_counted(self):
+        alice = await self.connect(self.alice, "/ws/online-status/")
+        await self.drain(alice)
+        bob = await self.connect(self.bob, "/ws/online-status/")
+
+        html = await alice.receive_from()
+        self.assertIn("1 online", html)
+
+        await alice.disconnect()
+        await bob.disconnect()
+
+    async def test_online_in_chats_flag(self):
+        chatroom = await self.connect(self.bob, "/ws/chatroom/public-chat")
+        alice = await self.connect(self.alice, "/ws/online-status/")
+
+        html = await alice.receive_from()
+        self.assertIn("bg-green-500", html)
+
+        await alice.disconnect()
+        await chatroom.disconnect()
+
+    async def test_room_presence_batch_updates_flag(self):
+        alice = await self.connect(self.alice, "/ws/online-status/")
+        await self.drain(alice)
+        chatroom = await self.connect(self.bob, "/ws/chatroom/public-chat")
+
+        html = await alice.receive_from()
+        self.assertIn("bg-green-500", html)
+
+        await chatroom.disconnect()
+        html = await alice.receive_from()
+        self.assertNotIn("bg-green-500", html)
+        await alice.disconnect()
+
+    async def test_new_membership_is_followed(self):
+        groupchat = await ChatGroup.objects.acreate(groupchat_name="Friends")
+        await groupchat.members.aadd(self.bob)
+        alice = await self.connect(self.alice, "/ws/online-status/")
+        await self.drain(alice)
+        chatroom = await self.connect(self.bob, f"/ws/chatroom/{groupchat.group_name}")
+        # Public chat is empty and alice isn't a member of the group yet
+        self.assertTrue(await alice.receive_nothing(timeout=0.1))
+
+        @database_sync_to_async
+        def join():
+            with self.captureOnCommitCallbacks(execute=True):
+                groupchat.members.add(self.alice)
+
+        await join()
+        html = await alice.receive_from()
+        self.assertIn("bg-green-500", html)
+
+        await chatroom.disconnect()
+        await alice.disconnect()
+
+
+class ChatHistoryTests(ChatTestCase):
+    def setUp(self):
+        super().setUp()
+        GroupMessage.objects.bulk_create(
+            [
+                GroupMessage(group=self.public_chat, author=self.bob, body=f"message {i}")
+                for i in range(PAGE_SIZE + 5)
+            ]
+        )
+        self.client.force_login(self.alice)
+
+    def test_chat_view_renders_newest_page(self):
+        response = self.client.get(reverse("chat_home"))
+        bodies = [m.body for m in response.context["chat_messages"]]
+        self.assertEqual(len(bodies), PAGE_SIZE)
+        self.assertEqual(bodies[-1], f"message {PAGE_SIZE + 4}")
+        self.assertIsNotNone(response.context["older_cursor"])
+
+    def test_older_messages_continue_before_cursor(self):
+        cursor = self.client.get(reverse("chat_home")).context["older_cursor"]
+        response = self.client.get(
+            reverse("chat-older", args=["public-chat"]), {"before": cursor}
+        )
+        bodies = [m.body for m in response.context["chat_messages"]]
+        self.assertEqual(bodies, [f"message {i}" for i in range(5)])
+        self.assertIsNone(response.context["older_cursor"])
+
+    def test_malformed_cursor_is_rejected(self):
+        for cursor in ("nope", f"{10**20}.1", f"0.{2**64}"):
+            response = self.client.get(
+                reverse("chat-older", args=["public-chat"]), {"before": cursor}
+            )
+            self.assertEqual(response.status_code, 400)
+
+
+@override_settings(CHAT_MEMBER_PAGE_SIZE=2)
+class MemberStripTests(ChatTestCase):
+    def setUp(self):
+        super().setUp()
+        self.users = [User.objects.create_user(f"user{i}") for i in range(3)]
+        self.room = ChatGroup.objects.create(groupchat_name="Team", admin=self.alice)
+        self.room.members.add(self.alice, self.bob, *self.users)
+        self.client.force_login(self.alice)
+
+    def test_members_are_paginated(self):
+        response = self.client.get(reverse("chatroom", args=[self.room.group_name]))
+        self.assertEqual(response.context["members"], [self.alice, self.bob])
+        self.assertContains(response, 'id="load-members"')
+
+        url = reverse("chat-members", args=[self.room.group_name])
+        response = self.client.get(url, {"after": response.context["next_member"]})
+        self.assertEqual(response.context["members"], self.users[:2])
+        response = self.client.get(url, {"after": response.context["next_member"]})
+        self.assertEqual(response.context["members"], self.users[2:])
+        self.assertNotContains(response, 'id="load-members"')
+
+    def test_members_show_who_is_online(self):
+        with mock.patch("chat_site.views.presence", PresenceRegistry()) as registry:
+            registry.connect(self.room.group_name, self.bob.id, "channel")
+            response = self.client.get(reverse("chatroom", args=[self.room.group_name]))
+
+        self.assertEqual([m.online for m in response.context["members"]], [False, True])
+        self.assertContains(response, "border-green-800", count=1)
+
+    def test_non_members_cannot_list_members(self):
+        self.client.force_login(User.objects.create_user("carol", password="pw"))
+        response = self.client.get(reverse("chat-members", args=[self.room.group_name]))
+        self.assertEqual(response.status_code, 404)
+
+
+class PresenceRegistryTests(TestCase):
+    def setUp(self):
+        self.registry = PresenceRegistry()
+
+    def test_user_stays_online_until_last_tab_closes(self):
+        self.assertTrue(self.registry.connect("room", 1, "tab-1"))
+        self.assertFalse(self.registry.connect("room", 1, "tab-2"))
+        self.assertFalse(self.registry.disconnect("room", 1, "tab-1"))
+        self.assertTrue(self.registry.is_online("room", 1))
+        self.assertTrue(self.registry.disconnect("room", 1, "tab-2"))
+        self.assertEqual(self.registry.online_count("room"), 0)
+
+    @override_settings(CHAT_PRESENCE_TTL=-1)
+    def test_connection_without_heartbeat_expires(self):
+        self.registry.connect("room", 1, "tab-1")
+        self.registry.on_change = mock.Mock()
+        self.assertEqual(self.registry.online_user_ids("room"), set())
+        # Expiring is a change like any other: it is broadcast and flushed
+        self.registry.on_change.assert_called()
+        self.assertEqual(self.registry.take_snapshot(), {"room": set()})
+
+    def test_snapshot_is_flushed_to_users_online(self):
+        room = ChatGroup.objects.create(group_name="room")
+        carol = User.objects.create_user("carol")
+        dave = User.objects.create_user("dave")
+        self.registry.connect("room", carol.id, "tab-1")
+        self.registry.connect("room", dave.id, "tab-2")
+        self.registry.flush()
+        self.assertEqual(set(room.users_online.all()), {carol, dave})
+
+        self.registry.disconnect("room", carol.id, "tab-1")
+        # Lookup, savepoint, delete and insert the worker's view, delete,
+        # select and insert users_online, release
+        with self.assertNumQueries(8):
+            self.registry.flush()
+        self.assertEqual(list(room.users_online.all()), [dave])
+
+        self.registry.disconnect("room", dave.id, "tab-2")
+        self.registry.flush()
+        self.assertFalse(room.users_online.exists())
+
+    def test_workers_views_are_merged(self):
+        room = ChatGroup.objects.create(group_name="room")
+        other_room = ChatGroup.objects.create(group_name="other-room")
+        carol = User.objects.create_user("carol")
+        dave = User.objects.create_user("dave")
+        write_snapshot({"room": {carol.id}}, worker_id=1)
+        write_snapshot({"room": {carol.id, dave.id}, "other-room": {dave.id}}, worker_id=2)
+        write_snapshot({"room": set()}, worker_id=1)
+        self.assertEqual(set(room.users_online.all()), {carol, dave})
+
+        # A new process with worker id 2 drops what the old one saw, everywhere
+        with mock.patch("chat_site.presence._cleared_workers", {1}):
+            write_snapshot({"room": {carol.id}}, worker_id=2)
+        self.assertEqual(list(room.users_online.all()), [carol])
+        self.assertFalse(other_room.users_online.exists())
+
+
+class QueryBudgetTests(ChatTestCase):
+    """
+    Pin the number of queries of the hot paths so N+1 regressions fail CI.
+
+    Every budget is checked against a room with several authors, members and
+    chats so a per-row query would show up.
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.users = [
+            User.objects.create_user(f"member{i}", f"member{i}@example.com")
+            for i in range(5)
+        ]
+        GroupMessage.objects.bulk_create(
+            [
+                GroupMessage(group=self.public_chat, author=user, body=f"hi from {user}")
+                for user in self.users * 3
+            ]
+        )
+        self.groupchat = ChatGroup.objects.create(groupchat_name="Team", admin=self.alice)
+        self.groupchat.members.add(self.alice, *self.users)
+        for user in self.users[:3]:
+            private = ChatGroup.objects.create(is_private=True)
+            private.members.add(self.alice, user)
+        self.client.force_login(self.alice)
+
+    def test_chat_page(self):
+        # session, user, room, member ids, messages with authors, header
+        # chats + their members, header profile, the members strip
+        url = reverse("chatroom", args=[self.groupchat.group_name])
+        with self.assertNumQueries(9):
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        # The room and its member ids are cached
+        with self.assertNumQueries(7):
+            self.client.get(url)
+
+    def test_public_chat_page(self):
+        with self.assertNumQueries(8):
+            response = self.client.get(reverse("chat_home"))
+        self.assertEqual(response.status_code, 200)
+
+    def test_file_upload(self):
+        # session, user, room, its bans, seq, insert, author profile for the
+        # render, and storing new content: a reference that misses, then its
+        # blob row (with its savepoint)
+        upload = SimpleUploadedFile("notes.txt", b"some notes")
+        with self.assertNumQueries(11):
+            response = self.client.post(
+                reverse("chat-file-upload", args=["public-chat"]),
+                {"file": upload},
+                headers={"HX-Request": "true"},
+            )
+        self.assertEqual(response.status_code, 200)
+
+    async def test_message_broadcast(self):
+        sockets = [
+            await self.connect(user, f"/ws/chatroom/{self.groupchat.group_name}")
+            for user in [self.alice, *self.users]
+        ]
+        await self.drain(*sockets)
+
+        # The seq and the insert: the author's profile was loaded on connect
+        # and recipients only pick a pre-rendered variant
+        async with self.assertNumQueriesAsync(2):
+            await sockets[0].send_json_to({"body": "hello"})
+            for socket in sockets:
+                await socket.receive_from()
+
+        for socket in sockets:
+            await socket.disconnect()
+
+
+class PrivateChatTests(ChatTestCase):
+    def test_both_users_get_the_same_room(self):
+        self.client.force_login(self.alice)
+        first = self.client.get(reverse("start-chat", args=["bob"]))
+        self.client.force_login(self.bob)
+        second = self.client.get(reverse("start-chat", args=["alice"]))
+
+        self.assertEqual(first.url, second.url)
+        room = ChatGroup.objects.get(is_private=True)
+        self.assertEqual(room.private_key, f"{self.alice.pk}:{self.bob.pk}")
+        self.assertCountEqual(room.members.all(), [self.alice, self.bob])
+
+    def test_lookup_is_one_query(self):
+        self.client.force_login(self.alice)
+        self.client.get(reverse("start-chat", args=["bob"]))
+        # session, user, other user, room lookup inside a savepoint
+        with self.assertNumQueries(6):
+            self.client.get(reverse("start-chat", args=["bob"]))
+
+
+@override_settings(CHAT_MESSAGE_PERSISTENCE="write_behind", CHAT_WRITE_BEHIND_INTERVAL=0)
+class WriteBehindTests(ChatTestCase):
+    async def test_message_is_broadcast_then_stored(self):
+        alice = await self.connect(self.alice, "/ws/chatroom/public-chat")
+        await self.drain(alice)
+
+        await alice.send_json_to({"body": "queued"})
+        html = await alice.receive_from()
+        self.assertIn("queued", html)
+
+        await message_writer.flush()
+        self.assertTrue(await GroupMessage.objects.filter(body="queued").aexists())
+        await alice.disconnect()
+
+    def test_ids_are_unique_and_ordered(self):
+        ids = [new_message_id() for _ in range(1000)]
+        self.assertEqual(ids, sorted(set(ids)))
+        self.assertLess(max(ids), 2**53)
+
+    def test_processes_claim_distinct_worker_ids(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        generators = [IdGenerator() for _ in range(3)]
+        with override_settings(CHAT_WORKER_LOCK_DIR=directory):
+            for generator in generators:
+                self.addCleanup(generator.release)
+            self.assertEqual([g.worker_id for g in generators], [0, 1, 2])
+            generators[1].release()
+            # A freed id goes to the next process to start
+            generators[1] = IdGenerator()
+            self.addCleanup(generators[1].release)
+            self.assertEqual(generators[1].worker_id, 1)
+
+            with mock.patch("chat_site.ids.MAX_WORKER_ID", 2):
+                with self.assertRaises(ImproperlyConfigured):
+                    IdGenerator().worker_id
+
+
+class ArchiveTests(ChatTestCase):
+    def setUp(self):
+        super().setUp()
+        old = timezone.now() - timedelta(days=100)
+        GroupMessage.objects.bulk_create(
+            [
+                GroupMessage(
+                    group=self.public_chat,
+                    author=self.bob,
+                    body=f"message {i}",
+                    created=old + timedelta(minutes=i),
+                )
+                for i in range(100)
+            ]
+            + [
+                GroupMessage(group=self.public_chat, author=self.bob, body=f"message {i}")
+                for i in range(100, 110)
+            ]
+        )
+        self.client.force_login(self.alice)
+
+    def read_history(self):
+        response = self.client.get(reverse("chat_home"))
+        bodies = [m.body for m in response.context["chat_messages"]]
+        cursor = response.context["older_cursor"]
+        while cursor:
+            response = self.client.get(
+                reverse("chat-older", args=["public-chat"]), {"before": cursor}
+            )
+            bodies[:0] = [m.body for m in response.context["chat_messages"]]
+            cursor = response.context["older_cursor"]
+        return bodies
+
+    @mock.patch.object(archive, "BLOCK_SIZE", 16)
+    def test_old_messages_move_to_segments(self):
+        history = self.read_history()
+        out = StringIO()
+        call_command("archive_messages", "--days", "30", stdout=out)
+        self.assertIn("Archived 100 messages", out.getvalue())
+        self.assertEqual(GroupMessage.objects.filter(group=self.public_chat).count(), 10)
+        # Pages run from the table into the archive without a seam
+        self.assertEqual(self.read_history(), history)
+
+    def test_segments_are_appended(self):
+        archive.archive_room(self.public_chat, timezone.now() - timedelta(days=30), 30)
+        self.assertEqual(len(archive.segment_paths(self.public_chat.pk)), 4)
+        self.assertEqual(self.read_history(), [f"message {i}" for i in range(110)])
+
+    def test_interrupted_run_is_finished(self):
+        # The segment was written but the rows were never deleted
+        crash = mock.patch.object(archive, "delete_archived", side_effect=RuntimeError)
+        with crash, self.assertRaises(RuntimeError):
+            archive.archive_room(self.public_chat, timezone.now() - timedelta(days=30))
+        self.assertEqual(GroupMessage.objects.count(), 110)
+        archive.archive_room(self.public_chat, timezone.now() - timedelta(days=30))
+        self.assertEqual(GroupMessage.objects.count(), 10)
+        self.assertEqual(self.read_history(), [f"message {i}" for i in range(110)])
+
+    def test_rows_stored_behind_the_archive_are_archived_later(self):
+        archive.archive_room(self.public_chat, timezone.now() - timedelta(days=30))
+        # Flushed by the write-behind writer after its neighbours were archived
+        created = timezone.now() - timedelta(days=100) + timedelta(minutes=50, seconds=30)
+        GroupMessage.objects.bulk_create(
+            [GroupMessage(group=self.public_chat, author=self.bob, body="late", created=created)]
+        )
+        history = [f"message {i}" for i in range(51)] + ["late"]
+        history += [f"message {i}" for i in range(51, 110)]
+        self.assertEqual(self.read_history(), history)
+
+        archived = archive.archive_room(self.public_chat, timezone.now() - timedelta(days=30))
+        self.assertEqual(archived, 1)
+        self.assertEqual(GroupMessage.objects.count(), 10)
+        self.assertEqual(self.read_history(), history)
+
+    def test_first_format_segments_are_read(self):
+        with mock.patch.object(archive, "MAGIC", b"CHATSEG1"):
+            archive.write_segment(
+                self.public_chat.pk,
+                [
+                    [0, 1, self.bob.id, "before file names", None],
+                    [1, 2, self.bob.id, "", "files/notes.txt", "notes.txt"],
+                ],
+            )
+        second, first = archive.archived_before(self.public_chat)
+        self.assertEqual(
+            (first.body, first.file_name, first.variants), ("before file names", "", [])
+        )
+        self.assertEqual((second.filename, second.image_width), ("notes.txt", None))
+
+    def test_room_threshold_of_zero_is_honored(self):
+        self.public_chat.archive_after_days = 0
+        self.public_chat.save()
+        archived = archive.archive_messages()
+        self.assertEqual(archived["public-chat"], 110)
+        self.assertEqual(self.read_history(), [f"message {i}" for i in range(110)])
+
+
+class SearchTests(ChatTestCase):
+    def setUp(self):
+        super().setUp()
+        self.other_room = ChatGroup.objects.create(group_name="other")
+        GroupMessage.objects.bulk_create(
+            [
+                GroupMessage(group=self.public_chat, author=self.bob, body="lunch at noon?"),
+                GroupMessage(group=self.public_chat, author=self.bob, body="lunch lunch lunch"),
+                GroupMessage(group=self.public_chat, author=self.bob, body="see you later"),
+                GroupMessage(group=self.other_room, author=self.bob, body="lunch elsewhere"),
+            ]
+        )
+        self.client.force_login(self.alice)
+
+    def search(self, query, **params):
+        response = self.client.get(
+            reverse("chat-search", args=["public-chat"]), {"q": query, **params}
+        )
+        return [m.body for m in response.context["results"]], response.context["next_cursor"]
+
+    def test_results_are_ranked_within_the_room(self):
+        self.assertEqual(self.search("lunch"), (["lunch lunch lunch", "lunch at noon?"], None))
+
+    def test_last_word_is_a_prefix(self):
+        self.assertEqual(self.search("see you lat")[0], ["see you later"])
+
+    def test_query_syntax_is_not_interpreted(self):
+        self.assertEqual(self.search('lunch" OR "later')[0], [])
+        self.assertEqual(self.search("*")[0], [])
+
+    def test_results_are_paginated(self):
+        first, cursor = search_messages(self.public_chat, "lunch", per_page=1)
+        self.assertTrue(cursor)
+        second, cursor = search_messages(self.public_chat, "lunch", cursor, per_page=1)
+        self.assertIsNone(cursor)
+        self.assertEqual([m.body for m in first + second], self.search("lunch")[0])
+
+    @mock.patch("chat_site.search.SEARCH_CANDIDATES", 2)
+    def test_matches_past_the_ranked_window_follow_by_date(self):
+        GroupMessage.objects.bulk_create(
+            [
+                GroupMessage(group=self.public_chat, author=self.bob, body=f"lunch {i}")
+                for i in range(3)
+            ]
+        )
+        bodies, cursor = [], None
+        while True:
+            page, cursor = search_messages(self.public_chat, "lunch", cursor, per_page=2)
+            bodies += [m.body for m in page]
+            if cursor is None:
+                break
+
+        # The two newest ranked, then every older match, newest first
+        self.assertEqual(
+            bodies, ["lunch 2", "lunch 1", "lunch 0", "lunch lunch lunch", "lunch at noon?"]
+        )
+
+    def test_malformed_cursor_is_rejected(self):
+        for cursor in ("nope", f"date.{2**64}"):
+            response = self.client.get(
+                reverse("chat-search", args=["public-chat"]), {"q": "lunch", "cursor": cursor}
+            )
+            self.assertEqual(response.status_code, 400)
+
+    def test_index_follows_updates_and_deletes(self):
+        message = GroupMessage.objects.get(body="see you later")
+        message.body = "lunch tomorrow"
+        message.save()
+        GroupMessage.objects.filter(body="lunch at noon?").delete()
+        self.assertEqual(self.search("lunch")[0], ["lunch lunch lunch", "lunch tomorrow"])
+        self.assertEqual(self.search("later")[0], [])
+
+    def test_index_can_be_rebuilt(self):
+        call_command("rebuild_search_index", stdout=StringIO())
+        self.assertEqual(len(self.search("lunch")[0]), 2)
+
+
+class UnreadTests(ChatTestCase):
+    def setUp(self):
+        super().setUp()
+        self.room = ChatGroup.objects.create(groupchat_name="Team", admin=self.alice)
+        GroupMessage.objects.create(group=self.room, author=self.bob, body="before")
+        self.room.members.add(self.alice, self.bob)
+        self.badge = f'id="unread-{self.room.group_name}"'
+
+    async def receive_badge(self, socket):
+        while True:
+            html = await socket.receive_from()
+            if self.badge in html:
+                return html
+
+    def test_members_start_at_the_newest_message(self):
+        GroupMessage.objects.create(group=self.room, author=self.bob, body="after")
+        self.client.force_login(self.alice)
+        response = self.client.get(reverse("chat_home"))
+        (room,) = response.context["my_chat_groups"]
+        self.assertEqual(room.unread_count, 1)
+
+        self.room.members.remove(self.alice)
+        self.assertFalse(ReadCursor.objects.filter(member=self.alice).exists())
+
+    async def test_messages_elsewhere_are_counted(self):
+        status = await self.connect(self.alice, "/ws/online-status/")
+        await self.receive_badge(status)
+        bob = await self.connect(self.bob, f"/ws/chatroom/{self.room.group_name}")
+
+        await bob.send_json_to({"body": "ping"})
+        html = await self.receive_badge(status)
+        self.assertIn(">1</span>", html)
+
+        await bob.disconnect()
+        await status.disconnect()
+
+    async def test_opening_the_room_reads_it(self):
+        status = await self.connect(self.alice, "/ws/online-status/")
+        await self.receive_badge(status)
+        await GroupMessage.objects.acreate(group=self.room, author=self.bob, body="after")
+
+        alice = await self.connect(self.alice, f"/ws/chatroom/{self.room.group_name}")
+        html = await self.receive_badge(status)
+        self.assertIn(f"{self.badge} class=\"\"></span>", html)
+
+        bob = await self.connect(self.bob, f"/ws/chatroom/{self.room.group_name}")
+        await bob.send_json_to({"body": "seen"})
+        await self.drain(alice)
+        await alice.disconnect()  # writes the cursor it held back
+        cursor = await ReadCursor.objects.aget(member=self.alice, group=self.room)
+        latest = await GroupMessage.objects.filter(group=self.room).alatest("id")
+        self.assertEqual(cursor.last_read_id, latest.id)
+
+        await bob.disconnect()
+        await status.disconnect()
+
+
+@override_settings(CHAT_UPLOAD_CHUNK_SIZE=4, CHAT_UPLOAD_MAX_SIZE=16)
+class ChunkedUploadTests(ChatTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client.force_login(self.alice)
+
+    def start(self, size, filename="notes.txt"):
+        url = reverse("chat-upload-start", args=[self.public_chat.group_name])
+        return self.client.post(url, {"filename": filename, "size": size})
+
+    def patch(self, upload_id, offset, data):
+        url = reverse("chat-upload-chunk", args=[self.public_chat.group_name, upload_id])
+        return self.client.patch(
+            url, data, content_type="application/octet-stream", headers={"Upload-Offset": offset}
+        )
+
+    def finalize(self, upload_id, **data):
+        url = reverse("chat-upload-finalize", args=[self.public_chat.group_name, upload_id])
+        return self.client.post(url, data)
+
+    def test_upload_in_chunks(self):
+        response = self.start(10)
+        self.assertEqual(response.status_code, 201)
+        upload_id = response.json()["id"]
+        self.assertEqual(response.json()["chunk_size"], 4)
+
+        with mock.patch("chat_site.views.broadcast_message") as broadcast:
+            for offset in (0, 4, 8):
+                response = self.patch(upload_id, offset, b"0123456789"[offset : offset + 4])
+                self.assertEqual(response["Upload-Offset"], str(min(offset + 4, 10)))
+            self.assertEqual(self.finalize(upload_id, sha256="").status_code, 200)
+            broadcast.assert_called_once()
+
+        message = GroupMessage.objects.get(group=self.public_chat, author=self.alice)
+        with message.file.open() as f:
+            self.assertEqual(f.read(), b"0123456789")
+        self.assertFalse(ChunkedUpload.objects.exists())
+        self.assertEqual(os.listdir(os.path.join(self.media_root, "partial")), [])
+
+    def test_resume_from_the_server_offset(self):
+        upload_id = self.start(6).json()["id"]
+        self.patch(upload_id, 0, b"abcd")
+
+        response = self.patch(upload_id, 2, b"cdef")
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response["Upload-Offset"], "4")
+        url = reverse("chat-upload-chunk", args=[self.public_chat.group_name, upload_id])
+        self.assertEqual(self.client.head(url)["Upload-Offset"], "4")
+
+        self.assertEqual(self.finalize(upload_id).status_code, 409)
+        self.patch(upload_id, 4, b"ef")
+        # A restarted process rebuilds the checksum from the partial file
+        uploads._hashes.clear()
+        sha256 = hashlib.sha256(b"abcdef").hexdigest()
+        self.assertEqual(self.finalize(upload_id, sha256=sha256).status_code, 200)
+
+    def test_size_limits(self):
+        self.assertEqual(self.start(17).status_code, 413)
+        self.assertFalse(ChunkedUpload.objects.exists())
+
+        upload_id = self.start(6).json()["id"]
+        self.assertEqual(self.patch(upload_id, 0, b"abcde").status_code, 413)
+        self.patch(upload_id, 0, b"abcd")
+        self.assertEqual(self.patch(upload_id, 4, b"efg").status_code, 413)
+
+    def test_checksum_mismatch_discards_the_upload(self):
+        upload_id = self.start(2).json()["id"]
+        self.patch(upload_id, 0, b"ab")
+        self.assertEqual(self.finalize(upload_id, sha256="0" * 64).status_code, 400)
+        self.assertFalse(ChunkedUpload.objects.exists())
+        self.assertFalse(GroupMessage.objects.filter(group=self.public_chat).exists())
+
+    def test_only_the_author_can_write(self):
+        upload_id = self.start(2).json()["id"]
+        self.client.force_login(self.bob)
+        self.assertEqual(self.patch(upload_id, 0, b"ab").status_code, 404)
+
+
+class ContentStoreTests(ChatTestCase):
+    def attach(self, name, data, **kwargs):
+        return GroupMessage.objects.create(
+            group=self.public_chat,
+            author=self.alice,
+            file=SimpleUploadedFile(name, data),
+            file_name=name,
+            **kwargs,
+        )
+
+    def blobs(self):
+        blob_dir = os.path.join(self.media_root, "blobs")
+        return sorted(name for _, _, names in os.walk(blob_dir) for name in names)
+
+    def test_duplicates_share_one_file(self):
+        first = self.attach("photo.png", b"pixels")
+        second = self.attach("copy.PNG", b"pixels")
+        self.assertEqual(first.file.name, second.file.name)
+        self.assertEqual(second.filename, "copy.PNG")
+        self.assertEqual(Blob.objects.get().references, 2)
+        self.assertEqual(len(self.blobs()), 1)
+
+        self.bob.profile.image = SimpleUploadedFile("avatar.png", b"pixels")
+        self.bob.profile.save()
+        self.assertEqual(self.bob.profile.image.name, first.file.name)
+        self.assertEqual(Blob.objects.get().references, 3)
+
+    def test_last_reference_deletes_the_file(self):
+        first = self.attach("notes.txt", b"notes")
+        second = self.attach("notes.txt", b"notes")
+        with self.captureOnCommitCallbacks(execute=True):
+            first.delete()
+        self.assertEqual(Blob.objects.get().references, 1)
+        self.assertTrue(second.file.storage.exists(second.file.name))
+        with self.captureOnCommitCallbacks(execute=True):
+            second.delete()
+        self.assertFalse(Blob.objects.exists())
+        self.assertEqual(self.blobs(), [])
+
+    def test_archived_messages_keep_their_files(self):
+        message = self.attach("notes.txt", b"notes", created=timezone.now() - timedelta(days=100))
+        archive.archive_room(self.public_chat, timezone.now() - timedelta(days=30))
+        self.assertFalse(GroupMessage.objects.exists())
+        self.assertEqual(self.blobs(), [os.path.basename(message.file.name)])
+
+        self.client.force_login(self.alice)
+        response = self.client.get(reverse("chat_home"))
+        (archived,) = response.context["chat_messages"]
+        self.assertEqual(archived.filename, "notes.txt")
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.public_chat.delete()
+        self.assertEqual(self.blobs(), [])
+
+    @override_settings(CHAT_UPLOAD_CHUNK_SIZE=4)
+    def test_uploads_are_deduplicated_by_the_bytes_received(self):
+        message = self.attach("photo.png", b"pixels")
+        self.client.force_login(self.bob)
+        url = reverse("chat-upload-start", args=[self.public_chat.group_name])
+        sha256 = hashlib.sha256(b"pixels").hexdigest()
+        # Knowing the digest is not enough: the bytes must be sent
+        response = self.client.post(url, {"filename": "again.png", "size": 6, "sha256": sha256})
+        self.assertNotIn("complete", response.json())
+        self.assertFalse(GroupMessage.objects.filter(author=self.bob).exists())
+
+        upload_id = response.json()["id"]
+        for offset in (0, 4):
+            self.client.patch(
+                f"{url}{upload_id}",
+                b"pixels"[offset : offset + 4],
+                content_type="application/octet-stream",
+                headers={"Upload-Offset": offset},
+            )
+        self.client.post(f"{url}{upload_id}/finalize")
+        copy = GroupMessage.objects.get(author=self.bob)
+        self.assertEqual(copy.file.name, message.file.name)
+        self.assertEqual(copy.filename, "again.png")
+        self.assertEqual(Blob.objects.get().references, 2)
+
+    def test_dedupe_media(self):
+        legacy = FileSystemStorage()
+        for name in ("files/photo.png", "avatars/photo.png"):
+            legacy.save(name, ContentFile(b"pixels"))
+        GroupMessage.objects.create(
+            group=self.public_chat, author=self.alice, file="files/photo.png"
+        )
+        self.bob.profile.image = "avatars/photo.png"
+        self.bob.profile.save()
+
+        call_command("dedupe_media", stdout=StringIO())
+        message = GroupMessage.objects.get()
+        self.assertEqual(message.filename, "photo.png")
+        self.bob.profile.refresh_from_db()
+        self.assertEqual(self.bob.profile.image.name, message.file.name)
+        self.assertEqual(Blob.objects.get().references, 2)
+        self.assertFalse(legacy.exists("files/photo.png"))
+        self.assertFalse(legacy.exists("avatars/photo.png"))
+
+
+def png(width, height):
+    data = io.BytesIO()
+    Image.new("RGB", (width, height), "teal").save(data, "PNG")
+    return data.getvalue()
+
+
+@override_settings(CHAT_THUMBNAIL_WORKERS=0)
+class ThumbnailTests(ChatTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client.force_login(self.alice)
+
+    def upload(self, name, data):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(
+                reverse("chat-file-upload", args=["public-chat"]),
+                {"file": SimpleUploadedFile(name, data)},
+                headers={"HX-Request": "true"},
+            )
+        return GroupMessage.objects.get(file_name=name)
+
+    def test_variants_of_a_large_image(self):
+        message = self.upload("photo.png", png(2000, 1000))
+        self.assertEqual((message.image_width, message.image_height), (2000, 1000))
+        self.assertEqual(message.mime_type, "image/png")
+        self.assertEqual([width for width, _, _ in message.variants], [320, 640, 1280])
+        for width, height, name in message.variants:
+            with Image.open(message.file.storage.path(name)) as variant:
+                self.assertEqual(variant.size, (width, height))
+
+        html = self.client.get(reverse("chat_home")).content.decode()
+        self.assertIn('width="2000" height="1000"', html)
+        self.assertIn('loading="lazy"', html)
+        self.assertIn(f"{message.file.url} 2000w", html)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            message.delete()
+        self.assertEqual(os.listdir(os.path.dirname(message.file.path)), [])
+
+    def test_archived_images_keep_their_variants(self):
+        message = self.upload("photo.png", png(2000, 1000))
+        GroupMessage.objects.update(created=timezone.now() - timedelta(days=100))
+        archive.archive_room(self.public_chat, timezone.now() - timedelta(days=30))
+        self.assertFalse(GroupMessage.objects.exists())
+
+        html = self.client.get(reverse("chat_home")).content.decode()
+        self.assertIn('width="2000" height="1000"', html)
+        self.assertIn(f"{message.file.url} 2000w", html)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.public_chat.delete()
+        self.assertEqual(os.listdir(os.path.dirname(message.file.path)), [])
+
+    def test_small_images_have_no_variants(self):
+        message = self.upload("icon.png", png(100, 50))
+        self.assertEqual(message.image_width, 100)
+        self.assertEqual(message.variants, [])
+        self.assertEqual(message.srcset, "")
+
+    def test_unreadable_images_stay_attachments(self):
+        with self.assertLogs("chat_site.thumbnails", "ERROR"):
+            message = self.upload("broken.png", b"not a png")
+        self.assertEqual(message.mime_type, "")
+
+    async def test_viewers_get_the_variants(self):
+        socket = await self.connect(self.bob, "/ws/chatroom/public-chat")
+        await self.drain(socket)
+        await database_sync_to_async(self.upload)("photo.png", png(800, 600))
+        self.assertIn("photo.png", await socket.receive_from())
+        html = await socket.receive_from()
+        self.assertIn('hx-swap-oob="true"', html)
+        self.assertIn("320w", html)
+        await socket.disconnect()
+
+    def test_only_the_files_variants_are_deleted(self):
+        legacy = FileSystemStorage()
+        for name in ("files/report.png", "files/report.w320.webp", "files/report.week1.pdf"):
+            legacy.save(name, ContentFile(b"data"))
+
+        content_store.delete("files/report.png")
+
+        self.assertEqual(os.listdir(os.path.join(self.media_root, "files")), ["report.week1.pdf"])
+
+    @override_settings(CHAT_THUMBNAIL_WORKERS=1)
+    def test_process_pool(self):
+        path = os.path.join(self.media_root, "photo.png")
+        with open(path, "wb") as f:
+            f.write(png(700, 700))
+        self.use_pool()
+        output = os.path.join(self.media_root, "photo.w320.webp")
+        future = thumbnails.pool().submit(thumbnails.render_variants, path, [(320, output)])
+        self.assertEqual(future.result(timeout=30), (700, 700, "image/png", [(320, 320, output)]))
+
+    @override_settings(CHAT_THUMBNAIL_WORKERS=1)
+    async def test_pool_results_are_broadcast_from_the_server_loop(self):
+        self.use_pool()
+        socket = await self.connect(self.bob, "/ws/chatroom/public-chat")
+        await self.drain(socket)
+
+        with mock.patch.object(thumbnails, "finish", wraps=thumbnails.finish) as finish:
+            await database_sync_to_async(self.upload)("photo.png", png(800, 600))
+            self.assertIn("photo.png", await socket.receive_from())
+            # Comes as soon as the pool is done, without anything else waking the loop
+            html = await socket.receive_from(timeout=30)
+
+        self.assertIn("320w", html)
+        finish.assert_awaited_once()  # on this loop, not the pool's thread
+        self.assertEqual(thumbnails._tasks, set())
+        message = await GroupMessage.objects.aget(file_name="photo.png")
+        self.assertEqual(message.image_width, 800)
+        await socket.disconnect()
+
+    def use_pool(self):
+        def shutdown():
+            if thumbnails._pool is not None:
+                thumbnails._pool.shutdown()
+                thumbnails._pool = None
+
+        self.addCleanup(shutdown)
+
+
+class FileHandlerTests(ChatTestCase):
+    def setUp(self):
+        super().setUp()
+        self.name = content_store.save("report.pdf", ContentFile(b"0123456789"))
+        self.url = content_store.url(self.name)
+
+    async def get(self, url, method="GET", **headers):
+        async def django(scope, receive, send):
+            await send({"type": "http.response.start", "status": 404, "headers": []})
+            await send({"type": "http.response.body", "body": b"django"})
+
+        communicator = HttpCommunicator(
+            files.FileHandler(django),
+            method,
+            url,
+            headers=[
+                (key.replace("_", "-").encode(), value.encode()) for key, value in headers.items()
+            ],
+        )
+        response = await communicator.get_response()
+        response["headers"] = {key.decode(): value.decode() for key, value in response["headers"]}
+        return response
+
+    async def test_serves_signed_media(self):
+        response = await self.get(self.url)
+        self.assertEqual(response["status"], 200)
+        self.assertEqual(response["body"], b"0123456789")
+        self.assertEqual(response["headers"]["content-type"], "application/pdf")
+        self.assertIn("immutable", response["headers"]["cache-control"])
+
+        unsigned = await self.get(self.url.split("?")[0])
+        self.assertEqual(unsigned["body"], b"django")
+        escape = await self.get(f"/media/../core/settings.py?s={url_signature('../core/settings.py')}")
+        self.assertEqual(escape["status"], 404)
+
+    async def test_conditional_requests(self):
+        response = await self.get(self.url)
+        etag, modified = response["headers"]["etag"], response["headers"]["last-modified"]
+        self.assertEqual((await self.get(self.url, if_none_match=etag))["status"], 304)
+        self.assertEqual((await self.get(self.url, if_modified_since=modified))["status"], 304)
+        stale = http_date(0)
+        self.assertEqual((await self.get(self.url, if_modified_since=stale))["status"], 200)
+
+    async def test_range_requests(self):
+        response = await self.get(self.url, range="bytes=2-5")
+        self.assertEqual(response["status"], 206)
+        self.assertEqual(response["body"], b"2345")
+        self.assertEqual(response["headers"]["content-range"], "bytes 2-5/10")
+        self.assertEqual((await self.get(self.url, range="bytes=-3"))["body"], b"789")
+        self.assertEqual((await self.get(self.url, range="bytes=10-"))["status"], 416)
+
+        etag = (await self.get(self.url, method="HEAD"))["headers"]["etag"]
+        resumed = await self.get(self.url, range="bytes=8-", if_range=etag)
+        self.assertEqual(resumed["body"], b"89")
+        changed = await self.get(self.url, range="bytes=8-", if_range='"other"')
+        self.assertEqual((changed["status"], changed["body"]), (200, b"0123456789"))
+
+    @mock.patch.object(files, "CHUNK_SIZE", 4)
+    async def test_streams_in_chunks(self):
+        response = await self.get(self.url, range="bytes=1-")
+        self.assertEqual(response["body"], b"123456789")
+
+    @override_settings(DEBUG=True)
+    async def test_serves_static_files(self):
+        response = await self.get("/static/images/avatar.svg")
+        self.assertEqual(response["status"], 200)
+        self.assertEqual(response["headers"]["content-type"], "image/svg+xml")
+
+
+@override_settings(
+    CHAT_RATE_LIMITS={
+        "message": {"user": (1, 2), "room": (10, 3)},
+        "upload": {"user": (1, 1), "room": (1, 10)},
+    }
+)
+class RateLimitTests(ChatTestCase):
+    def test_token_buckets(self):
+        now = [0.0]
+        limiter = RateLimiter(clock=lambda: now[0])
+        self.assertEqual(limiter.take("message", self.alice.id, "room"), 0)
+        self.assertEqual(limiter.take("message", self.alice.id, "room"), 0)
+        self.assertAlmostEqual(limiter.take("message", self.alice.id, "room"), 1)
+        # The room's burst of 3 is shared, and a refused take costs nothing
+        self.assertEqual(limiter.take("message", self.bob.id, "room"), 0)
+        self.assertAlmostEqual(limiter.take("message", self.bob.id, "room"), 0.1)
+        now[0] = 1.0
+        self.assertEqual(limiter.take("message", self.alice.id, "room"), 0)
+
+    async def test_flooding_messages_are_dropped(self):
+        socket = await self.connect(self.alice, "/ws/chatroom/public-chat")
+        await self.drain(socket)
+        for i in range(3):
+            await socket.send_json_to({"body": f"flood {i}"})
+        html = ""
+        while "rate-limit-notice" not in html:
+            html = await socket.receive_from()
+        self.assertIn("try again in 1s", html)
+        await self.drain(socket)
+        self.assertEqual(await GroupMessage.objects.filter(author=self.alice).acount(), 2)
+        await socket.disconnect()
+
+    def test_uploads_are_limited(self):
+        self.client.force_login(self.alice)
+        url = reverse("chat-file-upload", args=["public-chat"])
+        for status in (200, 429):
+            response = self.client.post(
+                url,
+                {"file": SimpleUploadedFile("notes.txt", b"notes")},
+                headers={"HX-Request": "true"},
+            )
+            self.assertEqual(response.status_code, status)
+        self.assertEqual(response["Retry-After"], "1")
+
+
+@override_settings(CHANNEL_LAYERS=SERIALIZING_LAYERS, CHAT_PRESENCE_BATCH_INTERVAL=0)
+class ReplayTests(ChatTestCase):
+    async def send_messages(self, *bodies):
+        alice = await self.connect(self.alice, "/ws/chatroom/public-chat")
+        await self.drain(alice)
+        for body in bodies:
+            await alice.send_json_to({"body": body})
+            await alice.receive_from()
+        await alice.disconnect()
+
+    async def resume(self, last_seq):
+        bob = await self.connect(self.bob, f"/ws/chatroom/public-chat?last_seq={last_seq}")
+        frames = []
+        while not await bob.receive_nothing(timeout=0.2):
+            frames.append(await bob.receive_from())
+        await bob.disconnect()
+        presence = ("online-count", "member-status")
+        return [frame for frame in frames if not any(id in frame for id in presence)]
+
+    def test_messages_are_numbered_per_room(self):
+        first = GroupMessage.objects.create(group=self.public_chat, author=self.alice, body="a")
+        second = GroupMessage.objects.create(group=self.public_chat, author=self.bob, body="b")
+        other = GroupMessage.objects.create(group=self.online_status, author=self.bob, body="c")
+
+        self.assertEqual((first.seq, second.seq, other.seq), (1, 2, 1))
+        self.public_chat.refresh_from_db()
+        self.assertEqual(self.public_chat.last_seq, 2)
+
+    async def test_missed_messages_are_replayed_from_the_buffer(self):
+        await self.send_messages("one", "two", "three")
+
+        with mock.patch("chat_site.consumers.stored_events") as stored_events:
+            frames = await self.resume(last_seq=1)
+
+        stored_events.assert_not_called()
+
+        self.assertEqual(len(frames), 2)
+        self.assertIn("two", frames[0])
+        self.assertIn("three", frames[1])
+        self.assertIn('data-seq="3"', frames[1])
+
+    async def test_missed_messages_are_replayed_from_the_database(self):
+        await self.send_messages("one", "two", "three")
+        room_logs.clear()  # another process, or a restart
+
+        frames = await self.resume(last_seq=1)
+
+        self.assertEqual(len(frames), 2)
+        self.assertIn("two", frames[0])
+        self.assertIn("@alice", frames[1])  # rendered for bob
+
+    @override_settings(CHAT_REPLAY_LIMIT=1)
+    async def test_long_gap_reloads_the_page(self):
+        await self.send_messages("one", "two", "three")
+
+        frames = await self.resume(last_seq=1)
+
+        self.assertEqual(len(frames), 1)
+        self.assertIn("location.reload()", frames[0])
+
+    async def test_fresh_page_replays_nothing(self):
+        await self.send_messages("one")
+
+        self.assertEqual(await self.resume(last_seq=1), [])
+
+    def test_room_log_needs_the_whole_gap(self):
+        log = RoomLog(size=3)
+        for seq in [1, 2, 4, 5]:
+            log.add(seq, {"seq": seq})
+
+        self.assertEqual(log.seqs, [2, 4, 5])
+        self.assertEqual(log.between(3, 5), [{"seq": 4}, {"seq": 5}])
+        self.assertIsNone(log.between(2, 5))  # 3 was never logged
+        self.assertIsNone(log.between(0, 2))  # 1 was evicted
+
+    @override_settings(CHAT_REPLAY_MAX_BYTES=100)
+    def test_room_logs_are_bounded_in_bytes(self):
+        logs = RoomLogs()
+
+        def event(seq):
+            return {"seq": seq, "html": {"own": "x" * 10, "other": "x" * 10}, "record": "x" * 5}
+
+        for seq in range(1, 4):
+            logs.get("quiet").add(seq, event(seq))
+        for seq in range(1, 3):
+            logs.get("busy").add(seq, event(seq))
+
+        # The least recently used room gives up its oldest events first
+        self.assertEqual(logs.bytes, 100)
+        self.assertEqual(logs.logs["quiet"].seqs, [2, 3])
+        self.assertEqual(logs.logs["busy"].seqs, [1, 2])
+        logs.get("busy").add(3, event(3))
+        self.assertEqual(logs.logs["quiet"].seqs, [3])
+        self.assertEqual(logs.logs["busy"].seqs, [1, 2, 3])
+        self.assertLessEqual(logs.bytes, 100)
+
+
+class CacheTests(ChatTestCase):
+    def setUp(self):
+        super().setUp()
+        self.room = ChatGroup.objects.create(groupchat_name="Team", admin=self.alice)
+        self.room.members.add(self.alice)
+
+    def test_rooms_and_members_are_cached(self):
+        cache.member_ids(cache.get_room(self.room.group_name))
+
+        with self.assertNumQueries(0):
+            room = cache.get_room(self.room.group_name)
+            self.assertEqual(room.groupchat_name, "Team")
+            self.assertEqual(cache.member_ids(room), {self.alice.id})
+
+    def test_membership_changes_are_seen(self):
+        self.assertEqual(cache.member_ids(self.room), {self.alice.id})
+
+        self.room.members.add(self.bob)
+        self.assertEqual(cache.member_ids(self.room), {self.alice.id, self.bob.id})
+        self.alice.chat_groups.remove(self.room)
+        self.assertEqual(cache.member_ids(self.room), {self.bob.id})
+        self.bob.chat_groups.clear()
+        self.assertEqual(cache.member_ids(self.room), set())
+
+    def test_room_changes_are_seen(self):
+        cache.get_room(self.room.group_name)
+
+        self.room.groupchat_name = "Renamed"
+        self.room.save()
+        self.assertEqual(cache.get_room(self.room.group_name).groupchat_name, "Renamed")
+        self.room.delete()
+        with self.assertRaises(ChatGroup.DoesNotExist):
+            cache.get_room(self.room.group_name)
+
+    def test_saving_a_cached_room_keeps_its_last_seq(self):
+        GroupMessage.objects.create(group=self.room, author=self.alice, body="hi")
+        room = cache.get_room(self.room.group_name)
+
+        room.groupchat_name = "Renamed"
+        room.save()
+
+        self.room.refresh_from_db()
+        self.assertEqual(self.room.last_seq, 1)
+
+    def test_joining_needs_a_verified_email(self):
+        email = EmailAddress.objects.create(user=self.bob, email=self.bob.email, primary=True)
+        self.client.force_login(self.bob)
+        url = reverse("chatroom", args=[self.room.group_name])
+
+        self.assertRedirects(self.client.get(url), reverse("profile-settings"))
+        email.verified = True
+        email.save()
+        self.assertEqual(self.client.get(url).status_code, 200)
+        self.assertIn(self.bob.id, cache.member_ids(self.room))
+
+
+class ModerationTests(ChatTestCase):
+    def setUp(self):
+        super().setUp()
+        self.users = [User.objects.create_user(f"user{i}") for i in range(30)]
+        self.room = ChatGroup.objects.create(groupchat_name="Team", admin=self.alice)
+        self.room.members.add(self.alice, self.bob, *self.users)
+        self.url = reverse("chatroom-moderate", args=[self.room.group_name])
+        self.client.force_login(self.alice)
+
+    def moderate(self, action, users):
+        return self.client.post(
+            self.url, {"action": action, "user_ids": [user.id for user in users]}
+        )
+
+    def test_removal_takes_the_same_queries_for_any_number_of_members(self):
+        with CaptureQueriesContext(connection) as one:
+            moderation.remove_members(self.room, [self.users[0].id], ban=True)
+        with CaptureQueriesContext(connection) as many:
+            moderation.remove_members(self.room, [u.id for u in self.users[1:]], ban=True)
+
+        self.assertEqual(len(one), len(many))
+        self.assertEqual(self.room.members.count(), 2)
+        self.assertEqual(ChatBan.objects.filter(group=self.room).count(), 30)
+
+    def test_edit_page_removes_and_bans(self):
+        response = self.client.post(
+            reverse("edit-chatroom", args=[self.room.group_name]),
+            {
+                "groupchat_name": "Team",
+                "remove_members": [self.bob.id, self.users[0].id],
+                "ban_members": "on",
+            },
+        )
+
+        self.assertRedirects(response, reverse("chatroom", args=[self.room.group_name]))
+        self.assertNotIn(self.bob, self.room.members.all())
+        self.assertEqual(cache.banned_ids(self.room), {self.bob.id, self.users[0].id})
+
+    def test_admin_is_never_removed(self):
+        response = self.moderate("kick", [self.alice, self.bob])
+
+        self.assertEqual(response.json()["user_ids"], [self.bob.id])
+        self.assertIn(self.alice, self.room.members.all())
+
+    def test_only_the_admin_moderates(self):
+        self.client.force_login(self.bob)
+        self.assertEqual(self.moderate("kick", self.users).status_code, 404)
+        self.assertEqual(self.room.members.count(), 32)
+
+    async def test_removed_members_sockets_are_closed(self):
+        path = f"/ws/chatroom/{self.room.group_name}"
+        alice = await self.connect(self.alice, path)
+        bob = await self.connect(self.bob, path)
+        await self.drain(alice, bob)
+
+        @database_sync_to_async
+        def kick():
+            with self.captureOnCommitCallbacks(execute=True):
+                self.moderate("kick", [self.bob])
+
+        await kick()
+
+        while (output := await bob.receive_output())["type"] != "websocket.close":
+            pass
+        self.assertEqual(output["code"], moderation.REMOVED_CLOSE_CODE)
+        self.assertTrue(await alice.receive_nothing())  # only bob's socket closes
+        await alice.disconnect()
+        await bob.disconnect()
+
+    async def test_banned_members_cannot_rejoin(self):
+        @database_sync_to_async
+        def ban_and_visit():
+            self.moderate("ban", [self.bob])
+            self.client.force_login(self.bob)
+            return self.client.get(reverse("chatroom", args=[self.room.group_name]))
+
+        self.assertEqual((await ban_and_visit()).status_code, 404)
+        communicator = WebsocketCommunicator(
+            URLRouter(routing.websocket_urlpatterns), f"/ws/chatroom/{self.room.group_name}"
+        )
+        communicator.scope["user"] = self.bob
+        connected, _ = await communicator.connect()
+        self.assertFalse(connected)
+
+    @override_settings(CHAT_UPLOAD_CHUNK_SIZE=4)
+    def test_removed_members_cannot_upload(self):
+        start = reverse("chat-upload-start", args=[self.room.group_name])
+        self.client.force_login(self.bob)
+        upload_id = self.client.post(start, {"filename": "a.txt", "size": 2}).json()["id"]
+        self.client.force_login(self.alice)
+        self.moderate("ban", [self.bob])
+
+        self.client.force_login(self.bob)
+        response = self.client.post(
+            reverse("chat-file-upload", args=[self.room.group_name]),
+            {"file": SimpleUploadedFile("notes.txt", b"notes")},
+            headers={"HX-Request": "true"},
+        )
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(self.client.post(start, {"filename": "a.txt", "size": 2}).status_code, 404)
+        chunk = reverse("chat-upload-chunk", args=[self.room.group_name, upload_id])
+        self.assertEqual(self.client.head(chunk).status_code, 404)
+        self.assertEqual(self.client.post(f"{chunk}/finalize").status_code, 404)
+        self.assertFalse(GroupMessage.objects.filter(group=self.room).exists())
+
+    def test_unbanned_members_can_rejoin(self):
+        EmailAddress.objects.create(
+            user=self.bob, email=self.bob.email, primary=True, verified=True
+        )
+        self.moderate("ban", [self.bob])
+        self.moderate("unban", [self.bob])
+
+        self.client.force_login(self.bob)
+        response = self.client.get(reverse("chatroom", args=[self.room.group_name]))
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(self.bob, self.room.members.all())
+
+
+class UnixSocketChannelLayerTests(TestCase):
+    """Two workers in one process, each with a layer of its own."""
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path, ignore_errors=True)
+
+    @contextlib.asynccontextmanager
+    async def layers(self, count, **config):
+        layers = [UnixSocketChannelLayer(self.path, **config) for _ in range(count)]
+        try:
+            yield layers
+        finally:
+            for layer in layers:
+                await layer.close()
+
+    async def test_group_send_reaches_other_workers(self):
+        async with self.layers(2) as (first, second):
+            channels = [await first.new_channel(), await second.new_channel()]
+            for layer, channel in zip([first, second], channels):
+                await layer.group_add("room", channel)
+
+            await first.group_send("room", {"type": "hello", "n": 1})
+
+            received = [
+                await asyncio.wait_for(layer.receive(channel), 1)
+                for layer, channel in zip([first, second], channels)
+            ]
+        self.assertEqual(received, [{"type": "hello", "n": 1}] * 2)
+
+    async def test_send_goes_to_the_owner(self):
+        async with self.layers(2) as (first, second):
+            channel = await second.new_channel()
+
+            await first.send(channel, {"type": "direct"})
+
+            received = await asyncio.wait_for(second.receive(channel), 1)
+        self.assertEqual(received, {"type": "direct"})
+
+    async def test_capacity_is_per_channel(self):
+        async with self.layers(2, capacity=1) as (first, second):
+            channel = await second.new_channel()
+            await second.group_add("room", channel)
+
+            await second.send(channel, {"type": "one"})
+            with self.assertRaises(ChannelFull):
+                await second.send(channel, {"type": "two"})
+            await first.group_send("room", {"type": "three"})  # dropped by the owner
+            await asyncio.sleep(0.05)
+
+            self.assertEqual(await second.receive(channel), {"type": "one"})
+            with self.assertRaises(asyncio.TimeoutError):
+                await asyncio.wait_for(second.receive(channel), 0.05)
+
+    async def test_dead_workers_are_forgotten(self):
+        stale = os.path.join(self.path, "w1x0.sock")
+        with socket.socket(socket.AF_UNIX) as sock:
+            sock.bind(stale)  # bound, never listening: refuses connections
+
+        async with self.layers(1) as (layer,):
+            await layer.group_send("room", {"type": "hello"})
+
+        self.assertFalse(os.path.exists(stale))
+
+
+class SendQueueTests(TestCase):
+    async def test_slow_reader(self):
+        unblock = asyncio.Event()
+        sent, closed = [], []
+
+        async def send(message):
+            await unblock.wait()
+            sent.append(message)
+
+        async def overflow():
+            closed.append(True)
+
+        queue = SendQueue(send, overflow, maxsize=3)
+        await queue.put("m1")
+        await asyncio.sleep(0)  # the writer takes m1 and blocks on it
+        for frame in ("p1", "m2", "p2"):
+            await queue.put(frame, presence=frame.startswith("p"))
+        # Full: the oldest presence update makes way for a message
+        await queue.put("m3")
+        self.assertEqual([frame for _, frame in queue.frames], ["m2", "p2", "m3"])
+        await queue.put("m4")
+        # Only messages left: presence updates are dropped, messages overflow
+        await queue.put("p3", presence=True)
+        self.assertEqual((queue.dropped, closed), (3, []))
+        await queue.put("m5")
+        self.assertEqual(closed, [True])
+
+        # The connection is closing: nothing more is written
+        unblock.set()
+        await asyncio.sleep(0)
+        self.assertEqual((sent, len(queue.frames)), ([], 0))
+
+    async def test_frames_are_sent_in_order(self):
+        sent = []
+
+        async def send(message):
+            sent.append(message)
+
+        queue = SendQueue(send, None, maxsize=10)
+        for i in range(5):
+            await queue.put(i)
+        await asyncio.sleep(0)
+        self.assertEqual(sent, [0, 1, 2, 3, 4])
+        queue.close()
+
+    async def test_named_presence_updates_collapse(self):
+        queue = SendQueue(None, None, maxsize=10)
+        queue.close()  # nothing is written, the frames stay queued
+        await queue.put("count 1", presence="online_count")
+        await queue.put("m1")
+        await queue.put("count 2", presence="online_count")
+        await queue.put("status", presence="online_status")
+
+        self.assertEqual([frame for _, frame in queue.frames], ["m1", "count 2", "status"])
+        self.assertEqual(queue.dropped, 0)
+
+    async def test_bursts_are_coalesced(self):
+        sent = []
+
+        async def send(message):
+            sent.append(message["text"])
+
+        def text(data):
+            return {"type": "websocket.send", "text": data}
+
+        queue = SendQueue(send, None, maxsize=10, window=0.01, max_bytes=16)
+        for frame in ["<p>1</p>", "<p>2</p>", "<p>3</p>", '{"a":1}', '{"b":2}']:
+            await queue.put(text(frame))
+        await asyncio.sleep(0.05)
+        queue.close()
+
+        # Fragments and records are joined apart, up to max_bytes per frame
+        self.assertEqual(sent, ["<p>1</p>\n<p>2</p>", "<p>3</p>", '[{"a":1},{"b":2}]'])
@@ -0,0 +1,179 @@
+"""
+Sized variants of image attachments.
+
+Once a message with a raster image is committed, a job on a process pool
+(``CHAT_THUMBNAIL_WORKERS`` processes, or inline when 0) decodes it with
+Pillow and writes a WebP copy at each of ``VARIANT_WIDTHS`` narrower than
+the original, JPEG if this Pillow lacks WebP. The job stores the original's
+dimensions and MIME type and the variants on the message, then tells the
+room, whose sockets swap the ``<img>`` for one with a ``srcset``. The
+upload request only queues the job; its result is picked up on the
+server's event loop, never on the pool's own threads, since channel
+layers such as ``InMemoryChannelLayer`` are not thread-safe.
+
+Variants sit next to the file they were made from and are named after it,
+so a file shared by several messages has one set of variants, deleted by
+the store along with it. Animated GIFs and SVGs are served as they are.
+"""
+
+import asyncio
+import contextlib
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import transaction
+from PIL import Image, ImageOps, features
+
+from .events import attachment_event
+
+logger = logging.getLogger(__name__)
+
+VARIANT_WIDTHS = (320, 640, 1280)
+RASTER_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp")
+
+# Every extension variants may have been written with, for deleting them
+VARIANT_EXTENSIONS = (".webp", ".jpg")
+
+if features.check("webp"):
+    VARIANT_FORMAT, VARIANT_EXTENSION = "WEBP", ".webp"
+else:
+    VARIANT_FORMAT, VARIANT_EXTENSION = "JPEG", ".jpg"
+
+_pool = None
+_tasks = set()  # running finish() tasks, which the loop only holds weakly
+
+
+def pool():
+    global _pool
+    if _pool is None:
+        # Spawned, not forked: the server's threads and connections stay behind
+        _pool = ProcessPoolExecutor(
+            max_workers=settings.CHAT_THUMBNAIL_WORKERS,
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+    return _pool
+
+
+def render_variants(path, outputs, image_format=VARIANT_FORMAT):
+    """
+    Write the variants of the image at ``path``: ``outputs`` is a list of
+    ``(width, output path)``, widths the image doesn't exceed are skipped
+    and existing outputs reused. Runs in the pool, without Django.
+
+    Returns ``(width, height, MIME type, [(width, height, output path)])``.
+    """
+    with Image.open(path) as original:
+        mime_type = original.get_format_mimetype()
+        image = ImageOps.exif_transpose(original)
+        width, height = image.size
+        has_alpha = "A" in image.getbands() or "transparency" in image.info
+        variants = []
+        for target, output in outputs:
+            if target >= width:
+                continue
+            target_height = max(1, round(height * target / width))
+            if not os.path.exists(output):
+                mode = "RGBA" if has_alpha and image_format != "JPEG" else "RGB"
+                variant = image.convert(mode).resize(
+                    (target, target_height), Image.Resampling.LANCZOS
+                )
+                partial = f"{output}.partial"
+                variant.save(partial, image_format, quality=80)
+                os.replace(partial, output)
+            variants.append((target, target_height, output))
+    return width, height, mime_type, variants
+
+
+def queue_variants(message):
+    """Make the variants of ``message``'s image in the background once it is committed."""
+    if message.file and message.filename.lower().endswith(RASTER_EXTENSIONS):
+        transaction.on_commit(lambda: submit(message))
+
+
+def submit(message):
+    storage = message.file.storage
+    outputs = [
+        (width, storage.path(storage.variant_name(message.file.name, width, VARIANT_EXTENSION)))
+        for width in VARIANT_WIDTHS
+    ]
+    args = (storage.path(message.file.name), outputs)
+    if not settings.CHAT_THUMBNAIL_WORKERS:
+        with logged_failures(message):
+            broadcast_variants(message, save_variants(message, render_variants(*args)))
+        return
+    future = pool().submit(render_variants, *args)
+    loop = server_loop()
+    if loop is None:
+        # No server to hand the result to (a management command): wait for it
+        with logged_failures(message):
+            broadcast_variants(message, save_variants(message, future.result()))
+        return
+    loop.call_soon_threadsafe(start_finish, message, future)
+
+
+async def _running_loop():
+    return asyncio.get_running_loop()
+
+
+def server_loop():
+    """The event loop this sync thread serves, or None if there is none."""
+    loop = async_to_sync(_running_loop)()
+    # Without one, async_to_sync ran on a loop of its own, closed since
+    return None if loop.is_closed() else loop
+
+
+def start_finish(message, future):
+    task = asyncio.create_task(finish(message, future))
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+
+
+async def finish(message, future):
+    """Store the pool's result and tell the room, on the server's loop."""
+    with logged_failures(message):
+        result = await asyncio.wrap_future(future)
+        event = await database_sync_to_async(save_variants)(message, result)
+        if event is not None:
+            await get_channel_layer().group_send(message.group.group_name, event)
+
+
+@contextlib.contextmanager
+def logged_failures(message):
+    # An image Pillow can't read is still a valid attachment
+    try:
+        yield
+    except Exception:
+        logger.exception("Could not make the variants of message %s", message.id)
+
+
+def save_variants(message, result):
+    """
+    Save the job's ``result`` on ``message``. Returns the ``attachment_handler``
+    event for the room, or None if the message is gone.
+    """
+    from .models import GroupMessage
+
+    message.image_width, message.image_height, message.mime_type, variants = result
+    storage = message.file.storage
+    message.variants = [
+        [width, height, storage.variant_name(message.file.name, width, VARIANT_EXTENSION)]
+        for width, height, _ in variants
+    ]
+    updated = GroupMessage.objects.filter(id=message.id).update(
+        image_width=message.image_width,
+        image_height=message.image_height,
+        mime_type=message.mime_type,
+        variants=message.variants,
+    )
+    return attachment_event(message) if updated else None
+
+
+def broadcast_variants(message, event):
+    if event is not None:
+        async_to_sync(get_channel_layer().group_send)(message.group.group_name, event)
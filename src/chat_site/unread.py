@@ -0,0 +1,78 @@
+"""
+Read cursors and unread counts.
+
+Every member of a chat has a ``ReadCursor``: the id of the newest message
+they have seen there, starting at the newest message when they join.
+Message ids are time-ordered, so a chat's unread messages are the ones
+with a greater id, counted as a range of the ``groupmessage_group_id``
+index. The header annotates the counts of all the user's chats onto the
+query that lists them (``ChatGroup.objects.with_unread_counts``).
+
+``ChatroomConsumer`` advances the cursor of the user viewing a chat: to the
+newest message when the socket opens, then to the newest message it
+delivered, written at most every ``CHAT_READ_CURSOR_INTERVAL`` seconds and
+when the socket closes. Each write is followed by an ``unread_handler``
+event to the user's online-status sockets with the exact count.
+
+Between writes the ``OnlineStatusConsumer`` keeps the badges current
+without queries: every message is announced to the status group of its
+room and counted by the members who aren't the author and aren't viewing
+the room.
+"""
+
+from django.db.models import Max
+
+from .models import ChatGroup, GroupMessage, ReadCursor
+
+
+def create_read_cursors(pairs):
+    """Create cursors at the newest message for ``(member id, group id)`` pairs."""
+    group_ids = {group_id for _, group_id in pairs}
+    latest = dict(
+        GroupMessage.objects.filter(group_id__in=group_ids)
+        .values("group")
+        .annotate(latest=Max("id"))
+        .values_list("group", "latest")
+    )
+    ReadCursor.objects.bulk_create(
+        [
+            ReadCursor(member_id=member_id, group_id=group_id, last_read_id=latest.get(group_id, 0))
+            for member_id, group_id in pairs
+        ],
+        ignore_conflicts=True,
+    )
+
+
+def advance_read_cursor(member_id, group_id, message_id=None):
+    """
+    Move the member's cursor forward to ``message_id`` (never back), or to
+    the chat's newest message.
+
+    Returns ``(last read id, messages still unread)``, or None if the cursor
+    didn't move: the member has no cursor there or already read further.
+    """
+    if message_id is None:
+        message_id = (
+            GroupMessage.objects.filter(group_id=group_id)
+            .order_by("-id")
+            .values_list("id", flat=True)
+            .first()
+        )
+        if message_id is None:
+            return None
+    moved = ReadCursor.objects.filter(
+        member_id=member_id, group_id=group_id, last_read_id__lt=message_id
+    ).update(last_read_id=message_id)
+    if not moved:
+        return None
+    return message_id, GroupMessage.objects.filter(group_id=group_id, id__gt=message_id).count()
+
+
+def unread_counts(user):
+    """``{room: (last read id, unread count)}`` for the chats ``user`` is a member of."""
+    return {
+        room: (last_read_id or 0, unread_count)
+        for room, last_read_id, unread_count in ChatGroup.objects.filter(members=user)
+        .with_unread_counts(user)
+        .values_list("group_name", "last_read_id", "unread_count")
+    }
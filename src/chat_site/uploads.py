@@ -0,0 +1,184 @@
+"""
+Chunked, resumable attachment uploads.
+
+The protocol, all under ``/chat/upload/<room>/``:
+
+``POST <room>/`` with ``filename`` and ``size``
+    Starts an upload and returns ``{"id", "offset", "chunk_size"}``. Files
+    over ``CHAT_UPLOAD_MAX_SIZE`` are refused (413) before a byte is sent.
+``PATCH <room>/<id>`` with an ``Upload-Offset`` header and the chunk as body
+    Appends at most ``CHAT_UPLOAD_CHUNK_SIZE`` bytes at that offset and
+    returns the new ``Upload-Offset``. A wrong offset gets 409 and the
+    server's offset, so the client can resume from it.
+``HEAD <room>/<id>``
+    Returns the ``Upload-Offset`` to resume from after a dropped connection.
+``POST <room>/<id>/finalize``, optionally with the client's ``sha256``
+    Once every byte arrived, moves the file into storage, creates the
+    message and only then broadcasts it.
+
+Chunks are streamed from the request into a partial file next to the
+media files, so finalizing is a rename rather than a copy. The SHA-256 is
+updated as chunks arrive; if the process restarted mid-upload, the partial
+file is hashed once on the next request to catch up. Uploads untouched for
+``CHAT_UPLOAD_EXPIRY`` seconds are deleted.
+
+Content is only deduplicated (``chat_site.storage``) by the digest the
+server computed over the bytes it received: a digest sent by the client
+proves nothing about having the file, and would hand out any stored file
+to whoever knows or guesses its hash.
+"""
+
+import hashlib
+import os
+from datetime import timedelta
+from pathlib import Path
+
+from django.conf import settings
+from django.core.files import File
+from django.utils import timezone
+from django.utils.text import get_valid_filename
+
+from .models import ChunkedUpload, GroupMessage
+from .storage import content_store
+
+READ_SIZE = 64 * 1024
+
+
+class UploadError(Exception):
+    status = 400
+
+
+class UploadTooLarge(UploadError):
+    status = 413
+
+
+class OffsetMismatch(UploadError):
+    status = 409
+
+
+class UploadIncomplete(UploadError):
+    status = 409
+
+
+class PartialFile(File):
+    """A finished partial file, which FileSystemStorage moves instead of copying."""
+
+    def temporary_file_path(self):
+        return self.file.name
+
+
+# Running SHA-256 of each upload in this process: upload id -> (offset, hash)
+_hashes = {}
+
+
+def partial_path(upload):
+    return Path(settings.MEDIA_ROOT) / "partial" / str(upload.pk)
+
+
+def clean_filename(filename):
+    return get_valid_filename(os.path.basename(filename or "upload"))
+
+
+def start_upload(chat_group, author, filename, size):
+    """Register a new upload of ``size`` bytes, refusing oversized files up front."""
+    if size < 0:
+        raise UploadError("Invalid size")
+    if size > settings.CHAT_UPLOAD_MAX_SIZE:
+        raise UploadTooLarge(f"Files are limited to {settings.CHAT_UPLOAD_MAX_SIZE} bytes")
+    filename = clean_filename(filename)
+    expire_uploads()
+
+    upload = ChunkedUpload.objects.create(
+        group=chat_group, author=author, filename=filename, size=size
+    )
+    path = partial_path(upload)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.touch()
+    _hashes[upload.pk] = (0, hashlib.sha256())
+    return upload
+
+
+def write_chunk(upload, offset, stream, length):
+    """
+    Stream ``length`` bytes of ``stream`` into the upload at ``offset``.
+
+    Returns the new offset. Checked before reading the body: the offset
+    must be the one the server has, and the chunk must fit both
+    ``CHAT_UPLOAD_CHUNK_SIZE`` and the size announced at the start.
+    """
+    if offset != upload.offset:
+        raise OffsetMismatch(f"Expected offset {upload.offset}")
+    if length > settings.CHAT_UPLOAD_CHUNK_SIZE:
+        raise UploadTooLarge(f"Chunks are limited to {settings.CHAT_UPLOAD_CHUNK_SIZE} bytes")
+    if offset + length > upload.size:
+        raise UploadTooLarge(f"The upload was announced as {upload.size} bytes")
+
+    sha256 = running_hash(upload)
+    written = 0
+    with open(partial_path(upload), "r+b") as f:
+        f.seek(offset)
+        while written < length:
+            data = stream.read(min(READ_SIZE, length - written))
+            if not data:
+                break
+            f.write(data)
+            sha256.update(data)
+            written += len(data)
+        # Drop whatever a previous attempt at this chunk left past it
+        f.truncate()
+
+    upload.offset = offset + written
+    upload.save(update_fields=["offset", "updated"])
+    _hashes[upload.pk] = (upload.offset, sha256)
+    return upload.offset
+
+
+def running_hash(upload):
+    """The SHA-256 of the upload so far, rebuilt from the partial file if needed."""
+    offset, sha256 = _hashes.get(upload.pk, (None, None))
+    if offset == upload.offset:
+        return sha256
+    sha256 = hashlib.sha256()
+    with open(partial_path(upload), "rb") as f:
+        remaining = upload.offset
+        while remaining:
+            data = f.read(min(READ_SIZE, remaining))
+            if not data:
+                break
+            sha256.update(data)
+            remaining -= len(data)
+    return sha256
+
+
+def finalize_upload(upload, sha256=None):
+    """
+    Turn a complete upload into a ``GroupMessage`` with the file attached.
+
+    ``sha256``, if the client sent one, must match what was received.
+    """
+    if upload.offset != upload.size:
+        raise UploadIncomplete(f"Received {upload.offset} of {upload.size} bytes")
+    digest = running_hash(upload).hexdigest()
+    if sha256 and sha256.lower() != digest:
+        discard_upload(upload)
+        raise UploadError("Checksum mismatch, the upload was discarded")
+
+    message = GroupMessage(author=upload.author, group=upload.group, file_name=upload.filename)
+    with PartialFile(open(partial_path(upload), "rb"), name=upload.filename) as content:
+        content.sha256 = digest  # spares the store hashing it again
+        message.file.save(upload.filename, content, save=False)
+    message.save(force_insert=True)
+    discard_upload(upload)
+    return message
+
+
+def discard_upload(upload):
+    _hashes.pop(upload.pk, None)
+    partial_path(upload).unlink(missing_ok=True)
+    upload.delete()
+
+
+def expire_uploads():
+    cutoff = timezone.now() - timedelta(seconds=settings.CHAT_UPLOAD_EXPIRY)
+    for upload in ChunkedUpload.objects.filter(updated__lt=cutoff):
+        discard_upload(upload)
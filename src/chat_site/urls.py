@@ -2,21 +2,45 @@ from django.urls import path, include
 
 from .views import (
     chat_view,
+    chat_older_messages,
+    chat_members,
+    chat_search,
     get_or_create_chatroom,
     create_groupchat,
     chatroom_edit_view,
+    chatroom_moderate_view,
     chatroom_delete_view,
     chatroom_leave_view,
-    chat_file_upload
+    chat_file_upload,
+    chat_upload_start,
+    chat_upload_chunk,
+    chat_upload_finalize,
 )
 
 urlpatterns = [
     path("", chat_view, name="chat_home"),
     path("chat/<username>", get_or_create_chatroom, name="start-chat"),
     path("chat/room/<chatroom_name>", chat_view, name="chatroom"),
+    path("chat/room/<chatroom_name>/older", chat_older_messages, name="chat-older"),
+    path("chat/room/<chatroom_name>/search", chat_search, name="chat-search"),
+    path("chat/room/<chatroom_name>/members", chat_members, name="chat-members"),
     path("chat/new_groupchat/", create_groupchat, name="new-groupchat"),
     path("chat/edit/<chatroom_name>", chatroom_edit_view, name="edit-chatroom"),
+    path(
+        "chat/moderate/<chatroom_name>", chatroom_moderate_view, name="chatroom-moderate"
+    ),
     path("chat/delete/<chatroom_name>", chatroom_delete_view, name="chatroom-delete"),
     path("chat/leave/<chatroom_name>", chatroom_leave_view, name="chatroom-leave"),
     path("chat/fileupload/<chatroom_name>", chat_file_upload, name="chat-file-upload"),
+    path("chat/upload/<chatroom_name>/", chat_upload_start, name="chat-upload-start"),
+    path(
+        "chat/upload/<chatroom_name>/<uuid:upload_id>",
+        chat_upload_chunk,
+        name="chat-upload-chunk",
+    ),
+    path(
+        "chat/upload/<chatroom_name>/<uuid:upload_id>/finalize",
+        chat_upload_finalize,
+        name="chat-upload-finalize",
+    ),
 ]
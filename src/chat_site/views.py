@@ -1,21 +1,47 @@
+import math
+
 from asgiref.sync import async_to_sync
 from channels.layers import get_channel_layer
 from django.shortcuts import render, get_object_or_404, redirect
 from django.contrib.auth import get_user_model
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required
-from django.http import HttpRequest, Http404, HttpResponse
-
-from .models import ChatGroup, UserChannel, GroupMessage
+from django.conf import settings
+from django.db import transaction
+from django.http import (
+    HttpRequest,
+    Http404,
+    HttpResponse,
+    HttpResponseBadRequest,
+    JsonResponse,
+)
+from django.views.decorators.http import require_http_methods, require_POST
+
+from .cache import banned_ids, is_verified, member_ids, room_or_404
+from .events import message_event, new_message_event, room_status_group
+from .models import ChatGroup, ChunkedUpload, GroupMessage
 from .forms import ChatMessageCreateForm, NewGroupForm, ChatRoomEditForm
+from .moderation import remove_members, unban_members
+from .pagination import messages_before
+from .presence import presence
+from .ratelimit import rate_limiter
+from .records import SUBPROTOCOL
+from .search import search_messages
+from .thumbnails import queue_variants
+from .uploads import (
+    UploadError,
+    finalize_upload,
+    start_upload,
+    write_chunk,
+)
 
 User = get_user_model()
 
 
 @login_required
 def chat_view(request: HttpRequest, chatroom_name="public-chat"):
-    chat_group:list[ChatGroup] = get_object_or_404(ChatGroup, group_name=chatroom_name)
-    chat_messages = chat_group.chat_messages.all()[:40:-1]
+    chat_group: ChatGroup = room_or_404(chatroom_name)
+    chat_messages, older_cursor = messages_before(chat_group)
     form = ChatMessageCreateForm()
     other_user = get_other_user(request.user, chat_group)
 
@@ -30,24 +56,112 @@ def chat_view(request: HttpRequest, chatroom_name="public-chat"):
 
     context = {
         "chat_messages": chat_messages,
+        "older_cursor": older_cursor,
         "form": form,
         "other_user": other_user,
         "chatroom_name": chatroom_name,
         "chat_group": chat_group,
+        "member_ids": member_ids(chat_group),
+        "upload_chunk_size": settings.CHAT_UPLOAD_CHUNK_SIZE,
+        "wire_protocol": SUBPROTOCOL if settings.CHAT_WIRE_PROTOCOL == "json" else "",
     }
 
+    if chat_group.groupchat_name:
+        context.update(members_page(chat_group))
     return render(request, "chat_site/chat.html", context)
 
 
+@login_required
+def chat_members(request: HttpRequest, chatroom_name: str):
+    """Return the page of a group chat's members after the ``after`` id."""
+    chat_group = room_or_404(chatroom_name)
+    check_can_read(request.user, chat_group)
+    try:
+        after = int(request.GET.get("after", 0))
+    except ValueError:
+        return HttpResponseBadRequest("Invalid cursor")
+
+    context = {"chat_group": chat_group, **members_page(chat_group, after)}
+    return render(request, "chat_site/partials/members.html", context)
+
+
+def members_page(chat_group, after=0):
+    """
+    The context of a page of the member strip: ``CHAT_MEMBER_PAGE_SIZE``
+    members by id, each marked ``online``, and the id to continue after.
+    """
+    size = settings.CHAT_MEMBER_PAGE_SIZE
+    members = list(
+        chat_group.members.select_related("profile")
+        .filter(id__gt=after)
+        .order_by("id")[: size + 1]
+    )
+    next_member = members[size - 1].id if len(members) > size else None
+    online_user_ids = presence.peek_online_user_ids(chat_group.group_name)
+    for member in members[:size]:
+        member.online = member.id in online_user_ids
+    return {"members": members[:size], "next_member": next_member}
+
+
+@login_required
+def chat_older_messages(request: HttpRequest, chatroom_name: str):
+    """Return the page of messages before the ``before`` cursor for HTMX to prepend."""
+    chat_group = room_or_404(chatroom_name)
+    check_can_read(request.user, chat_group)
+
+    try:
+        chat_messages, older_cursor = messages_before(
+            chat_group, request.GET.get("before")
+        )
+    except ValueError:
+        return HttpResponseBadRequest("Invalid cursor")
+
+    context = {
+        "chat_messages": chat_messages,
+        "older_cursor": older_cursor,
+        "chat_group": chat_group,
+    }
+    return render(request, "chat_site/partials/chat_older.html", context)
+
+
+@login_required
+def chat_search(request: HttpRequest, chatroom_name: str):
+    """Return a page of the room's messages matching ``q``, best match first."""
+    chat_group = room_or_404(chatroom_name)
+    check_can_read(request.user, chat_group)
+
+    query = request.GET.get("q", "")
+    try:
+        results, next_cursor = search_messages(chat_group, query, request.GET.get("cursor"))
+    except ValueError:
+        return HttpResponseBadRequest("Invalid cursor")
+
+    context = {
+        "results": results,
+        "query": query,
+        "next_cursor": next_cursor,
+        "chat_group": chat_group,
+    }
+    return render(request, "chat_site/partials/search_results.html", context)
+
+
+def check_can_read(user, chat_group):
+    """Raise 404 unless ``user`` may read, and post to, ``chat_group``."""
+    if user.id in banned_ids(chat_group):
+        raise Http404("You are banned from this chat group.")
+    get_other_user(user, chat_group)  # private chats are members only
+    if chat_group.groupchat_name and user.id not in member_ids(chat_group):
+        raise Http404("You are not a member of this chat group.")
+
+
 def get_other_user(current_user, chat_group):
     """Return the other user in a private chat group."""
     if chat_group.is_private:
-        if current_user not in chat_group.members.all():
+        members = member_ids(chat_group)
+        if current_user.id not in members:
             raise Http404("You are not a member of this chat group.")
-        return next(
-            (member for member in chat_group.members.all() if member != current_user),
-            None,
-        )
+        other_id = next((id for id in members if id != current_user.id), None)
+        return User.objects.select_related("profile").filter(id=other_id).first()
     return None
 
 
@@ -57,8 +171,10 @@ def add_user_to_chat_group(request: HttpRequest, chat_group: ChatGroup):
     Checks if the email is verified or not.
     Non-verified members can't join chat.
     """
-    if chat_group.groupchat_name and request.user not in chat_group.members.all():
-        if request.user.emailaddress_set.filter(verified=True).exists():
+    if chat_group.groupchat_name and request.user.id not in member_ids(chat_group):
+        if request.user.id in banned_ids(chat_group):
+            raise Http404("You are banned from this chat group.")
+        if is_verified(request.user):
             chat_group.members.add(request.user)
             return True
         messages.warning(request, "You need to verify your email first to join in.")
@@ -87,16 +203,16 @@ def get_or_create_chatroom(request: HttpRequest, username: str):
     if request.user.username == username:
         return redirect("chat_home")
 
-    other_user = User.objects.get(username=username)
-    my_private_chatrooms = request.user.chat_groups.filter(is_private=True)
+    other_user = get_object_or_404(User, username=username)
 
-    if my_private_chatrooms.exists():
-        for chatroom in my_private_chatrooms:
-            if other_user in chatroom.members.all():
-                return redirect("chatroom", chatroom.group_name)
-
-    chatroom = ChatGroup.objects.create(is_private=True)
-    chatroom.members.add(other_user, request.user)
+    # One indexed lookup; the unique key makes concurrent clicks create one room
+    with transaction.atomic():
+        chatroom, created = ChatGroup.objects.get_or_create(
+            private_key=ChatGroup.private_key_for(request.user, other_user),
+            defaults={"is_private": True},
+        )
+        if created:
+            chatroom.members.add(other_user, request.user)
     return redirect("chatroom", chatroom.group_name)
 
 
@@ -128,19 +244,11 @@ def chatroom_edit_view(request: HttpRequest, chatroom_name: str):
         if form.is_valid():
             form.save()
 
-            remove_members = request.POST.getlist("remove_members")
-            for member_id in remove_members:
-                channel_layer = get_channel_layer()
-                member = User.objects.get(id=member_id)
-                user_channels = UserChannel.objects.filter(
-                    member=member, group=chatgroup
-                )
-                for user_channel in user_channels:
-                    async_to_sync(channel_layer.group_discard)(
-                        chatroom_name, user_channel.channel
-                    )
-                    user_channel.delete()
-                chatgroup.members.remove(member)
+            try:
+                user_ids = user_ids_param(request, "remove_members")
+            except ValueError:
+                return HttpResponseBadRequest("Invalid member id")
+            remove_members(chatgroup, user_ids, ban="ban_members" in request.POST)
 
             return redirect("chatroom", chatroom_name)
     context = {
@@ -150,6 +258,36 @@ def chatroom_edit_view(request: HttpRequest, chatroom_name: str):
     return render(request, "chat_site/chatroom_edit.html", context)
 
 
+@login_required
+@require_POST
+def chatroom_moderate_view(request: HttpRequest, chatroom_name: str):
+    """
+    Remove (``action=kick``), ban (``ban``) or unban (``unban``) the members
+    ``user_ids`` of a group chat at once, see ``chat_site.moderation``.
+    """
+    chatgroup = get_object_or_404(ChatGroup, group_name=chatroom_name)
+    if chatgroup.admin != request.user:
+        raise Http404("You need to be admin of chat to access this feature")
+    action = request.POST.get("action")
+    if action not in ("kick", "ban", "unban"):
+        return HttpResponseBadRequest("action must be kick, ban or unban")
+    try:
+        user_ids = user_ids_param(request, "user_ids")
+    except ValueError:
+        return HttpResponseBadRequest("Invalid user id")
+
+    if action == "unban":
+        unban_members(chatgroup, user_ids)
+    else:
+        user_ids = remove_members(chatgroup, user_ids, ban=action == "ban")
+    return JsonResponse({"action": action, "user_ids": sorted(user_ids)})
+
+
+def user_ids_param(request, name):
+    """The set of user ids in the POST list ``name``; raises ValueError."""
+    return {int(user_id) for user_id in request.POST.getlist(name)}
+
+
 @login_required
 def chatroom_delete_view(request: HttpRequest, chatroom_name: str):
     chatgroup = get_object_or_404(ChatGroup, group_name=chatroom_name)
@@ -165,8 +303,8 @@ def chatroom_delete_view(request: HttpRequest, chatroom_name: str):
 
 @login_required
 def chatroom_leave_view(request: HttpRequest, chatroom_name: str):
-    chatgroup = get_object_or_404(ChatGroup, group_name=chatroom_name)
-    if request.user not in chatgroup.members.all():
+    chatgroup = room_or_404(chatroom_name)
+    if request.user.id not in member_ids(chatgroup):
         raise Http404("You need to be member of chat to leave the chat.")
 
     if request.method == "POST":
@@ -178,19 +316,112 @@ def chatroom_leave_view(request: HttpRequest, chatroom_name: str):
 
 @login_required
 def chat_file_upload(request: HttpRequest, chatroom_name: str):
-    chat_group = get_object_or_404(ChatGroup, group_name=chatroom_name)
+    chat_group = room_or_404(chatroom_name)
+    check_can_read(request.user, chat_group)
 
     if request.htmx and request.FILES:
+        limited = rate_limited(request, chat_group)
+        if limited:
+            return limited
         file = request.FILES["file"]
         message = GroupMessage.objects.create(
-            file=file, author=request.user, group=chat_group
+            file=file, file_name=file.name, author=request.user, group=chat_group
         )
+        queue_variants(message)
+        broadcast_message(message)
+    return HttpResponse()
+
+
+@login_required
+@require_POST
+def chat_upload_start(request: HttpRequest, chatroom_name: str):
+    """Start a chunked upload, see ``chat_site.uploads`` for the protocol."""
+    chat_group = room_or_404(chatroom_name)
+    check_can_read(request.user, chat_group)
+    filename = request.POST.get("filename")
+    try:
+        size = int(request.POST["size"])
+    except (KeyError, ValueError):
+        return HttpResponseBadRequest("A numeric size is required")
+    limited = rate_limited(request, chat_group)
+    if limited:
+        return limited
+
+    try:
+        upload = start_upload(chat_group, request.user, filename, size)
+    except UploadError as error:
+        return HttpResponse(str(error), status=error.status)
+    data = {
+        "id": str(upload.pk),
+        "offset": upload.offset,
+        "chunk_size": settings.CHAT_UPLOAD_CHUNK_SIZE,
+    }
+    return JsonResponse(data, status=201)
 
-        channel_layer = get_channel_layer()
-        event = {
-            "type": "message_handler",
-            "message": message,
-        }
 
-        async_to_sync(channel_layer.group_send)(chatroom_name, event)
+@login_required
+@require_http_methods(["HEAD", "PATCH"])
+def chat_upload_chunk(request: HttpRequest, chatroom_name: str, upload_id):
+    """Report (HEAD) or advance (PATCH) the offset of a chunked upload."""
+    upload = get_object_or_404(
+        ChunkedUpload.objects.select_related("group"),
+        pk=upload_id,
+        group__group_name=chatroom_name,
+        author=request.user,
+    )
+    check_can_read(request.user, upload.group)  # not removed since it started
+    if request.method == "PATCH":
+        try:
+            offset = int(request.headers["Upload-Offset"])
+            length = int(request.headers["Content-Length"])
+            # Streamed from the request, never buffered whole
+            write_chunk(upload, offset, request, length)
+        except (KeyError, ValueError):
+            return HttpResponseBadRequest("Upload-Offset and Content-Length are required")
+        except UploadError as error:
+            response = HttpResponse(str(error), status=error.status)
+            response["Upload-Offset"] = upload.offset
+            return response
+    response = HttpResponse(status=204)
+    response["Upload-Offset"] = upload.offset
+    return response
+
+
+@login_required
+@require_POST
+def chat_upload_finalize(request: HttpRequest, chatroom_name: str, upload_id):
+    """Create and broadcast the message of a completed chunked upload."""
+    upload = get_object_or_404(
+        ChunkedUpload.objects.select_related("group", "author__profile"),
+        pk=upload_id,
+        group__group_name=chatroom_name,
+        author=request.user,
+    )
+    check_can_read(request.user, upload.group)
+    try:
+        message = finalize_upload(upload, request.POST.get("sha256"))
+    except UploadError as error:
+        return HttpResponse(str(error), status=error.status)
+    queue_variants(message)
+    broadcast_message(message)
     return HttpResponse()
+
+
+def rate_limited(request, chat_group):
+    """A 429 response if the user is over an upload limit, else None."""
+    retry_after = rate_limiter.take("upload", request.user.id, chat_group.group_name)
+    if not retry_after:
+        return None
+    response = HttpResponse("Too many uploads, try again later", status=429)
+    response["Retry-After"] = math.ceil(retry_after)
+    return response
+
+
+def broadcast_message(message):
+    """Send a new message to its room and announce it to the members' badges."""
+    channel_layer = get_channel_layer()
+    room = message.group.group_name
+    async_to_sync(channel_layer.group_send)(room, message_event(message))
+    async_to_sync(channel_layer.group_send)(
+        room_status_group(room), new_message_event(message)
+    )
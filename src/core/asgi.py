@@ -24,9 +24,15 @@ os.environ.setdefault("DJANGO_SETTINGS_MODULE", "core.settings")
 django_asgi_application = get_asgi_application()
 
 from chat_site import routing # import it after django_asgi_application
+from chat_site.ids import claim_process_worker_id
+from core.files import FileHandler
+
+claim_process_worker_id()  # raises ImproperlyConfigured if none is free
+
 application = ProtocolTypeRouter(
     {
-        "http": django_asgi_application,  # django asgi for http requests
+        # media and static files are served before django (core/files.py)
+        "http": FileHandler(django_asgi_application),
         "websocket": AllowedHostsOriginValidator(
             AuthMiddlewareStack(URLRouter(routing.websocket_urlpatterns))
         ),
@@ -0,0 +1,217 @@
+"""
+ASGI serving of media and static files, in front of Django.
+
+``FileHandler`` answers GET and HEAD requests under ``MEDIA_URL`` and
+``STATIC_URL`` itself and passes everything else on. Files are sent
+without going through Django's request cycle:
+
+- with the ``http.response.zerocopysend`` extension (sendfile) when the
+  server offers it, otherwise from a memory map in ``CHUNK_SIZE`` pieces;
+- with a strong ``ETag`` (size and modification time) and
+  ``Last-Modified``, answering ``If-None-Match`` and ``If-Modified-Since``
+  with 304;
+- honouring a single ``Range`` (and ``If-Range``) with 206, so an
+  interrupted download or a PDF viewer fetches only the bytes it needs.
+
+Media URLs carry the signature ``chat_site.storage`` adds to them, so only
+someone who was shown an attachment (a member of its chat, see
+``check_can_read``) can fetch it. Content-addressed files never change and
+are cached for a year; other files are revalidated with their ETag.
+"""
+
+import mimetypes
+import mmap
+import os
+import stat
+from email.utils import formatdate, parsedate_to_datetime
+from urllib.parse import parse_qs, unquote
+
+from django.conf import settings
+from django.contrib.staticfiles import finders
+from django.core.exceptions import SuspiciousFileOperation
+from django.utils._os import safe_join
+
+from chat_site.storage import BLOB_DIR, verify_url_signature
+
+CHUNK_SIZE = 256 * 1024
+IMMUTABLE = "private, max-age=31536000, immutable"
+
+
+class FileHandler:
+    def __init__(self, application):
+        self.application = application
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["method"] in ("GET", "HEAD"):
+            path = self.find(scope)
+            if path is not None:
+                return await serve(scope, send, *path)
+        await self.application(scope, receive, send)
+
+    def find(self, scope):
+        """``(file path, Cache-Control)`` of the file ``scope`` asks for, or None."""
+        url = scope["path"]
+        media_url = f"/{settings.MEDIA_URL.lstrip('/')}"
+        static_url = f"/{settings.STATIC_URL.lstrip('/')}"
+        if url.startswith(media_url):
+            name = unquote(url[len(media_url) :])
+            signature = parse_qs(scope.get("query_string", b"").decode()).get("s", [""])[0]
+            if not verify_url_signature(name, signature):
+                return None
+            cache_control = IMMUTABLE if name.startswith(f"{BLOB_DIR}/") else "private, no-cache"
+            return join(settings.MEDIA_ROOT, name), cache_control
+        if url.startswith(static_url):
+            name = unquote(url[len(static_url) :])
+            if settings.STATIC_ROOT:
+                return join(settings.STATIC_ROOT, name), "public, no-cache"
+            if settings.DEBUG:
+                path = finders.find(name)
+                return (path, "no-cache") if path else None
+        return None
+
+
+def join(root, name):
+    try:
+        return safe_join(root, name)
+    except SuspiciousFileOperation:
+        return None
+
+
+async def serve(scope, send, path, cache_control):
+    if path is None:
+        return await respond(send, 404)
+    try:
+        f = open(path, "rb")
+    except OSError:
+        return await respond(send, 404)
+    with f:
+        st = os.fstat(f.fileno())
+        if not stat.S_ISREG(st.st_mode):
+            return await respond(send, 404)
+        size = st.st_size
+        etag = f'"{size:x}-{st.st_mtime_ns:x}"'
+        headers = {
+            "etag": etag,
+            "last-modified": formatdate(st.st_mtime, usegmt=True),
+            "cache-control": cache_control,
+            "accept-ranges": "bytes",
+        }
+        request = {
+            key.decode().lower(): value.decode("latin-1") for key, value in scope["headers"]
+        }
+        if not_modified(request, etag, st.st_mtime):
+            return await respond(send, 304, headers)
+
+        content_type, encoding = mimetypes.guess_type(path)
+        headers["content-type"] = content_type or "application/octet-stream"
+        if encoding:
+            headers["content-encoding"] = encoding
+
+        status, start, end = 200, 0, size
+        byte_range = request.get("range")
+        if byte_range and if_range_matches(request.get("if-range"), etag, st.st_mtime):
+            parsed = parse_range(byte_range, size)
+            if parsed == "unsatisfiable":
+                headers["content-range"] = f"bytes */{size}"
+                return await respond(send, 416, headers)
+            if parsed is not None:
+                start, end = parsed
+                status = 206
+                headers["content-range"] = f"bytes {start}-{end - 1}/{size}"
+        headers["content-length"] = str(end - start)
+
+        await send(
+            {
+                "type": "http.response.start",
+                "status": status,
+                "headers": [(key.encode(), value.encode()) for key, value in headers.items()],
+            }
+        )
+        if scope["method"] == "HEAD" or start == end:
+            return await send({"type": "http.response.body", "body": b""})
+        if "http.response.zerocopysend" in scope.get("extensions", {}):
+            return await send(
+                {
+                    "type": "http.response.zerocopysend",
+                    "file": f,
+                    "offset": start,
+                    "count": end - start,
+                }
+            )
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            for offset in range(start, end, CHUNK_SIZE):
+                chunk_end = min(offset + CHUNK_SIZE, end)
+                await send(
+                    {
+                        "type": "http.response.body",
+                        "body": data[offset:chunk_end],
+                        "more_body": chunk_end < end,
+                    }
+                )
+
+
+async def respond(send, status, headers=None):
+    headers = dict(headers or {})
+    headers["content-length"] = "0"
+    await send(
+        {
+            "type": "http.response.start",
+            "status": status,
+            "headers": [(key.encode(), value.encode()) for key, value in headers.items()],
+        }
+    )
+    await send({"type": "http.response.body", "body": b""})
+
+
+def parse_http_date(value):
+    try:
+        return parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+
+def not_modified(request, etag, mtime):
+    """Whether the client's copy is current (RFC 9110 13.1.2 and 13.1.3)."""
+    if_none_match = request.get("if-none-match")
+    if if_none_match is not None:
+        # Weak comparison: W/"x" matches "x"
+        tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+        return "*" in tags or etag in tags
+    since = parse_http_date(request.get("if-modified-since"))
+    return since is not None and int(mtime) <= since
+
+
+def if_range_matches(if_range, etag, mtime):
+    """Whether a ``Range`` applies: ``If-Range`` absent, or naming this version."""
+    if if_range is None:
+        return True
+    if if_range.startswith('"'):
+        return if_range == etag  # strong comparison
+    return parse_http_date(if_range) == int(mtime)
+
+
+def parse_range(value, size):
+    """
+    ``(start, end)`` of a single-range ``bytes=`` header, "unsatisfiable",
+    or None to ignore it and send the whole file (several ranges, or
+    syntax this doesn't know).
+    """
+    unit, _, ranges = value.partition("=")
+    if unit.strip().lower() != "bytes" or "," in ranges:
+        return None
+    first, _, last = ranges.strip().partition("-")
+    try:
+        if not first:
+            suffix = int(last)
+            if suffix <= 0:
+                return "unsatisfiable"
+            return max(size - suffix, 0), size
+        start = int(first)
+        end = int(last) + 1 if last else size
+    except ValueError:
+        return None
+    if start >= size:
+        return "unsatisfiable"
+    if end <= start:
+        return None
+    return start, min(end, size)
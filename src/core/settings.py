@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/4.2/ref/settings/
 """
 
+import tempfile
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -80,6 +81,7 @@ TEMPLATES = [
                 "django.template.context_processors.request",
                 "django.contrib.auth.context_processors.auth",
                 "django.contrib.messages.context_processors.messages",
+                "chat_site.context_processors.chat_groups",
             ],
         },
     },
@@ -90,12 +92,81 @@ ASGI_APPLICATION = "core.asgi.application"
 
 # Channels layers config
 # https://channels.readthedocs.io/en/latest/topics/channel_layers.html#in-memory-channel-layer
+# One process. Several workers on one host share groups with
+#   "BACKEND": "chat_site.layers.UnixSocketChannelLayer",
+#   "CONFIG": {"path": BASE_DIR / "run" / "channels"},
+# each claiming its own CHAT_WORKER_ID. They also need
+#   CHAT_CACHE_BACKEND = "chat_site.cache.SharedCache"
+# or a worker keeps serving rooms, members and bans changed by another.
+# The rest stays per worker:
+# - presence: online counts and status dots count the worker's own sockets,
+#   and unread badges go up for messages read on another worker's socket
+#   (until that socket's read cursor is saved). users_online is the union
+#   of every worker's view (chat_site.presence.write_snapshot);
+# - rate limits: each worker has its own buckets, so a user or room may send
+#   up to the number of workers times CHAT_RATE_LIMITS;
+# - replay logs: a worker without the gap in memory reads it from the table.
 CHANNEL_LAYERS = {
     "default": {
         "BACKEND": "channels.layers.InMemoryChannelLayer"
     }
 }
 
+# Presence registry (chat_site/presence.py)
+CHAT_PRESENCE_TTL = 60  # seconds a connection stays online without a heartbeat
+CHAT_PRESENCE_FLUSH_INTERVAL = 30  # seconds between users_online snapshots
+CHAT_PRESENCE_BATCH_INTERVAL = 1  # seconds presence changes are coalesced for
+CHAT_MEMBER_PAGE_SIZE = 50  # members per page of a group chat's member strip
+
+# Message persistence (chat_site/persistence.py): "sync" or "write_behind"
+CHAT_MESSAGE_PERSISTENCE = "sync"
+CHAT_WRITE_BEHIND_QUEUE_SIZE = 10000  # messages waiting for the writer
+CHAT_WRITE_BEHIND_BATCH_SIZE = 500  # rows per group commit
+CHAT_WRITE_BEHIND_INTERVAL = 0.05  # seconds a group commit waits to fill up
+CHAT_WORKER_ID = None  # 0-63, unique per process writing messages (chat_site/ids.py)
+CHAT_WORKER_LOCK_DIR = Path(tempfile.gettempdir()) / "chat-worker-ids"  # claims of unset ids
+
+# Unread tracking (chat_site/unread.py)
+CHAT_READ_CURSOR_INTERVAL = 5  # seconds between read cursor writes per socket
+
+# Chunked attachment uploads (chat_site/uploads.py)
+CHAT_UPLOAD_MAX_SIZE = 100 * 1024 * 1024  # bytes per file
+CHAT_UPLOAD_CHUNK_SIZE = 1024 * 1024  # bytes per request
+CHAT_UPLOAD_EXPIRY = 24 * 60 * 60  # seconds before an abandoned upload is deleted
+
+# Rate limits (chat_site/ratelimit.py): (tokens per second, burst)
+CHAT_RATE_LIMITS = {
+    "message": {"user": (2, 10), "room": (50, 200)},
+    "upload": {"user": (0.2, 5), "room": (2, 20)},
+}
+CHAT_SEND_QUEUE_SIZE = 256  # outbound frames per socket, not under daphne (chat_site/sendqueue.py)
+CHAT_COALESCE_WINDOW = 0  # seconds a chatroom socket gathers a burst, 0 sends each frame
+CHAT_COALESCE_MAX_BYTES = 64 * 1024  # per coalesced frame
+
+# Room and membership cache (chat_site/cache.py): "chat_site.cache.LocalCache"
+# in each process, or "chat_site.cache.SharedCache" in the CHAT_CACHE_ALIAS
+# Django cache, for several workers
+CHAT_CACHE_BACKEND = "chat_site.cache.LocalCache"
+CHAT_CACHE_SIZE = 10000  # entries of each LocalCache
+CHAT_CACHE_ALIAS = "default"
+
+# Resuming sockets (chat_site/replay.py)
+CHAT_REPLAY_BUFFER = 256  # message events kept per room and process
+CHAT_REPLAY_MAX_BYTES = 32 * 1024 * 1024  # of rendered events, all rooms of a process
+CHAT_REPLAY_LIMIT = 500  # missed messages past which the page is reloaded instead
+
+# Socket wire protocol (chat_site/records.py): "html" fragments, or "json"
+# records the chat page renders itself
+CHAT_WIRE_PROTOCOL = "html"
+
+# Image variants (chat_site/thumbnails.py)
+CHAT_THUMBNAIL_WORKERS = 2  # Pillow processes, 0 makes the variants in the request
+
+# Cold storage of old messages (chat_site/archive.py)
+CHAT_ARCHIVE_ROOT = BASE_DIR / "archive"
+CHAT_ARCHIVE_AFTER_DAYS = 90  # unless a room sets archive_after_days
+CHAT_ARCHIVE_SEGMENT_SIZE = 50000  # messages per segment file
+
 
 # Database
 # https://docs.djangoproject.com/en/4.2/ref/settings/#databases
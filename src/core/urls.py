@@ -17,8 +17,6 @@ Including another URLconf
 
 from django.contrib import admin
 from django.urls import path, include
-from django.conf import settings
-from django.conf.urls.static import static
 from a_users.views import profile_view
 
 urlpatterns = [
@@ -29,6 +27,4 @@ urlpatterns = [
     path("profile/", include("a_users.urls")),
 ]
 
-if settings.DEBUG:
-    urlpatterns += static(settings.STATIC_URL, document_root=settings.STATIC_ROOT)
-    urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
+# Media and static files are served by core.files.FileHandler in core/asgi.py
@@ -0,0 +1,81 @@
+// Renders the JSON records of a chatroom socket (chat_site/records.py) into
+// the markup chat_message.html produces. Frames that aren't records are
+// htmx fragments and are left to the ws extension.
+
+(() => {
+  const userId = Number(document.currentScript.dataset.userId);
+
+  document.addEventListener("htmx:wsBeforeMessage", (event) => {
+    const data = event.detail.message;
+    if (typeof data !== "string" || (data[0] !== "{" && data[0] !== "[")) return;
+    event.preventDefault();
+    // A burst of records comes as one array (chat_site/sendqueue.py)
+    [JSON.parse(data)].flat().forEach(render);
+  });
+
+  function render(record) {
+    if (record.type === "message") {
+      renderMessage(record);
+    } else if (record.type === "attachment") {
+      const img = document.getElementById("attachment-" + record.id);
+      if (img) setImageSize(img, record);
+    }
+  }
+
+  function renderMessage(record) {
+    const own = record.author_id === userId;
+    const li = document.getElementById(own ? "message-own" : "message-other")
+      .content.firstElementChild.cloneNode(true);
+    if (record.seq) li.dataset.seq = record.seq;
+    li.querySelector("[data-slot=content]").append(...content(record));
+    if (!own) {
+      const profile = li.querySelector("[data-slot=profile]");
+      profile.href = profile.dataset.href.replace("USERNAME", encodeURIComponent(record.username));
+      li.querySelector("[data-slot=avatar]").src = record.avatar;
+      li.querySelector("[data-slot=name]").textContent = record.name;
+      li.querySelector("[data-slot=username]").textContent = "@" + record.username;
+    }
+    const wrapper = document.createElement("div");
+    wrapper.className = "fade-in-up";
+    wrapper.append(li);
+    document.getElementById("chat_messages").append(wrapper);
+    scrollToBottom(100);
+  }
+
+  function content(record) {
+    if (record.body) {
+      const span = document.createElement("span");
+      span.textContent = record.body;
+      return [span];
+    }
+    if (record.image) {
+      const img = document.createElement("img");
+      img.id = "attachment-" + record.id;
+      img.src = record.file;
+      img.alt = record.file_name;
+      img.className = "max-w-full h-auto";
+      img.loading = "lazy";
+      img.decoding = "async";
+      setImageSize(img, record);
+      return [img];
+    }
+    const link = document.createElement("a");
+    link.href = record.file;
+    link.className = "cursor-pointer italic hover:underline";
+    link.target = "_blank";
+    link.download = "";
+    link.textContent = record.file_name;
+    return ["\u{1F4CE} ", link];
+  }
+
+  function setImageSize(img, record) {
+    if (record.width) {
+      img.width = record.width;
+      img.height = record.height;
+    }
+    if (record.srcset) {
+      img.srcset = record.srcset;
+      img.sizes = "(max-width: 640px) 70vw, 480px";
+    }
+  }
+})();